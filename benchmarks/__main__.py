@@ -0,0 +1,462 @@
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import libvirt
+from prometheus_client import CollectorRegistry
+
+from benchmarks.fake_connection import FakeConnection
+from prometheus_libvirt import domain_metadata, exporter_desc, prometheus_desc
+from prometheus_libvirt.domain_description import DomainDescription
+from prometheus_libvirt.domain_worker import STATS_GROUPS, DomainWorker
+from prometheus_libvirt.exposition import ExpositionCache, Snapshot
+from prometheus_libvirt.http_server import HttpServer
+from prometheus_libvirt.libvirt_executor import LibvirtExecutor
+from prometheus_libvirt.rate_store import RateStore
+from prometheus_libvirt.shard import SeriesEncoder, ShardSeries
+from prometheus_libvirt.storage_pool_worker import StoragePoolWorker
+from prometheus_libvirt.storage_volume_worker import StorageVolumeWorker
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="benchmarks",
+        description="Measure collection sweeps, /metrics rendering and serving "
+        "against a synthetic connection or libvirt's test driver",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=("fake", "test"),
+        default="fake",
+        help="fake: synthetic in-process connection, test: test:///default "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--domains",
+        type=int,
+        default=100,
+        help="Domains of the fake backend (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--nics",
+        type=int,
+        default=2,
+        help="Interfaces per fake domain (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--disks",
+        type=int,
+        default=2,
+        help="Disks per fake domain (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--volumes",
+        type=int,
+        default=0,
+        help="Volumes in each of the four fake storage pools (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-nova",
+        action="store_true",
+        help="Leave the nova metadata out of the fake domain XML",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        metavar="SECONDS",
+        help="Simulated latency of every fake libvirt call (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--bulk-stats",
+        default="",
+        metavar="GROUPS",
+        help="Comma separated stats groups to collect with getAllDomainStats, "
+        "or 'all'",
+    )
+    parser.add_argument(
+        "--derived-metrics",
+        action="store_true",
+        help="Compute the rate gauges during the sweeps",
+    )
+    parser.add_argument(
+        "--rpc-threads",
+        type=int,
+        default=8,
+        metavar="N",
+        help="Executor threads (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=5,
+        metavar="N",
+        help="Sweeps and renderings measured per benchmark (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=200,
+        metavar="N",
+        help="/metrics requests sent to the HTTP server (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        metavar="N",
+        help="Keep-alive connections the requests are spread over "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--startup-budget",
+        type=float,
+        default=3,
+        metavar="SECONDS",
+        help="Fail when a fresh exporter process takes longer than this to "
+        "serve collected series on /metrics (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output",
+        default="benchmark.json",
+        metavar="PATH",
+        help="JSON file to write the results to, - for stdout "
+        "(default: %(default)s)",
+    )
+    args = parser.parse_args()
+    if args.bulk_stats == "all":
+        args.bulk_stats = tuple(STATS_GROUPS)
+    else:
+        args.bulk_stats = tuple(group for group in args.bulk_stats.split(",") if group)
+        for group in args.bulk_stats:
+            if group not in STATS_GROUPS:
+                parser.error("unknown stats group %r" % group)
+    return args
+
+
+def summary(values: list) -> dict:
+    return {
+        "min": min(values),
+        "median": statistics.median(values),
+        "mean": statistics.mean(values),
+        "max": max(values),
+    }
+
+
+def executor_calls() -> collections.Counter:
+    # Calls that went through a LibvirtExecutor, by method
+    calls = collections.Counter()
+    for family in exporter_desc.libvirt_exporter_rpc_duration.collect():
+        for sample in family.samples:
+            if sample.name.endswith("_count"):
+                calls[sample.labels["method"]] = int(sample.value)
+    return calls
+
+
+def libvirt_calls(conn) -> collections.Counter:
+    # Every call the fake backend answered, including those made inside
+    # executor calls, e.g. the bulk stats probes
+    return collections.Counter(getattr(conn, "rpcs", {}))
+
+
+async def bench_sweeps(sweep, conn, iterations: int) -> dict:
+    started = time.perf_counter()
+    objects = await sweep()
+    first_sweep = time.perf_counter() - started
+
+    durations = []
+    calls_before, libvirt_before = executor_calls(), libvirt_calls(conn)
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await sweep()
+        durations.append(time.perf_counter() - started)
+    calls = executor_calls() - calls_before
+    libvirt_total = libvirt_calls(conn) - libvirt_before
+
+    tracemalloc.start()
+    await sweep()
+    allocated, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        "objects": objects,
+        "first_sweep_seconds": first_sweep,
+        "sweep_seconds": summary(durations),
+        "executor_calls_per_sweep": {
+            method: count / iterations for method, count in sorted(calls.items())
+        },
+        "allocated_bytes": allocated,
+        "peak_traced_bytes": peak,
+    }
+    if libvirt_total:
+        result["libvirt_calls_per_sweep"] = {
+            method: count / iterations
+            for method, count in sorted(libvirt_total.items())
+        }
+    return result
+
+
+def bench_parse(domains: list, iterations: int) -> dict:
+    # Per-domain cost of reading the domain XML and the nova metadata element
+    # alone, without the libvirt calls fetching them
+    if not domains:
+        return {}
+    xmls = [domain.XMLDesc(0) for domain in domains]
+    elements = []
+    for domain in domains:
+        try:
+            elements.append(
+                domain.metadata(
+                    libvirt.VIR_DOMAIN_METADATA_ELEMENT,
+                    domain_metadata.NOVA.namespace,
+                    0,
+                )
+            )
+        except libvirt.libvirtError:
+            pass
+    description_durations = []
+    metadata_durations = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        for xml in xmls:
+            DomainDescription(0, xml)
+        description_durations.append((time.perf_counter() - started) / len(xmls))
+        started = time.perf_counter()
+        for element_xml in elements:
+            domain_metadata.NOVA.extract(domain_metadata.fromstring(element_xml))
+        if elements:
+            metadata_durations.append(
+                (time.perf_counter() - started) / len(elements)
+            )
+    result = {"description_seconds_per_domain": summary(description_durations)}
+    if metadata_durations:
+        result["metadata_seconds_per_domain"] = summary(metadata_durations)
+    return result
+
+
+async def bench_shard_batches(sweep, registry, iterations: int) -> dict:
+    # What a --shards process sends per sweep and the supervisor merges,
+    # with every domain in one shard
+    encoder = SeriesEncoder()
+    series = ShardSeries()
+    first = encoder.batch(registry)
+    series.apply(first)
+    encode_durations = []
+    apply_durations = []
+    sizes = []
+    for _ in range(iterations):
+        await sweep()
+        started = time.perf_counter()
+        batch = encoder.batch(registry)
+        encode_durations.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        series.apply(batch)
+        apply_durations.append(time.perf_counter() - started)
+        sizes.append(len(batch))
+    return {
+        "first_batch_bytes": len(first),
+        "batch_bytes": summary(sizes),
+        "encode_seconds": summary(encode_durations),
+        "apply_seconds": summary(apply_durations),
+        "series": len(series.series),
+    }
+
+
+def bench_render(exposition: ExpositionCache, iterations: int) -> dict:
+    snapshot_durations = []
+    durations = []
+    compress_durations = []
+    for _ in range(iterations):
+        # The part of a rendering that runs on the loop
+        started = time.perf_counter()
+        snapshot = Snapshot(exposition.registry)
+        snapshot_durations.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        renderings = exposition.render(snapshot)
+        durations.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        for rendering in renderings:
+            # Fresh copies, the cache keeps compressed bodies of unchanged
+            # renderings
+            rendering.gzip = rendering.zstd = None
+            rendering.compress()
+        compress_durations.append(time.perf_counter() - started)
+    text = exposition.text
+    return {
+        "snapshot_seconds": summary(snapshot_durations),
+        "render_seconds": summary(durations),
+        "compress_seconds": summary(compress_durations),
+        "body_bytes": len(text.body),
+        "gzip_bytes": len(text.gzip),
+        "zstd_bytes": len(text.zstd) if text.zstd is not None else None,
+        "series": text.body.count(b"\n") - text.body.count(b"\n#"),
+    }
+
+
+async def bench_http(exposition: ExpositionCache, requests: int, concurrency: int):
+    async def handler(request):
+        return exposition.response(
+            request.header("accept"),
+            request.header("accept-encoding"),
+            request.header("if-none-match"),
+            request.header("if-modified-since"),
+        )
+
+    server = HttpServer(handler, host="127.0.0.1", port=0)
+    await server.start()
+    port = server.server.sockets[0].getsockname()[1]
+    latencies = []
+
+    async def client(count: int):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        for _ in range(count):
+            started = time.perf_counter()
+            writer.write(
+                b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n"
+                b"Accept-Encoding: gzip\r\n\r\n"
+            )
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = int(head.lower().split(b"content-length: ")[1].split(b"\r\n")[0])
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - started)
+        writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(client(requests // concurrency) for _ in range(concurrency))
+    )
+    elapsed = time.perf_counter() - started
+    await server.close()
+    return {
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "request_seconds": summary(latencies),
+        "requests_per_second": len(latencies) / elapsed,
+    }
+
+
+def bench_startup(args) -> dict:
+    # In a fresh interpreter, so imports are paid for again
+    command = [
+        sys.executable,
+        "-m",
+        "benchmarks.startup",
+        "--backend",
+        args.backend,
+        "--domains",
+        str(args.domains),
+    ]
+    started = time.perf_counter()
+    output = subprocess.run(command, capture_output=True, text=True, check=True)
+    result = json.loads(output.stdout)
+    result["process_seconds"] = time.perf_counter() - started
+    result["budget_seconds"] = args.startup_budget
+    result["within_budget"] = result["first_metrics_seconds"] <= args.startup_budget
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    if args.backend == "fake":
+        conn = FakeConnection(
+            domains=args.domains,
+            nics=args.nics,
+            disks=args.disks,
+            nova=not args.no_nova,
+            latency=args.latency,
+            volumes=args.volumes,
+        )
+    else:
+        conn = libvirt.open("test:///default")
+    # A registry of its own, so runs don't see each other's series
+    registry = CollectorRegistry()
+    metrics = prometheus_desc.metric_set(registry)
+    executor = LibvirtExecutor(max_workers=args.rpc_threads)
+    domain_worker = DomainWorker(
+        conn,
+        stats_groups=args.bulk_stats,
+        metrics=metrics,
+        executor=executor,
+        rates=RateStore() if args.derived_metrics else None,
+    )
+    storage_pool_worker = StoragePoolWorker(conn, metrics=metrics, executor=executor)
+    storage_volume_worker = StorageVolumeWorker(
+        conn, metrics=metrics, executor=executor
+    )
+    results = {
+        "domain_worker": await bench_sweeps(
+            domain_worker.sweep, conn, args.iterations
+        ),
+        "storage_pool_worker": await bench_sweeps(
+            storage_pool_worker.sweep, conn, args.iterations
+        ),
+        "storage_volume_worker": await bench_sweeps(
+            storage_volume_worker.sweep, conn, args.iterations
+        ),
+    }
+    if args.backend == "fake":
+        domains = conn.domains
+    else:
+        domains = conn.listAllDomains(0)
+    results["parse"] = bench_parse(domains, args.iterations)
+    results["shard_batches"] = await bench_shard_batches(
+        domain_worker.sweep, registry, args.iterations
+    )
+    exposition = ExpositionCache(registry)
+    results["render"] = bench_render(exposition, args.iterations)
+    results["http"] = await bench_http(exposition, args.requests, args.concurrency)
+    executor.shutdown()
+    results["startup"] = bench_startup(args)
+    return results
+
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run(args))
+    report = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "parameters": {
+            name: value for name, value in vars(args).items() if name != "output"
+        },
+        "results": results,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    startup = results["startup"]
+    if not startup["within_budget"]:
+        sys.exit(
+            "First /metrics after %.2fs, over the %gs startup budget"
+            % (startup["first_metrics_seconds"], startup["budget_seconds"])
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+import collections
+import threading
+import time
+
+import libvirt
+
+NOVA_NAMESPACE = "http://openstack.org/xmlns/libvirt/nova/1.1"
+
+NOVA_INSTANCE = (
+    "<nova:instance xmlns:nova='" + NOVA_NAMESPACE + "'>"
+    "<nova:name>instance-%(index)d</nova:name>"
+    "<nova:flavor name='m1.small'/>"
+    "<nova:owner>"
+    "<nova:user uuid='%(uuid)s'>user-%(index)d</nova:user>"
+    "<nova:project uuid='%(uuid)s'>project-%(index)d</nova:project>"
+    "</nova:owner>"
+    "</nova:instance>"
+)
+
+INTERFACE = (
+    "<interface type='bridge'>"
+    "<mac address='52:54:00:%02x:%02x:%02x'/>"
+    "<target dev='tap%d-%d'/>"
+    "</interface>"
+)
+
+DISK = (
+    "<disk type='file' device='disk'>"
+    "<driver name='qemu' type='qcow2' discard='unmap'/>"
+    "<source file='/var/lib/libvirt/images/domain-%d-%d.qcow2'/>"
+    "<target dev='vd%s' bus='virtio'/>"
+    "</disk>"
+)
+
+FAKE_CAPABILITIES = (
+    "<capabilities><host><cpu><arch>x86_64</arch>"
+    "<pages unit='KiB' size='4'/>"
+    "<pages unit='KiB' size='2048'/>"
+    "<pages unit='KiB' size='1048576'/>"
+    "</cpu></host></capabilities>"
+)
+
+
+class FakeConnection:
+    # Stands in for virConnect, with the subset of calls the workers make.
+    # Every remote call sleeps latency seconds and is counted in rpcs
+    def __init__(
+        self,
+        domains: int = 100,
+        nics: int = 2,
+        disks: int = 2,
+        nova: bool = True,
+        latency: float = 0,
+        pools: int = 4,
+        volumes: int = 0,
+    ):
+        self.latency = latency
+        self.rpcs = collections.Counter()
+        self.lock = threading.Lock()
+        self.domains = [
+            FakeDomain(self, i, nics, disks, nova) for i in range(domains)
+        ]
+        self.by_uuid = {domain.UUIDString(): domain for domain in self.domains}
+        self.pools = [FakeStoragePool(self, i, volumes) for i in range(pools)]
+
+    def rpc(self, method: str):
+        with self.lock:
+            self.rpcs[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def listAllDomains(self, flags=0):
+        self.rpc("listAllDomains")
+        return list(self.domains)
+
+    def lookupByUUIDString(self, uuid):
+        self.rpc("lookupByUUIDString")
+        return self.by_uuid[uuid]
+
+    def getAllDomainStats(self, stats=0, flags=0):
+        self.rpc("getAllDomainStats")
+        return [(domain, domain.stats_record(stats)) for domain in self.domains]
+
+    def domainListGetStats(self, domains, stats=0, flags=0):
+        self.rpc("domainListGetStats")
+        return [(domain, domain.stats_record(stats)) for domain in domains]
+
+    def listAllStoragePools(self, flags=0):
+        self.rpc("listAllStoragePools")
+        return list(self.pools)
+
+    def getVersion(self):
+        self.rpc("getVersion")
+        return 8000000
+
+    def getLibVersion(self):
+        self.rpc("getLibVersion")
+        return 9004000
+
+    def getHostname(self):
+        self.rpc("getHostname")
+        return "fake-host"
+
+    def getInfo(self):
+        self.rpc("getInfo")
+        return ["x86_64", 257673, 64, 2400, 2, 16, 2, 1]
+
+    def getCPUStats(self, cpuNum, flags=0):
+        self.rpc("getCPUStats")
+        return {
+            "kernel": 5 * 10**12,
+            "user": 2 * 10**13,
+            "idle": 10**14,
+            "iowait": 10**11,
+        }
+
+    def getMemoryStats(self, cellNum, flags=0):
+        self.rpc("getMemoryStats")
+        return {
+            "total": 263857152,
+            "free": 131928576,
+            "buffers": 1048576,
+            "cached": 8388608,
+        }
+
+    def getCellsFreeMemory(self, startCell, maxCells):
+        self.rpc("getCellsFreeMemory")
+        return [64 * 1024**3] * maxCells
+
+    def getCapabilities(self):
+        self.rpc("getCapabilities")
+        return FAKE_CAPABILITIES
+
+    def getFreePages(self, pages, startCell, cellCount, flags=0):
+        self.rpc("getFreePages")
+        return {
+            cell: {size: 1024 if size == 2048 else 10**6 for size in pages}
+            for cell in range(startCell, startCell + cellCount)
+        }
+
+    def setKeepAlive(self, interval, count):
+        pass
+
+    def registerCloseCallback(self, callback, opaque):
+        pass
+
+    def domainEventRegisterAny(self, dom, event_id, callback, opaque):
+        self.rpc("domainEventRegisterAny")
+        return event_id
+
+    def domainEventDeregisterAny(self, callback_id):
+        self.rpc("domainEventDeregisterAny")
+
+    def storagePoolEventRegisterAny(self, pool, event_id, callback, opaque):
+        self.rpc("storagePoolEventRegisterAny")
+        return event_id
+
+    def storagePoolEventDeregisterAny(self, callback_id):
+        self.rpc("storagePoolEventDeregisterAny")
+
+
+class FakeDomain:
+    def __init__(
+        self, conn: FakeConnection, index: int, nics: int, disks: int, nova: bool
+    ):
+        self.conn = conn
+        self.index = index
+        self.uuid = "00000000-0000-4000-8000-%012d" % index
+        self.nics = ["tap%d-%d" % (index, i) for i in range(nics)]
+        self.disks = ["vd%s" % chr(ord("a") + i) for i in range(disks)]
+        devices = "".join(
+            INTERFACE % (index >> 8 & 0xFF, index & 0xFF, i, index, i)
+            for i in range(nics)
+        ) + "".join(DISK % (index, i, chr(ord("a") + i)) for i in range(disks))
+        self.nova = None
+        metadata = ""
+        if nova:
+            self.nova = NOVA_INSTANCE % {"index": index, "uuid": self.uuid}
+            metadata = "<metadata>%s</metadata>" % self.nova
+        self.xml = (
+            "<domain type='kvm'><name>%s</name><uuid>%s</uuid>%s"
+            "<devices>%s</devices></domain>"
+            % (self.name(), self.uuid, metadata, devices)
+        )
+
+    # Local calls, answered from the virDomain object without an RPC
+
+    def name(self):
+        return "domain-%d" % self.index
+
+    def UUIDString(self):
+        return self.uuid
+
+    def ID(self):
+        return self.index + 1
+
+    def connect(self):
+        return self.conn
+
+    # Remote calls
+
+    def info(self):
+        self.conn.rpc("info")
+        return [libvirt.VIR_DOMAIN_RUNNING, 4194304, 2097152, 2, 10**10]
+
+    def isActive(self):
+        self.conn.rpc("isActive")
+        return 1
+
+    def isPersistent(self):
+        self.conn.rpc("isPersistent")
+        return 1
+
+    def XMLDesc(self, flags=0):
+        self.conn.rpc("XMLDesc")
+        return self.xml
+
+    def metadata(self, type, uri, flags=0):
+        self.conn.rpc("metadata")
+        if uri != NOVA_NAMESPACE or self.nova is None:
+            error = libvirt.libvirtError("metadata not found")
+            # As virGetLastError() would have it: code, domain, message, level
+            error.err = (
+                libvirt.VIR_ERR_NO_DOMAIN_METADATA,
+                libvirt.VIR_FROM_DOMAIN,
+                "metadata not found",
+                libvirt.VIR_ERR_ERROR,
+                None,
+                None,
+                None,
+                0,
+                0,
+            )
+            raise error
+        return self.nova
+
+    def getCPUStats(self, total):
+        self.conn.rpc("getCPUStats")
+        return [
+            {"cpu_time": 10**10, "user_time": 4 * 10**9, "system_time": 6 * 10**9}
+        ]
+
+    def memoryStats(self):
+        self.conn.rpc("memoryStats")
+        return self.memory_stats()
+
+    def setMemoryStatsPeriod(self, period, flags=0):
+        self.conn.rpc("setMemoryStatsPeriod")
+        return 0
+
+    def interfaceStats(self, dev):
+        self.conn.rpc("interfaceStats")
+        return (1000, 10, 0, 0, 2000, 20, 0, 0)
+
+    def blockStatsFlags(self, dev, flags=0):
+        self.conn.rpc("blockStatsFlags")
+        return {
+            "rd_bytes": 4096,
+            "rd_operations": 1,
+            "rd_total_times": 1000,
+            "wr_bytes": 8192,
+            "wr_operations": 2,
+            "wr_total_times": 2000,
+            "flush_operations": 1,
+            "flush_total_times": 500,
+        }
+
+    @staticmethod
+    def memory_stats():
+        return {
+            "actual": 2097152,
+            "swap_in": 0,
+            "swap_out": 0,
+            "major_fault": 10,
+            "minor_fault": 1000,
+            "unused": 1048576,
+            "available": 2000000,
+            "usable": 1500000,
+            "disk_caches": 100000,
+            "rss": 1900000,
+        }
+
+    def stats_record(self, stats: int) -> dict:
+        record = {}
+        if stats & libvirt.VIR_DOMAIN_STATS_STATE:
+            record["state.state"] = libvirt.VIR_DOMAIN_RUNNING
+        if stats & libvirt.VIR_DOMAIN_STATS_CPU_TOTAL:
+            record["cpu.time"] = 10**10
+            record["cpu.user"] = 4 * 10**9
+            record["cpu.system"] = 6 * 10**9
+        if stats & libvirt.VIR_DOMAIN_STATS_BALLOON:
+            record["balloon.current"] = 2097152
+            record["balloon.maximum"] = 4194304
+            for key, value in self.memory_stats().items():
+                record["balloon." + key] = value
+        if stats & libvirt.VIR_DOMAIN_STATS_VCPU:
+            record["vcpu.current"] = 2
+            record["vcpu.maximum"] = 2
+            for i in range(2):
+                record["vcpu.%d.state" % i] = 1
+                record["vcpu.%d.time" % i] = 5 * 10**9
+                record["vcpu.%d.wait" % i] = 0
+                record["vcpu.%d.delay" % i] = 10**8
+        if stats & libvirt.VIR_DOMAIN_STATS_INTERFACE:
+            record["net.count"] = len(self.nics)
+            for i, dev in enumerate(self.nics):
+                record["net.%d.name" % i] = dev
+                for key in ("rx.bytes", "rx.pkts", "rx.errs", "rx.drop"):
+                    record["net.%d.%s" % (i, key)] = 10
+                for key in ("tx.bytes", "tx.pkts", "tx.errs", "tx.drop"):
+                    record["net.%d.%s" % (i, key)] = 20
+        if stats & libvirt.VIR_DOMAIN_STATS_BLOCK:
+            record["block.count"] = len(self.disks)
+            for i, dev in enumerate(self.disks):
+                record["block.%d.name" % i] = dev
+                for key in ("rd.bytes", "rd.reqs", "rd.times", "wr.bytes", "wr.reqs"):
+                    record["block.%d.%s" % (i, key)] = 100
+                for key in ("wr.times", "fl.reqs", "fl.times"):
+                    record["block.%d.%s" % (i, key)] = 10
+        return record
+
+
+class FakeStoragePool:
+    def __init__(self, conn: FakeConnection, index: int, volumes: int = 0):
+        self.conn = conn
+        self.index = index
+        self.volumes = [FakeStorageVolume(self, i) for i in range(volumes)]
+
+    def name(self):
+        return "pool-%d" % self.index
+
+    def UUIDString(self):
+        return "00000000-0000-4000-9000-%012d" % self.index
+
+    def info(self):
+        self.conn.rpc("poolInfo")
+        return [libvirt.VIR_STORAGE_POOL_RUNNING, 10**12, 4 * 10**11, 6 * 10**11]
+
+    def listAllVolumes(self, flags=0):
+        self.conn.rpc("listAllVolumes")
+        return list(self.volumes)
+
+
+class FakeStorageVolume:
+    def __init__(self, pool: FakeStoragePool, index: int):
+        self.pool = pool
+        self.index = index
+
+    def name(self):
+        return "volume-%d.qcow2" % self.index
+
+    def info(self):
+        self.pool.conn.rpc("volumeInfo")
+        return [0, 20 * 2**30, (self.index % 20 + 1) * 2**30]
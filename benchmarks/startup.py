@@ -0,0 +1,97 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+# Taken before anything of the exporter is imported
+STARTED = time.perf_counter()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="benchmarks.startup",
+        description="Start the exporter in this process and report how long "
+        "it took until /metrics served collected series, as JSON on stdout",
+    )
+    parser.add_argument("--backend", choices=("fake", "test"), default="fake")
+    parser.add_argument("--domains", type=int, default=100)
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=30,
+        metavar="SECONDS",
+        help="Give up waiting for collected series after this long "
+        "(default: %(default)s)",
+    )
+    return parser.parse_args()
+
+
+async def fetch_metrics(port: int) -> bytes:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(
+        b"GET /metrics HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n"
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response
+
+
+async def first_metrics(args) -> dict:
+    from prometheus_libvirt import __main__ as exporter
+
+    imported = time.perf_counter()
+    uri = "test:///default"
+    if args.backend == "fake":
+        import libvirt
+
+        from benchmarks.fake_connection import FakeConnection
+
+        # Every connection the exporter opens is a fake one
+        libvirt.open = lambda uri: FakeConnection(domains=args.domains)
+        uri = "fake:///system"
+    app = exporter.Exporter(
+        exporter.parse_args(
+            [
+                "--uri",
+                uri,
+                "--listen-address",
+                "127.0.0.1",
+                "--port",
+                "0",
+                "--log-level",
+                "WARNING",
+            ]
+        )
+    )
+    await app.start()
+    listening = time.perf_counter()
+    port = app.http_server.server.sockets[0].getsockname()[1]
+    deadline = listening + args.timeout
+    scrapes = 0
+    while True:
+        response = await fetch_metrics(port)
+        scrapes += 1
+        if b"libvirt_domain_state{" in response:
+            break
+        if time.perf_counter() > deadline:
+            raise TimeoutError("no domain series after %ss" % args.timeout)
+        await asyncio.sleep(0.01)
+    return {
+        "import_seconds": imported - STARTED,
+        "listening_seconds": listening - STARTED,
+        "first_metrics_seconds": time.perf_counter() - STARTED,
+        "scrapes": scrapes,
+    }
+
+
+def main():
+    args = parse_args()
+    result = asyncio.run(first_metrics(args))
+    json.dump(result, sys.stdout)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
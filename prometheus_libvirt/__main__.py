@@ -1,72 +1,930 @@
+import argparse
 import asyncio
+import functools
 import logging
-import threading
-from wsgiref.simple_server import make_server
 
 
 import libvirt
 from prometheus_client import (
+    CollectorRegistry,
     REGISTRY,
     GC_COLLECTOR,
     PROCESS_COLLECTOR,
     PLATFORM_COLLECTOR,
-    make_wsgi_app,
 )
 
-from prometheus_libvirt.domain_worker import DomainWorker
+from prometheus_libvirt.collector import LibvirtCollector
+from prometheus_libvirt.connection_pool import ConnectionPool
+from prometheus_libvirt.domain_allocations import DomainAllocations
+from prometheus_libvirt.domain_description import DomainDescriptionCache
+from prometheus_libvirt.domain_inventory import DomainInventory, register_event_impl
+from prometheus_libvirt.domain_worker import (
+    COLLECTION_GROUPS,
+    STATS_GROUPS,
+    DomainWorker,
+)
+from prometheus_libvirt.exposition import ExpositionCache, render_live
+from prometheus_libvirt.host_worker import HostWorker
+from prometheus_libvirt.http_server import HttpServer, Request
+from prometheus_libvirt.libvirt_executor import LibvirtExecutor
+from prometheus_libvirt.local_stats import LocalStats, local_uri, raise_open_files_limit
+from prometheus_libvirt.memory_stats import MemoryStatsCache
+from prometheus_libvirt.metric_config import MetricConfig
+from prometheus_libvirt.push import (
+    PushgatewayWriter,
+    RemoteWriter,
+    Spool,
+    default_labels,
+)
+from prometheus_libvirt.rate_store import RateStore
+from prometheus_libvirt.scheduler import Scheduler
+from prometheus_libvirt.series_tracker import SeriesTracker
+from prometheus_libvirt.shard import (
+    Shard,
+    ShardMetrics,
+    ShardSupervisor,
+    ShardWriter,
+    shard_metrics,
+)
 from prometheus_libvirt.storage_pool_worker import StoragePoolWorker
+from prometheus_libvirt.storage_volume_worker import StorageVolumeWorker
+from prometheus_libvirt.target import MultiTargetCollector, Target, target_host
+from prometheus_libvirt.volume_inventory import VolumeInventory
 from . import prometheus_desc
 
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="[%(asctime)s] p%(process)s {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s",
+LOG_FORMAT = (
+    "[%(asctime)s] p%(process)s {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s"
 )
 
-REGISTRY.unregister(GC_COLLECTOR)
-REGISTRY.unregister(PLATFORM_COLLECTOR)
-REGISTRY.unregister(PROCESS_COLLECTOR)
 
-conn = libvirt.open("qemu:///system")
-hypervisor_version_num = conn.getVersion()
-hypervisor_version = "%s.%s.%s" % (
-    int(hypervisor_version_num / 1000000 % 1000),
-    int(hypervisor_version_num / 1000 % 1000),
-    int(hypervisor_version_num % 1000),
-)
-libvirtd_version_num = conn.getLibVersion()
-libvirtd_version = "%s.%s.%s" % (
-    int(libvirtd_version_num / 1000000 % 1000),
-    int(libvirtd_version_num / 1000 % 1000),
-    int(libvirtd_version_num % 1000),
-)
-lib_version_num = libvirt.getVersion()
-lib_version = "%s.%s.%s" % (
-    int(lib_version_num / 1000000 % 1000),
-    int(lib_version_num / 1000 % 1000),
-    int(lib_version_num % 1000),
-)
+def version_string(version_num: int) -> str:
+    return "%s.%s.%s" % (
+        int(version_num / 1000000 % 1000),
+        int(version_num / 1000 % 1000),
+        int(version_num % 1000),
+    )
 
-prometheus_desc.libvirt_versions_info.labels(
-    hypervisor=hypervisor_version,
-    libvirtd=libvirtd_version,
-    libvirt_lib=lib_version,
-)
+
+def set_versions_info(
+    conn: libvirt.virConnect, versions_info=prometheus_desc.libvirt_versions_info
+):
+    # Also called after reconnects, libvirtd may have been upgraded meanwhile
+    versions_info.clear()
+    versions_info.labels(
+        hypervisor=version_string(conn.getVersion()),
+        libvirtd=version_string(conn.getLibVersion()),
+        libvirt_lib=version_string(libvirt.getVersion()),
+    )
+
+
+# Seconds between collections of each group unless overridden by --interval
+DEFAULT_INTERVALS = {
+    "state": 5,
+    "vcpu": 5,
+    "cpu": 5,
+    "balloon": 5,
+    "interface": 5,
+    "block": 5,
+    "nova": 300,
+    "storage_pool": 5,
+    "storage_volume": 60,
+    "host": 15,
+}
+
+
+def interval_arg(value: str) -> tuple:
+    group, _, seconds = value.partition("=")
+    if group not in DEFAULT_INTERVALS:
+        raise argparse.ArgumentTypeError(
+            "unknown collection group %r, choose from %s"
+            % (group, ", ".join(DEFAULT_INTERVALS))
+        )
+    try:
+        seconds = float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid interval in %r" % value)
+    if seconds <= 0:
+        raise argparse.ArgumentTypeError("interval in %r must be positive" % value)
+    return group, seconds
+
+
+def label_arg(value: str) -> tuple:
+    name, _, label_value = value.partition("=")
+    if not name or not label_value:
+        raise argparse.ArgumentTypeError("expected NAME=VALUE, got %r" % value)
+    return name, label_value
+
+
+def stats_groups_arg(value: str) -> tuple:
+    if value == "all":
+        return tuple(STATS_GROUPS)
+    groups = tuple(group for group in value.split(",") if group)
+    for group in groups:
+        if group not in STATS_GROUPS:
+            raise argparse.ArgumentTypeError(
+                "unknown stats group %r, choose from %s"
+                % (group, ", ".join(STATS_GROUPS))
+            )
+    return groups
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser(prog="prometheus_libvirt")
+    parser.add_argument(
+        "--log-level",
+        choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+        default="INFO",
+        help="Log messages of this level and above (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--listen-address",
+        default="0.0.0.0",
+        metavar="ADDRESS",
+        help="Address to serve /metrics and /healthz on (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8000,
+        help="Port to serve /metrics and /healthz on (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--keepalive-timeout",
+        type=float,
+        default=75,
+        metavar="SECONDS",
+        help="Close idle HTTP connections after this long (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--health-staleness",
+        type=float,
+        default=3,
+        metavar="INTERVALS",
+        help="/healthz fails once a collection group had no successful run for "
+        "this many of its intervals (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--uri",
+        action="append",
+        default=[],
+        metavar="URI",
+        help="libvirt URI to collect from, may be repeated to cover several "
+        "hypervisors; their series get a host label and are also served on "
+        "/metrics?target=HOST (default: qemu:///system)",
+    )
+    parser.add_argument(
+        "--bulk-stats",
+        type=stats_groups_arg,
+        default=(),
+        metavar="GROUPS",
+        help="Comma separated stats groups (%s) or 'all' to fetch for every "
+        "domain with a single getAllDomainStats call; other groups use "
+        "per-domain calls. Per-vCPU stats are only collected with vcpu among "
+        "them" % ", ".join(STATS_GROUPS),
+    )
+    parser.add_argument(
+        "--domain-events",
+        action="store_true",
+        help="Track domains through libvirt lifecycle and device events "
+        "instead of listing all domains on every collection cycle",
+    )
+    parser.add_argument(
+        "--domain-resync-interval",
+        type=float,
+        default=300,
+        metavar="SECONDS",
+        help="With --domain-events, how often to re-list domains to recover "
+        "from missed events, 0 disables (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--xml-cache-max-age",
+        type=float,
+        default=300,
+        metavar="SECONDS",
+        help="Re-read a domain's XML description after this long even without "
+        "a domain event or restart, 0 disables (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--memory-stats",
+        choices=("all", "available"),
+        default="all",
+        help="all: export every balloon memory stat, 0 when a domain doesn't "
+        "report it; available: only the stats each domain reports "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--memory-stats-period",
+        type=int,
+        default=0,
+        metavar="SECONDS",
+        help="Set the balloon stats period of every running domain, so the guest "
+        "reports its memory usage; 0 leaves it alone (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--local-stats",
+        action="store_true",
+        help="Read CPU, memory and interface counters of the domains from their "
+        "cgroup v2 and sysfs files rather than libvirt where possible. Only for "
+        "the qemu:///system connection of the host the exporter runs on",
+    )
+    parser.add_argument(
+        "--volume-refresh-interval",
+        type=float,
+        default=600,
+        metavar="SECONDS",
+        help="List the volumes of a storage pool again after this long even "
+        "without a pool refresh event, 0 disables (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--volume-batch-size",
+        type=int,
+        default=256,
+        metavar="N",
+        help="Volumes whose info() is read in one executor call, batches run "
+        "in parallel on the --rpc-threads (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--on-scrape",
+        action="store_true",
+        help="Query libvirt only when /metrics is requested instead of "
+        "collecting continuously",
+    )
+    parser.add_argument(
+        "--scrape-window",
+        type=float,
+        default=1,
+        metavar="SECONDS",
+        help="With --on-scrape, scrapes arriving within this long after a "
+        "collection started share its result (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--render-interval",
+        type=float,
+        default=1,
+        metavar="SECONDS",
+        help="Render the /metrics response at most this often, after "
+        "collection runs finish; ignored with --on-scrape (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--interval",
+        type=interval_arg,
+        action="append",
+        default=[],
+        metavar="GROUP=SECONDS",
+        help="Collection interval of a group (%s), may be repeated"
+        % ", ".join(
+            "%s=%s" % (group, seconds) for group, seconds in DEFAULT_INTERVALS.items()
+        ),
+    )
+    parser.add_argument(
+        "--interval-jitter",
+        type=float,
+        default=0.1,
+        metavar="FRACTION",
+        help="Randomly move every collection by up to this fraction of its "
+        "interval (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Processes to split the domains over, each with its own libvirt "
+        "connections, for hosts where one core can't keep up with the "
+        "collection; a process that exits is restarted (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--connections",
+        type=int,
+        default=1,
+        metavar="N",
+        help="libvirt connections to spread per-domain calls over, closed "
+        "connections are re-opened in the background (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--keepalive-interval",
+        type=int,
+        default=5,
+        metavar="SECONDS",
+        help="Send a keepalive on idle connections after this long "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--keepalive-count",
+        type=int,
+        default=3,
+        metavar="N",
+        help="Consider a connection dead after this many unanswered "
+        "keepalives (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--rpc-threads",
+        type=int,
+        default=8,
+        metavar="N",
+        help="Threads running libvirt calls, also the limit of concurrent "
+        "calls (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--rpc-timeout",
+        type=float,
+        default=10,
+        metavar="SECONDS",
+        help="Give up waiting for a libvirt call after this long "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--rpc-circuit-threshold",
+        type=int,
+        default=3,
+        metavar="N",
+        help="Skip calls for a domain after this many consecutive timeouts "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--rpc-circuit-reset",
+        type=float,
+        default=60,
+        metavar="SECONDS",
+        help="Retry a skipped domain after this long (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--metric-config",
+        metavar="FILE",
+        help="JSON file with families to disable, labels to drop or rename "
+        "and series limits, see prometheus_libvirt/metric_config.py",
+    )
+    parser.add_argument(
+        "--disable-metric",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="Leave out the metric families matching this glob pattern, and "
+        "the libvirt calls only they need; may be repeated",
+    )
+    parser.add_argument(
+        "--max-series",
+        type=int,
+        metavar="N",
+        help="Drop new series of a family once it has this many, counted in "
+        "libvirt_exporter_series_overflow_total (default: no limit)",
+    )
+    parser.add_argument(
+        "--derived-metrics",
+        action="store_true",
+        help="Also export rates computed from the last two samples: CPU usage "
+        "in percent of the vCPUs, network bytes and block operations per second",
+    )
+    parser.add_argument(
+        "--remote-write-url",
+        metavar="URL",
+        help="Push every collection run to this Prometheus remote write "
+        "endpoint, for hosts Prometheus can't scrape",
+    )
+    parser.add_argument(
+        "--pushgateway-url",
+        metavar="URL",
+        help="Push every collection run to this Pushgateway instead, for "
+        "setups without a remote write receiver",
+    )
+    parser.add_argument(
+        "--push-label",
+        type=label_arg,
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Label added to every pushed series, may be repeated (default: "
+        "job=libvirt and instance=<hostname>)",
+    )
+    parser.add_argument(
+        "--push-interval",
+        type=float,
+        default=5,
+        metavar="SECONDS",
+        help="Push at most this often, runs finishing in between are pushed "
+        "together (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--push-max-samples",
+        type=int,
+        default=2000,
+        metavar="N",
+        help="Samples per remote write request (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--push-spool",
+        default="/var/spool/prometheus_libvirt",
+        metavar="DIR",
+        help="Where remote write batches wait until the receiver accepted "
+        "them, across restarts and outages (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--push-spool-max-bytes",
+        type=int,
+        default=256 * 1024 * 1024,
+        metavar="BYTES",
+        help="Drop the oldest spooled batches beyond this (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--stale-series-grace",
+        type=float,
+        metavar="SECONDS",
+        help="Remove series of domains, devices and pools not seen for this "
+        "long (default: three times the longest collection interval)",
+    )
+    parser.add_argument(
+        "--stale-series-interval",
+        type=float,
+        default=60,
+        metavar="SECONDS",
+        help="How often to look for stale series (default: %(default)s)",
+    )
+    args = parser.parse_args(argv)
+    if not args.uri:
+        args.uri = ["qemu:///system"]
+    if len(args.uri) > 1:
+        hosts = [target_host(uri) for uri in args.uri]
+        for host in hosts:
+            if hosts.count(host) > 1:
+                parser.error("more than one --uri for host %s" % host)
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
+    if args.shards > 1 and (args.on_scrape or len(args.uri) > 1):
+        parser.error("--shards works with a single --uri and without --on-scrape")
+    if args.remote_write_url and args.pushgateway_url:
+        parser.error("choose one of --remote-write-url and --pushgateway-url")
+    if args.on_scrape and (args.remote_write_url or args.pushgateway_url):
+        parser.error("pushing needs continuous collection, not --on-scrape")
+    return args
+
+
+def load_metric_config(args) -> MetricConfig:
+    if args.metric_config:
+        metric_config = MetricConfig.load(args.metric_config)
+    else:
+        metric_config = MetricConfig()
+    metric_config.disable.extend(args.disable_metric)
+    if args.max_series is not None:
+        metric_config.max_series = args.max_series
+    return metric_config
+
+
+def select_metric_set(args):
+    # prometheus_desc.metric_set or the one of the configured MetricConfig
+    if args.metric_config or args.disable_metric or args.max_series is not None:
+        return load_metric_config(args).metric_set
+    return prometheus_desc.metric_set
+
+
+def build_executor(args) -> LibvirtExecutor:
+    return LibvirtExecutor(
+        max_workers=args.rpc_threads,
+        timeout=args.rpc_timeout,
+        failure_threshold=args.rpc_circuit_threshold,
+        reset_after=args.rpc_circuit_reset,
+    )
+
+
+def collection_intervals(args) -> dict:
+    intervals = dict(DEFAULT_INTERVALS)
+    intervals.update(args.interval)
+    return intervals
+
+
+def build_scheduler(
+    args,
+    domain_worker: DomainWorker,
+    storage_pool_worker: StoragePoolWorker,
+    storage_volume_worker: StorageVolumeWorker,
+    series_tracker: SeriesTracker,
+    host: str = "",
+    host_worker: HostWorker = None,
+) -> Scheduler:
+    intervals = collection_intervals(args)
+    scheduler = Scheduler(jitter=args.interval_jitter, host=host)
+    scheduler.add(
+        ("stale_series",), args.stale_series_interval, series_tracker.collect_garbage
+    )
+    # Domain groups sharing an interval are collected in one sweep
+    by_interval = {}
+    for group in COLLECTION_GROUPS:
+        by_interval.setdefault(intervals[group], []).append(group)
+    for interval, groups in by_interval.items():
+        groups = tuple(groups)
+        scheduler.add(groups, interval, functools.partial(domain_worker.sweep, groups))
+    if host_worker is not None:
+        # Every shard exports the allocations of its own domains
+        scheduler.add(("host",), intervals["host"], host_worker.sweep)
+    if domain_worker.shard is not None and not domain_worker.shard.primary:
+        return scheduler
+    scheduler.add(
+        ("storage_pool",), intervals["storage_pool"], storage_pool_worker.sweep
+    )
+    scheduler.add(
+        ("storage_volume",),
+        intervals["storage_volume"],
+        storage_volume_worker.sweep,
+    )
+    return scheduler
+
+
+async def metrics_response(
+    request: Request, registry, exposition: ExpositionCache = None
+) -> tuple:
+    names = request.query.get("name[]")
+    if exposition is None or names:
+        return await render_live(
+            registry,
+            request.header("accept"),
+            request.header("accept-encoding"),
+            names or (),
+        )
+    return exposition.response(
+        request.header("accept"),
+        request.header("accept-encoding"),
+        request.header("if-none-match"),
+        request.header("if-modified-since"),
+    )
+
+
+def health_response(
+    schedulers: list,
+    pools: list,
+    factor: float,
+    supervisor: ShardSupervisor = None,
+) -> tuple:
+    problems = []
+    if supervisor is not None:
+        problems.extend(supervisor.problems())
+    for pool in pools:
+        if not pool.connected():
+            problems.append("no connection to %s" % pool.uri)
+    for scheduler in schedulers:
+        for job in scheduler.stale_jobs(factor):
+            problems.append(
+                "%s not collected for %g intervals%s"
+                % (
+                    ", ".join(job.groups),
+                    factor,
+                    " on " + scheduler.host if scheduler.host else "",
+                )
+            )
+    headers = [("Content-Type", "text/plain; charset=utf-8")]
+    if problems:
+        return 503, headers, ("\n".join(problems) + "\n").encode()
+    return 200, headers, b"ok\n"
+
+
+def make_handler(
+    endpoint: tuple,
+    target_endpoints: dict,
+    schedulers: list,
+    pools: list,
+    health_factor: float,
+    supervisor: ShardSupervisor = None,
+):
+    # endpoint and target_endpoints values are (registry, ExpositionCache or None)
+    async def handler(request: Request) -> tuple:
+        if request.method not in ("GET", "HEAD"):
+            return 405, [("Allow", "GET, HEAD")], b"Method Not Allowed\n"
+        if request.path == "/healthz":
+            return health_response(schedulers, pools, health_factor, supervisor)
+        if request.path not in ("/", "/metrics"):
+            return 404, [], b"Not Found\n"
+        target_endpoint = endpoint
+        if "target" in request.query:
+            # Multi-target exporter style, /metrics?target=HOST serves one target
+            target_endpoint = target_endpoints.get(request.query["target"][0])
+            if target_endpoint is None:
+                return 404, [], b"Unknown target\n"
+        return await metrics_response(request, *target_endpoint)
+
+    return handler
+
+
+async def start_target(
+    args,
+    uri: str,
+    executor: LibvirtExecutor,
+    registry=REGISTRY,
+    metrics=prometheus_desc,
+    versions_info=prometheus_desc.libvirt_versions_info,
+    host: str = "",
+    metric_set=prometheus_desc.metric_set,
+    shard: Shard = None,
+):
+    conn = ConnectionPool(
+        uri,
+        size=args.connections,
+        keepalive_interval=args.keepalive_interval,
+        keepalive_count=args.keepalive_count,
+        host=host,
+    )
+    # Slots that can't connect yet are retried in the background, collection
+    # runs fail until they are up
+    await conn.start()
+    primary = shard is None or shard.primary
+    if primary:
+        if conn.connected():
+            set_versions_info(conn, versions_info)
+        conn.listeners.append(
+            lambda index: set_versions_info(conn, versions_info)
+        )
+    domain_inventory = None
+    if args.domain_events:
+        domain_inventory = DomainInventory(
+            conn=conn,
+            resync_interval=args.domain_resync_interval,
+            executor=executor,
+        )
+        conn.listeners.append(domain_inventory.reconnected)
+        asyncio.get_running_loop().create_task(domain_inventory.run())
+    allocations = DomainAllocations()
+    local_stats = None
+    if args.local_stats:
+        if not local_uri(uri):
+            logging.warning("No local stats for %s, only for qemu:///system", uri)
+        elif not LocalStats().available():
+            logging.warning("No cgroup v2 hierarchy, local stats are disabled")
+        else:
+            local_stats = LocalStats()
+            raise_open_files_limit()
+    domain_worker = DomainWorker(
+        conn=conn,
+        stats_groups=args.bulk_stats,
+        inventory=domain_inventory,
+        descriptions=DomainDescriptionCache(
+            max_age=args.xml_cache_max_age, host=host
+        ),
+        executor=executor,
+        rates=RateStore() if args.derived_metrics else None,
+        memory_stats=MemoryStatsCache(
+            period=args.memory_stats_period,
+            export_absent=args.memory_stats == "all",
+        ),
+        shard=shard,
+        allocations=allocations,
+        local_stats=local_stats,
+        host=host,
+    )
+    host_worker = HostWorker(
+        conn=conn,
+        allocations=allocations,
+        executor=executor,
+        node_stats=primary,
+        host=host,
+    )
+    conn.listeners.append(host_worker.reconnected)
+    storage_pool_worker = StoragePoolWorker(conn=conn, executor=executor, host=host)
+    volume_inventory = VolumeInventory(
+        conn=conn,
+        executor=executor,
+        refresh_interval=args.volume_refresh_interval,
+        host=host,
+    )
+    if primary:
+        volume_inventory.start()
+        conn.listeners.append(volume_inventory.reconnected)
+    storage_volume_worker = StorageVolumeWorker(
+        conn=conn,
+        inventory=volume_inventory,
+        executor=executor,
+        batch_size=args.volume_batch_size,
+        host=host,
+    )
+    workers = [domain_worker, storage_pool_worker, storage_volume_worker, host_worker]
+    scheduler = None
+    if args.on_scrape:
+        registry.register(
+            LibvirtCollector(
+                loop=asyncio.get_running_loop(),
+                workers=workers,
+                window=args.scrape_window,
+                metric_set=metric_set,
+            )
+        )
+    else:
+        grace = args.stale_series_grace
+        if grace is None:
+            grace = 3 * max(collection_intervals(args).values())
+        series_tracker = SeriesTracker(metrics=metrics, grace=grace, host=host)
+        # Cached children are looked up again, stamping the tracker, well
+        # before their series could go stale
+        domain_worker.snapshots.max_age = grace / 3
+        for worker in workers:
+            worker.metrics = series_tracker
+        scheduler = build_scheduler(
+            args,
+            domain_worker,
+            storage_pool_worker,
+            storage_volume_worker,
+            series_tracker,
+            host,
+            host_worker,
+        )
+        asyncio.get_running_loop().create_task(scheduler.run())
+    return conn, scheduler
+
+
+def run_shard(shard: Shard, connection, args):
+    # Entry point of the --shards processes, which send their series to the
+    # supervisor instead of serving them
+    logging.basicConfig(level=args.log_level, format=LOG_FORMAT)
+    asyncio.run(Exporter(args).run_shard(shard, connection))
+
+
+class Exporter:
+    def __init__(self, args):
+        self.args = args
+        # Shared by all targets, so --rpc-threads limits the exporter as a whole
+        self.executor = None
+        self.exposition = None
+        self.pools = []
+        self.schedulers = []
+        # Host -> (registry, ExpositionCache or None) for /metrics?target=
+        self.target_endpoints = {}
+        self.supervisor = None
+        self.http_server = None
+
+    async def start(self):
+        # Nothing is imported, opened or registered before this, so the
+        # module can be imported without a libvirtd
+        args = self.args
+        loop = asyncio.get_running_loop()
+        # Has to come before any connection is opened
+        register_event_impl(loop)
+        self.executor = build_executor(args)
+        if not args.on_scrape:
+            # Rendered once per finished collection run instead of per scrape
+            self.exposition = ExpositionCache(
+                REGISTRY, min_interval=args.render_interval
+            )
+            loop.create_task(self.exposition.run())
+        metric_set = select_metric_set(args)
+        if args.shards > 1:
+            self.start_shards()
+        elif len(args.uri) == 1:
+            await self.start_single_target(metric_set)
+        else:
+            await self.start_targets(metric_set)
+        self.start_push()
+        # Served last, the first /metrics then already has the version info
+        # and whatever the first collection runs finished
+        self.http_server = HttpServer(
+            make_handler(
+                (REGISTRY, self.exposition),
+                self.target_endpoints,
+                self.schedulers,
+                self.pools,
+                args.health_staleness,
+                self.supervisor,
+            ),
+            host=args.listen_address,
+            port=args.port,
+            keepalive_timeout=args.keepalive_timeout,
+        )
+        await self.http_server.start()
+
+    async def start_single_target(self, metric_set):
+        args = self.args
+        metrics = prometheus_desc
+        if args.on_scrape or metric_set is not prometheus_desc.metric_set:
+            for metric in prometheus_desc.collected_metrics(prometheus_desc).values():
+                REGISTRY.unregister(metric)
+            if not args.on_scrape:
+                metrics = metric_set(REGISTRY)
+        conn, scheduler = await start_target(
+            args,
+            args.uri[0],
+            self.executor,
+            metrics=metrics,
+            metric_set=metric_set,
+        )
+        self.pools.append(conn)
+        if scheduler is not None:
+            scheduler.listeners.append(self.exposition.invalidate)
+            self.schedulers.append(scheduler)
+
+    async def start_targets(self, metric_set):
+        args = self.args
+        targets = []
+        # Every target has its own registry, merged here with a host label
+        for metric in prometheus_desc.collected_metrics(prometheus_desc).values():
+            REGISTRY.unregister(metric)
+        REGISTRY.unregister(prometheus_desc.libvirt_versions_info)
+        for uri in args.uri:
+            target = Target(uri)
+            metrics = None
+            if not args.on_scrape:
+                metrics = metric_set(target.registry)
+            conn, scheduler = await start_target(
+                args,
+                uri,
+                self.executor,
+                registry=target.registry,
+                metrics=metrics,
+                versions_info=target.versions_info,
+                host=target.host,
+                metric_set=metric_set,
+            )
+            self.pools.append(conn)
+            target_exposition = None
+            if scheduler is not None:
+                target_exposition = ExpositionCache(
+                    target.registry, min_interval=args.render_interval
+                )
+                asyncio.get_running_loop().create_task(target_exposition.run())
+                scheduler.listeners.append(target_exposition.invalidate)
+                scheduler.listeners.append(self.exposition.invalidate)
+                self.schedulers.append(scheduler)
+            self.target_endpoints[target.host] = (target.registry, target_exposition)
+            targets.append(target)
+        REGISTRY.register(MultiTargetCollector(targets))
+
+    def start_shards(self):
+        args = self.args
+        # Every series comes from the shard processes
+        for metric in prometheus_desc.collected_metrics(prometheus_desc).values():
+            REGISTRY.unregister(metric)
+        REGISTRY.unregister(prometheus_desc.libvirt_versions_info)
+        # The shards send their own RPC, sweep, scheduler and cache series
+        for metric in shard_metrics():
+            REGISTRY.unregister(metric)
+        self.supervisor = ShardSupervisor(
+            args.shards,
+            "prometheus_libvirt.__main__:run_shard",
+            (args,),
+            stale_after=args.health_staleness
+            * min(collection_intervals(args).values()),
+        )
+        self.supervisor.listeners.append(self.exposition.invalidate)
+        REGISTRY.register(self.supervisor)
+        asyncio.get_running_loop().create_task(self.supervisor.supervise())
+
+    def start_push(self):
+        args = self.args
+        labels = default_labels()
+        labels.update(args.push_label)
+        if args.remote_write_url:
+            writer = RemoteWriter(
+                REGISTRY,
+                args.remote_write_url,
+                Spool(args.push_spool, max_bytes=args.push_spool_max_bytes),
+                labels=labels,
+                max_samples=args.push_max_samples,
+                min_interval=args.push_interval,
+            )
+        elif args.pushgateway_url:
+            writer = PushgatewayWriter(
+                REGISTRY,
+                args.pushgateway_url,
+                labels=labels,
+                min_interval=args.push_interval,
+            )
+        else:
+            return
+        # Pushed like the exposition is rendered, after collection runs
+        for scheduler in self.schedulers:
+            scheduler.listeners.append(writer.invalidate)
+        if self.supervisor is not None:
+            self.supervisor.listeners.append(writer.invalidate)
+        asyncio.get_running_loop().create_task(writer.run())
+
+    async def run(self):
+        await self.start()
+        await asyncio.Event().wait()
+
+    async def run_shard(self, shard: Shard, connection):
+        args = self.args
+        register_event_impl(asyncio.get_running_loop())
+        registry = CollectorRegistry(auto_describe=True)
+        versions_info = prometheus_desc.clone(
+            prometheus_desc.libvirt_versions_info, registry
+        )
+        registry.register(ShardMetrics(shard))
+        conn, scheduler = await start_target(
+            args,
+            args.uri[0],
+            build_executor(args),
+            registry=registry,
+            metrics=select_metric_set(args)(registry),
+            versions_info=versions_info,
+            shard=shard,
+        )
+        writer = ShardWriter(registry, connection, min_interval=args.render_interval)
+        scheduler.listeners.append(writer.invalidate)
+        # Returns once the supervisor is gone
+        await writer.run()
 
 
-def run_server():
-    app = make_wsgi_app(registry=REGISTRY, disable_compression=True)
-    httpd = make_server("0.0.0.0", 8000, app)
-    t = threading.Thread(target=httpd.serve_forever)
-    t.daemon = True
-    t.start()
+def main(argv: list = None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level, format=LOG_FORMAT)
+    for collector in (GC_COLLECTOR, PLATFORM_COLLECTOR, PROCESS_COLLECTOR):
+        REGISTRY.unregister(collector)
+    asyncio.run(Exporter(args).run())
 
 
 if __name__ == "__main__":
-    run_server()
-    domain_worker = DomainWorker(conn=conn)
-    storage_pool_worker = StoragePoolWorker(conn=conn)
-    loop = asyncio.get_event_loop()
-    loop.create_task(domain_worker.run())
-    loop.create_task(storage_pool_worker.run())
-    loop.run_forever()
+    main()
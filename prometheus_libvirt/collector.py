@@ -0,0 +1,71 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+from prometheus_client.registry import Collector, CollectorRegistry
+
+from prometheus_libvirt import prometheus_desc
+
+
+class LibvirtCollector(Collector):
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        workers: list,
+        window: float = 0,
+        timeout: float = 60,
+        metric_set=prometheus_desc.metric_set,
+    ):
+        self.loop = loop
+        # DomainWorker / StoragePoolWorker, anything with metrics and sweep()
+        self.workers = workers
+        # Scrapes arriving up to window seconds after a sweep started reuse it
+        self.window = window
+        self.timeout = timeout
+        # Called with a registry to get the metrics of one sweep, e.g. the
+        # metric_set() of a MetricConfig
+        self.metric_set = metric_set
+        self.lock = threading.Lock()
+        self.families = None
+        # When the last sweep started and finished
+        self.swept_at = 0.0
+        self.finished_at = 0.0
+
+    def describe(self):
+        # Keeps registration from running a sweep before the loop is up
+        registry = CollectorRegistry(auto_describe=False)
+        self.metric_set(registry)
+        yield from registry.collect()
+
+    def collect(self):
+        requested_at = time.monotonic()
+        with self.lock:
+            # Whoever waited on the lock while a sweep ran shares its result,
+            # however long the sweep took
+            if (
+                self.families is None
+                or self.finished_at < requested_at
+                and self.swept_at < requested_at - self.window
+            ):
+                self.swept_at = time.monotonic()
+                self.families = self.sweep()
+                self.finished_at = time.monotonic()
+            families = self.families
+        yield from families
+
+    def sweep(self) -> list:
+        registry = CollectorRegistry(auto_describe=False)
+        metrics = self.metric_set(registry)
+        future = asyncio.run_coroutine_threadsafe(self.run_sweep(metrics), self.loop)
+        try:
+            future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+        return list(registry.collect())
+
+    async def run_sweep(self, metrics):
+        for worker in self.workers:
+            worker.metrics = metrics
+        await asyncio.gather(*(worker.sweep() for worker in self.workers))
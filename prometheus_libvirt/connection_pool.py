@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import zlib
+
+import libvirt
+
+from prometheus_libvirt import exporter_desc
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        uri: str,
+        size: int = 1,
+        keepalive_interval: int = 5,
+        keepalive_count: int = 3,
+        max_backoff: float = 60,
+        host: str = "",
+    ):
+        self.uri = uri
+        # Target the pool connects to, empty with a single target
+        self.host = host
+        self.size = size
+        # None while a slot is disconnected
+        self.connections = [None] * size
+        # Per slot, UUID -> virDomain bound to that slot's connection
+        self.handles = [{} for _ in range(size)]
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self.max_backoff = max_backoff
+        self.reconnecting = set()
+        # Called with the slot index after a connection was re-established
+        self.listeners = []
+
+    def __getattr__(self, name):
+        # Connection level calls (listAllDomains, event registration, ...) go
+        # to the primary connection, per-domain calls are spread with bind()
+        return getattr(self.primary(), name)
+
+    def primary(self) -> libvirt.virConnect:
+        for conn in self.connections:
+            if conn is not None:
+                return conn
+        raise libvirt.libvirtError("No connection to %s" % self.uri)
+
+    def open(self):
+        for index in range(self.size):
+            self.connect(index)
+
+    async def start(self):
+        # Like open(), but a libvirtd that isn't up yet doesn't stop the
+        # exporter, the slots are connected in the background until it is
+        for index in range(self.size):
+            try:
+                await asyncio.to_thread(self.connect, index)
+            except libvirt.libvirtError as e:
+                logging.warning(
+                    "Connecting to %s failed, retrying in the background: %s",
+                    self.uri,
+                    e,
+                )
+                self.schedule_reconnect(index)
+
+    def connect(self, index: int):
+        conn = libvirt.open(self.uri)
+        try:
+            conn.setKeepAlive(self.keepalive_interval, self.keepalive_count)
+        except libvirt.libvirtError as e:
+            # Local drivers don't do keepalive, the close callback still works
+            logging.debug("No keepalive on %s: %s", self.uri, e)
+        conn.registerCloseCallback(self.close_callback, index)
+        self.connections[index] = conn
+        self.handles[index].clear()
+        self.update_connected()
+
+    def close_callback(self, conn, reason, index):
+        if self.connections[index] is not conn:
+            return
+        logging.warning(
+            "Connection %d to %s closed, reason %s", index, self.uri, reason
+        )
+        self.connections[index] = None
+        self.handles[index].clear()
+        self.update_connected()
+        self.schedule_reconnect(index)
+
+    def schedule_reconnect(self, index: int):
+        if index not in self.reconnecting:
+            self.reconnecting.add(index)
+            asyncio.get_running_loop().create_task(self.reconnect(index))
+
+    async def reconnect(self, index: int):
+        backoff = 1.0
+        try:
+            while True:
+                await asyncio.sleep(backoff)
+                try:
+                    await asyncio.to_thread(self.connect, index)
+                except libvirt.libvirtError as e:
+                    logging.warning(
+                        "Reconnecting to %s failed, retrying in %ss: %s",
+                        self.uri,
+                        backoff,
+                        e,
+                    )
+                    backoff = min(backoff * 2, self.max_backoff)
+                    continue
+                break
+        finally:
+            self.reconnecting.discard(index)
+        exporter_desc.libvirt_exporter_connection_reconnects.inc()
+        logging.info("Connection %d to %s re-established", index, self.uri)
+        for listener in self.listeners:
+            listener(index)
+
+    def connected(self) -> int:
+        return sum(1 for conn in self.connections if conn is not None)
+
+    def update_connected(self):
+        exporter_desc.libvirt_exporter_connections.labels(host=self.host).set(
+            self.connected()
+        )
+
+    def slot(self, uuid: str) -> int:
+        return zlib.crc32(uuid.encode()) % self.size
+
+    def bound(self, domain: libvirt.virDomain):
+        # Handle of domain on the connection its UUID maps to, None if it
+        # still has to be looked up with bind()
+        uuid = domain.UUIDString()
+        index = self.slot(uuid)
+        conn = self.connections[index]
+        if conn is None or domain.connect() is conn:
+            return domain
+        handle = self.handles[index].get(uuid)
+        if handle is not None and handle.ID() != domain.ID():
+            # The domain restarted since it was bound, the handle's ID is a
+            # copy taken at lookup and would keep the ID keyed caches on the
+            # old run
+            del self.handles[index][uuid]
+            return None
+        return handle
+
+    def bind(self, domain: libvirt.virDomain) -> libvirt.virDomain:
+        uuid = domain.UUIDString()
+        index = self.slot(uuid)
+        conn = self.connections[index]
+        if conn is None:
+            return domain
+        handle = conn.lookupByUUIDString(uuid)
+        self.handles[index][uuid] = handle
+        return handle
+
+    def forget(self, uuid: str, domain: libvirt.virDomain = None):
+        for handles in self.handles:
+            handles.pop(uuid, None)
+
+    def retain(self, uuids):
+        uuids = set(uuids)
+        for handles in self.handles:
+            for uuid in handles.keys() - uuids:
+                del handles[uuid]
@@ -0,0 +1,32 @@
+import abc
+import asyncio
+
+
+class DebouncedWriter(abc.ABC):
+    __slots__ = ("min_interval", "dirty")
+
+    def __init__(self, min_interval: float = 1):
+        # Collection runs finishing closer together than this share one write
+        self.min_interval = min_interval
+        self.dirty = None
+
+    def invalidate(self):
+        # Scheduler and supervisor listener, called after a collection run
+        if self.dirty is not None:
+            self.dirty.set()
+
+    @abc.abstractmethod
+    async def write(self) -> bool:
+        # One rendering, batch or push of the current state, False once there
+        # is nowhere to write to anymore
+        ...
+
+    async def run(self):
+        self.dirty = asyncio.Event()
+        while True:
+            # Nothing is written before the first collection run finished
+            await self.dirty.wait()
+            self.dirty.clear()
+            if not await self.write():
+                return
+            await asyncio.sleep(self.min_interval)
@@ -0,0 +1,46 @@
+import libvirt
+
+# Domains in these states hold no host resources
+INACTIVE_STATES = frozenset((libvirt.VIR_DOMAIN_SHUTOFF, libvirt.VIR_DOMAIN_CRASHED))
+
+
+class DomainAllocations:
+    __slots__ = ("domains",)
+
+    def __init__(self):
+        # UUID -> [state, vcpus, max memory bytes, memory bytes] as last
+        # written by a DomainWorker
+        self.domains = {}
+
+    def record(self, uuid: str, key: str, values: tuple):
+        # key and values as written by DomainWorker.write for the state, vcpu
+        # and balloon groups
+        allocation = self.domains.get(uuid)
+        if allocation is None:
+            allocation = self.domains[uuid] = [None, 0.0, 0.0, 0.0]
+        if key == "state":
+            allocation[0] = values[0]
+        elif key == "vcpu":
+            allocation[1] = values[0]
+        else:
+            allocation[2:] = values[:2]
+
+    def forget(self, uuid: str, domain: libvirt.virDomain = None):
+        self.domains.pop(uuid, None)
+
+    def retain(self, uuids):
+        for uuid in self.domains.keys() - set(uuids):
+            del self.domains[uuid]
+
+    def totals(self) -> tuple:
+        # (domains, vcpus, max memory bytes, memory bytes) of the active
+        # domains. Without the state family every domain counts as active
+        totals = [0, 0.0, 0.0, 0.0]
+        for state, vcpus, max_memory, memory in self.domains.values():
+            if state in INACTIVE_STATES:
+                continue
+            totals[0] += 1
+            totals[1] += vcpus
+            totals[2] += max_memory
+            totals[3] += memory
+        return tuple(totals)
@@ -0,0 +1,117 @@
+import time
+from collections import namedtuple
+
+import libvirt
+
+from prometheus_libvirt import domain_metadata, exporter_desc
+
+
+Interface = namedtuple("Interface", ["target_dev", "mac"])
+
+Disk = namedtuple(
+    "Disk",
+    [
+        "disk_type",
+        "target_dev",
+        "target_bus",
+        "source_file",
+        "driver_name",
+        "driver_type",
+        "driver_discard",
+    ],
+)
+
+
+def attrib(element, name: str):
+    if element is None:
+        return None
+    return element.attrib.get(name)
+
+
+class DomainDescription:
+    __slots__ = ("generation", "parsed_at", "interfaces", "disks", "metadata")
+
+    def __init__(self, generation, domain_xml: str):
+        self.generation = generation
+        self.parsed_at = time.monotonic()
+        tree = domain_metadata.fromstring(domain_xml)
+        self.interfaces = tuple(
+            Interface(
+                target_dev=attrib(interface.find("target"), "dev"),
+                mac=attrib(interface.find("mac"), "address"),
+            )
+            for interface in tree.iter("interface")
+        )
+        self.disks = tuple(
+            Disk(
+                disk_type=disk.attrib.get("type"),
+                target_dev=attrib(disk.find("target"), "dev"),
+                target_bus=attrib(disk.find("target"), "bus"),
+                source_file=attrib(disk.find("source"), "file"),
+                driver_name=attrib(disk.find("driver"), "name"),
+                driver_type=attrib(disk.find("driver"), "type"),
+                driver_discard=attrib(disk.find("driver"), "discard"),
+            )
+            for disk in tree.iter("disk")
+        )
+        # Extractor name -> labels, see domain_metadata
+        self.metadata = domain_metadata.extract(tree.find("metadata"))
+
+
+class DomainDescriptionCache:
+    __slots__ = ("entries", "max_age", "host")
+
+    def __init__(self, max_age: float = 300, host: str = ""):
+        # UUID -> DomainDescription
+        self.entries = {}
+        # Without domain events hot-plugged devices are only picked up once
+        # an entry gets this old, 0 keeps entries until invalidated
+        self.max_age = max_age
+        # Target the cached domains run on, empty with a single target
+        self.host = host
+
+    @staticmethod
+    def generation(domain: libvirt.virDomain):
+        # The ID is cached in the virDomain object, so this costs no RPC.
+        # It changes on every start, which is when the live XML is rebuilt
+        return domain.ID()
+
+    def lookup(self, domain: libvirt.virDomain):
+        # Returns None if the domain XML has to be fetched and passed to store
+        description = self.entries.get(domain.UUIDString())
+        if (
+            description is not None
+            and description.generation == self.generation(domain)
+            and (
+                not self.max_age
+                or time.monotonic() - description.parsed_at < self.max_age
+            )
+        ):
+            exporter_desc.libvirt_exporter_xml_cache_hits.inc()
+            return description
+        exporter_desc.libvirt_exporter_xml_cache_misses.inc()
+        return None
+
+    def store(self, domain: libvirt.virDomain, domain_xml: str) -> DomainDescription:
+        with exporter_desc.libvirt_exporter_helper_duration.labels(
+            helper="xml_parse"
+        ).time():
+            description = DomainDescription(self.generation(domain), domain_xml)
+        self.entries[domain.UUIDString()] = description
+        self.update_entries()
+        return description
+
+    def invalidate(self, uuid: str, domain: libvirt.virDomain = None):
+        self.entries.pop(uuid, None)
+        self.update_entries()
+
+    def retain(self, uuids):
+        # Drops domains that disappeared when no inventory sends removals
+        for uuid in self.entries.keys() - set(uuids):
+            del self.entries[uuid]
+        self.update_entries()
+
+    def update_entries(self):
+        exporter_desc.libvirt_exporter_xml_cache_entries.labels(host=self.host).set(
+            len(self.entries)
+        )
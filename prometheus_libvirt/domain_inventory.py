@@ -0,0 +1,133 @@
+import asyncio
+import logging
+
+import libvirt
+import libvirtaio
+
+from prometheus_libvirt.libvirt_executor import LibvirtExecutor
+
+LIFECYCLE_REMOVED = (libvirt.VIR_DOMAIN_EVENT_UNDEFINED,)
+LIFECYCLE_MAYBE_REMOVED = (libvirt.VIR_DOMAIN_EVENT_STOPPED,)
+
+
+def register_event_impl(loop: asyncio.AbstractEventLoop):
+    # Has to run before the connection is opened, libvirt binds the event
+    # implementation to connections at open time
+    libvirtaio.virEventRegisterAsyncIOImpl(loop=loop)
+
+
+class DomainInventory:
+    __slots__ = (
+        "conn",
+        "executor",
+        "domains",
+        "listeners",
+        "callback_ids",
+        "resync_interval",
+    )
+
+    def __init__(
+        self,
+        conn: libvirt.virConnect,
+        resync_interval: float = 300,
+        executor: LibvirtExecutor = None,
+    ):
+        self.conn = conn
+        if executor is None:
+            executor = LibvirtExecutor()
+        self.executor = executor
+        # UUID -> virDomain, only changed by events and resyncs
+        self.domains = {}
+        # Called as listener(uuid, domain) whenever a domain was added, removed
+        # (domain is None) or its definition changed. The per-domain caches'
+        # invalidate and forget methods take exactly these arguments, with
+        # domain defaulting to None, so they can be registered directly
+        self.listeners = []
+        self.callback_ids = []
+        self.resync_interval = resync_interval
+
+    async def run(self):
+        try:
+            self.register_callbacks()
+        except libvirt.libvirtError as e:
+            # Registered by reconnected() once the connection is up
+            logging.warning("No domain events yet: %s", e)
+        while True:
+            try:
+                await self.resync()
+            except libvirt.libvirtError as e:
+                logging.warning("Listing domains failed: %s", e)
+            if not self.resync_interval:
+                return
+            await asyncio.sleep(self.resync_interval)
+
+    def register_callbacks(self):
+        self.deregister_callbacks()
+        for event_id, callback in (
+            (libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self.lifecycle_callback),
+            (libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED, self.device_callback),
+            (libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED, self.device_callback),
+            (libvirt.VIR_DOMAIN_EVENT_ID_METADATA_CHANGE, self.metadata_callback),
+        ):
+            self.callback_ids.append(
+                self.conn.domainEventRegisterAny(None, event_id, callback, None)
+            )
+
+    def deregister_callbacks(self):
+        for callback_id in self.callback_ids:
+            try:
+                self.conn.domainEventDeregisterAny(callback_id)
+            except libvirt.libvirtError:
+                pass
+        self.callback_ids.clear()
+
+    def reconnected(self, index: int):
+        # Callbacks and domain handles died with the old connection
+        self.register_callbacks()
+        asyncio.get_running_loop().create_task(self.resync())
+
+    async def resync(self):
+        # Safety net for events lost while the connection was down
+        domain_list = await self.executor.call(self.conn.listAllDomains, 0)
+        current = {domain.UUIDString(): domain for domain in domain_list}
+        for uuid in self.domains.keys() - current.keys():
+            self.remove(uuid)
+        for uuid, domain in current.items():
+            if uuid not in self.domains:
+                self.update(uuid, domain)
+            else:
+                self.domains[uuid] = domain
+
+    def update(self, uuid: str, domain: libvirt.virDomain):
+        self.domains[uuid] = domain
+        for listener in self.listeners:
+            listener(uuid, domain)
+
+    def remove(self, uuid: str):
+        if self.domains.pop(uuid, None) is None:
+            return
+        for listener in self.listeners:
+            listener(uuid, None)
+
+    def lifecycle_callback(self, conn, domain, event, detail, opaque):
+        uuid = domain.UUIDString()
+        if event in LIFECYCLE_REMOVED:
+            self.remove(uuid)
+            return
+        if event in LIFECYCLE_MAYBE_REMOVED:
+            # Transient domains are gone once they stop
+            try:
+                persistent = domain.isPersistent()
+            except libvirt.libvirtError:
+                persistent = False
+            if not persistent:
+                self.remove(uuid)
+                return
+        logging.debug("Domain %s lifecycle event %s/%s", uuid, event, detail)
+        self.update(uuid, domain)
+
+    def device_callback(self, conn, domain, dev_alias, opaque):
+        self.update(domain.UUIDString(), domain)
+
+    def metadata_callback(self, conn, domain, mtype, nsuri, opaque):
+        self.update(domain.UUIDString(), domain)
@@ -0,0 +1,98 @@
+import abc
+
+import libvirt
+
+
+def fromstring(xml: str):
+    # defusedxml is imported on the first parse rather than at startup
+    from defusedxml.ElementTree import fromstring as parse
+
+    return parse(xml)
+
+
+def text(element) -> str:
+    if element is None or element.text is None:
+        return ""
+    return element.text.strip()
+
+
+def attribute(element, name: str) -> str:
+    if element is None:
+        return ""
+    return element.attrib.get(name, "")
+
+
+class MetadataExtractor(abc.ABC):
+    # Reads one application's element of the domain <metadata> into the labels
+    # of an Info family. Subclasses set the class attributes and extract()
+    __slots__ = ()
+
+    # Key in DomainDescription.metadata
+    name = None
+    namespace = None
+    tag = None
+    # Attribute of prometheus_desc the labels are written to
+    metric = None
+
+    @property
+    def path(self) -> str:
+        return "{%s}%s" % (self.namespace, self.tag)
+
+    @abc.abstractmethod
+    def extract(self, element) -> dict:
+        # Label values of the element, missing fields are left empty
+        ...
+
+
+class NovaMetadata(MetadataExtractor):
+    __slots__ = ()
+
+    name = "nova"
+    namespace = "http://openstack.org/xmlns/libvirt/nova/1.1"
+    tag = "instance"
+    metric = "libvirt_domain_nova_metadata"
+
+    def extract(self, element) -> dict:
+        namespaces = {"nova": self.namespace}
+        user = element.find("nova:owner/nova:user", namespaces)
+        project = element.find("nova:owner/nova:project", namespaces)
+        return dict(
+            instance_name=text(element.find("nova:name", namespaces)),
+            flavor=attribute(element.find("nova:flavor", namespaces), "name"),
+            user_name=text(user),
+            user_uuid=attribute(user, "uuid"),
+            project_name=text(project),
+            project_uuid=attribute(project, "uuid"),
+        )
+
+
+NOVA = NovaMetadata()
+
+EXTRACTORS = (NOVA,)
+
+
+def extract(metadata, extractors: tuple = EXTRACTORS) -> dict:
+    # metadata is the <metadata> element of a parsed domain XML, or None.
+    # Returns extractor name -> labels for the elements present
+    found = {}
+    if metadata is None:
+        return found
+    for extractor in extractors:
+        element = metadata.find(extractor.path)
+        if element is not None:
+            found[extractor.name] = extractor.extract(element)
+    return found
+
+
+def fetch(domain: libvirt.virDomain, extractor: MetadataExtractor):
+    # Just the extractor's element, instead of the whole domain XML. None if
+    # the domain has no such metadata
+    try:
+        element_xml = domain.metadata(
+            libvirt.VIR_DOMAIN_METADATA_ELEMENT, extractor.namespace, 0
+        )
+    except libvirt.libvirtError as e:
+        if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN_METADATA:
+            return None
+        raise
+    return extractor.extract(fromstring(element_xml))
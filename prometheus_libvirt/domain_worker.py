@@ -2,232 +2,928 @@ import asyncio
 import logging
 import time
 
-import defusedxml.ElementTree as ET
 import libvirt
-import xmltodict
 
-from prometheus_libvirt import prometheus_desc
+from prometheus_libvirt import domain_metadata, exporter_desc, prometheus_desc
+from prometheus_libvirt.connection_pool import ConnectionPool
+from prometheus_libvirt.domain_allocations import DomainAllocations
+from prometheus_libvirt.domain_description import (
+    Disk,
+    DomainDescription,
+    DomainDescriptionCache,
+)
+from prometheus_libvirt.domain_inventory import DomainInventory
+from prometheus_libvirt.libvirt_executor import LibvirtExecutor
+from prometheus_libvirt.local_stats import LocalStats
+from prometheus_libvirt.memory_stats import MemoryStatsCache, MemoryStatsSupport
+from prometheus_libvirt.rate_store import RateStore
+from prometheus_libvirt.series_snapshot import DomainSnapshot, SnapshotCache
+from prometheus_libvirt.shard import Shard
+
+
+STATS_GROUPS = {
+    "state": libvirt.VIR_DOMAIN_STATS_STATE,
+    "cpu": libvirt.VIR_DOMAIN_STATS_CPU_TOTAL,
+    "balloon": libvirt.VIR_DOMAIN_STATS_BALLOON,
+    "vcpu": libvirt.VIR_DOMAIN_STATS_VCPU,
+    "interface": libvirt.VIR_DOMAIN_STATS_INTERFACE,
+    "block": libvirt.VIR_DOMAIN_STATS_BLOCK,
+}
+
+# Everything a domain sweep can collect, nova is read from the domain metadata
+COLLECTION_GROUPS = tuple(STATS_GROUPS) + ("nova",)
+
+# Errors telling that the driver can't deliver a stats group in bulk
+UNSUPPORTED_ERRORS = (
+    libvirt.VIR_ERR_NO_SUPPORT,
+    libvirt.VIR_ERR_ARGUMENT_UNSUPPORTED,
+)
+
+# balloon.<key> in getAllDomainStats uses the same names as memoryStats()
+MEMORY_STATS = (
+    ("actual", "libvirt_domain_mem_stat_actual_balloon_bytes", 1024),
+    ("swap_in", "libvirt_domain_mem_stat_swap_in_bytes", 1024),
+    ("swap_out", "libvirt_domain_mem_stat_swap_out_bytes", 1024),
+    ("major_fault", "libvirt_domain_mem_stat_major_fault", 1),
+    ("minor_fault", "libvirt_domain_mem_stat_minor_fault", 1),
+    ("unused", "libvirt_domain_mem_stat_unused_bytes", 1),
+    ("available", "libvirt_domain_mem_stat_available_bytes", 1024),
+    ("usable", "libvirt_domain_mem_stat_usable_bytes", 1024),
+    ("disk_caches", "libvirt_domain_mem_stat_disk_caches_bytes", 1024),
+    ("hugetlb_pgalloc", "libvirt_domain_mem_stat_hugetlb_pgalloc", 1),
+    ("hugetlb_pgfail", "libvirt_domain_mem_stat_hugetlb_pgfail", 1),
+    ("rss", "libvirt_domain_mem_stat_rss", 1024),
+)
 
+INTERFACE_STATS = (
+    ("rx.bytes", "libvirt_domain_io_rx_bytes"),
+    ("rx.pkts", "libvirt_domain_io_rx_packets"),
+    ("rx.errs", "libvirt_domain_io_rx_errors"),
+    ("rx.drop", "libvirt_domain_io_rx_drops"),
+    ("tx.bytes", "libvirt_domain_io_tx_bytes"),
+    ("tx.pkts", "libvirt_domain_io_tx_packets"),
+    ("tx.errs", "libvirt_domain_io_tx_errors"),
+    ("tx.drop", "libvirt_domain_io_tx_drops"),
+)
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="[%(asctime)s] p%(process)s {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s",
+# (blockStatsFlags key, getAllDomainStats block.<N>.<key>, metric name, divisor)
+BLOCK_STATS = (
+    (
+        "rd_bytes",
+        "rd.bytes",
+        "libvirt_domain_block_dev_read_bytes",
+        1,
+    ),
+    (
+        "rd_operations",
+        "rd.reqs",
+        "libvirt_domain_block_dev_read_operations",
+        1,
+    ),
+    (
+        "rd_total_times",
+        "rd.times",
+        "libvirt_domain_block_dev_read_total_seconds",
+        1000 * 1000 * 1000,
+    ),
+    (
+        "wr_bytes",
+        "wr.bytes",
+        "libvirt_domain_block_dev_write_bytes",
+        1,
+    ),
+    (
+        "wr_operations",
+        "wr.reqs",
+        "libvirt_domain_block_dev_write_operations",
+        1,
+    ),
+    (
+        "wr_total_times",
+        "wr.times",
+        "libvirt_domain_block_dev_write_total_seconds",
+        1000 * 1000 * 1000,
+    ),
+    (
+        "flush_operations",
+        "fl.reqs",
+        "libvirt_domain_block_dev_flush_operations",
+        1,
+    ),
+    (
+        "flush_total_times",
+        "fl.times",
+        "libvirt_domain_block_dev_flush_total_seconds",
+        1000 * 1000 * 1000,
+    ),
 )
+# getAllDomainStats vcpu.<N>.<key>, metric name, divisor. These only come in
+# bulk, vcpus() per domain would double the calls of a sweep
+VCPU_STATS = (
+    ("state", "libvirt_domain_vcpu_state", 1),
+    ("time", "libvirt_domain_vcpu_time", 1000 * 1000 * 1000),
+    ("wait", "libvirt_domain_vcpu_wait", 1000 * 1000 * 1000),
+    ("delay", "libvirt_domain_vcpu_delay", 1000 * 1000 * 1000),
+)
+
+VCPU_METRICS = tuple(name for _, name, _ in VCPU_STATS)
+
+CPU_METRICS = (
+    "libvirt_domain_cpu_time",
+    "libvirt_domain_cpu_user_time",
+    "libvirt_domain_cpu_system_time",
+)
+
+MEMORY_KEYS = frozenset(key for key, _, _ in MEMORY_STATS)
+
+# memoryStats() keys known without asking, from info() and LocalStats
+LOCAL_MEMORY_KEYS = frozenset(("actual", "rss"))
+
+MEMORY_METRICS = tuple(name for _, name, _ in MEMORY_STATS)
+
+BALLOON_METRICS = (
+    "libvirt_domain_max_memory_bytes",
+    "libvirt_domain_mem_stat_usage_bytes",
+) + MEMORY_METRICS
+
+INTERFACE_METRICS = tuple(name for _, name in INTERFACE_STATS)
+
+BLOCK_METRICS = tuple(name for _, _, name, _ in BLOCK_STATS)
+
+# Families written by each collection group, a group whose families are all
+# disabled is not collected at all
+GROUP_METRICS = {
+    "state": ("libvirt_domain_state",),
+    "vcpu": ("libvirt_domain_vcpus",) + VCPU_METRICS,
+    "cpu": CPU_METRICS,
+    "balloon": BALLOON_METRICS,
+    "interface": INTERFACE_METRICS,
+    "block": ("libvirt_domain_block_dev_metadata",) + BLOCK_METRICS,
+    "nova": ("libvirt_domain_nova_metadata",),
+}
+
+# Counter family -> gauge of its rate per second, written with a RateStore
+RATE_METRICS = {
+    "libvirt_domain_cpu_time": "libvirt_domain_cpu_usage_percent",
+    "libvirt_domain_io_rx_bytes": "libvirt_domain_io_rx_bytes_rate",
+    "libvirt_domain_io_tx_bytes": "libvirt_domain_io_tx_bytes_rate",
+    "libvirt_domain_block_dev_read_operations": "libvirt_domain_block_dev_read_iops",
+    "libvirt_domain_block_dev_write_operations": "libvirt_domain_block_dev_write_iops",
+}
+
+# Families written together -> (index of the counter, its rate gauge)
+RATE_PLANS = {
+    names: tuple(
+        (i, RATE_METRICS[name]) for i, name in enumerate(names) if name in RATE_METRICS
+    )
+    for names in (CPU_METRICS, INTERFACE_METRICS, BLOCK_METRICS)
+}
+
+# Families that need the devices of the domain XML
+DEVICE_METRICS = INTERFACE_METRICS + GROUP_METRICS["block"]
+
+# Writes whose values go into the host allocation sums
+ALLOCATION_KEYS = (("state",), ("vcpu",), ("balloon",))
+
+
+class DomainCalls:
+    __slots__ = ("domain", "executor", "tasks")
+
+    def __init__(self, domain: libvirt.virDomain, executor: LibvirtExecutor):
+        self.domain = domain
+        self.executor = executor
+        # Method name -> task of its call, awaited by every helper that needs
+        # the result
+        self.tasks = {}
+
+    def fetch(self, method: str):
+        # Argumentless per-domain calls several helpers need, made at most
+        # once per worker() call
+        task = self.tasks.get(method)
+        if task is None:
+            task = self.tasks[method] = asyncio.ensure_future(
+                self.executor.call(
+                    getattr(self.domain, method),
+                    key=self.domain.UUIDString(),
+                    method=method,
+                )
+            )
+        return task
+
+    def info(self):
+        return self.fetch("info")
+
+    def is_active(self):
+        return self.fetch("isActive")
+
 
 # noinspection PyProtectedMember
 class DomainWorker:
-    __slots__ = "conn"
+    __slots__ = (
+        "conn",
+        "stats_groups",
+        "bulk_groups",
+        "inventory",
+        "descriptions",
+        "snapshots",
+        "rates",
+        "memory_stats",
+        "shard",
+        "allocations",
+        "local_stats",
+        "errored",
+        "metrics",
+        "executor",
+        "host",
+    )
 
     def __init__(
         self,
         conn: libvirt.virConnect,
+        stats_groups: tuple = (),
+        inventory: DomainInventory = None,
+        descriptions: DomainDescriptionCache = None,
+        metrics=prometheus_desc,
+        executor: LibvirtExecutor = None,
+        snapshots: SnapshotCache = None,
+        rates: RateStore = None,
+        memory_stats: MemoryStatsCache = None,
+        shard: Shard = None,
+        allocations: DomainAllocations = None,
+        local_stats: LocalStats = None,
+        host: str = "",
     ):
         self.conn = conn
+        # Target the worker collects from, empty with a single target
+        self.host = host
+        if executor is None:
+            executor = LibvirtExecutor()
+        self.executor = executor
+        # prometheus_desc itself or a prometheus_desc.metric_set() copy
+        self.metrics = metrics
+        # Groups fetched in bulk. Per-vCPU stats are only available that way,
+        # they are collected when "vcpu" is among them
+        self.stats_groups = tuple(stats_groups)
+        # Resolved lazily on the first bulk sweep, see probe_stats_groups
+        self.bulk_groups = None
+        self.inventory = inventory
+        if descriptions is None:
+            descriptions = DomainDescriptionCache()
+        self.descriptions = descriptions
+        # Last values per domain, only series whose value changed are written
+        if snapshots is None:
+            snapshots = SnapshotCache()
+        self.snapshots = snapshots
+        # Previous samples of the RATE_METRICS counters, None to not derive
+        # rates at all
+        self.rates = rates
+        # Which memoryStats() a domain reports, and its balloon stats period
+        if memory_stats is None:
+            memory_stats = MemoryStatsCache()
+        self.memory_stats = memory_stats
+        # Domains other processes collect are left out, None to collect all
+        self.shard = shard
+        # Resources of the domains, summed up by a HostWorker, None to not
+        # keep them
+        self.allocations = allocations
+        # Reads the per-domain counters from cgroup and sysfs files where
+        # possible, None to always ask libvirt
+        self.local_stats = local_stats
+        # UUID -> name of the domains with a libvirt_exporter_domain_errors
+        # series, removed along with the domain
+        self.errored = {}
+        if inventory is not None:
+            inventory.listeners.append(descriptions.invalidate)
+            inventory.listeners.append(snapshots.invalidate)
+            inventory.listeners.append(memory_stats.invalidate)
+            if rates is not None:
+                inventory.listeners.append(rates.forget)
+            if allocations is not None:
+                inventory.listeners.append(allocations.forget)
+            if local_stats is not None:
+                inventory.listeners.append(local_stats.invalidate)
+            inventory.listeners.append(self.forget_errors)
+            if isinstance(conn, ConnectionPool):
+                inventory.listeners.append(conn.forget)
 
-    async def run(self):
-        while True:
-            domain_list = await asyncio.to_thread(self.conn.listAllDomains, 0)
-            workers = [self.worker(domain) for domain in domain_list]
-            await asyncio.gather(*workers, return_exceptions=False)
-
-    async def worker(self, domain: libvirt.virDomain):
-        domain_name = domain.name()
-        domain_info = domain.info()
-        prometheus_desc.libvirt_domain_metadata.labels(
-            domain=domain_name,
-            uuid=domain.UUIDString(),
-        )
-        prometheus_desc.libvirt_domain_state.labels(domain=domain_name).set(
-            domain_info[0]
-        )
-        prometheus_desc.libvirt_domain_vcpus.labels(domain=domain_name).set(
-            domain_info[3]
+    async def sweep(self, groups: tuple = COLLECTION_GROUPS) -> int:
+        groups = tuple(
+            group for group in groups if self.enabled(*GROUP_METRICS[group])
         )
-        dom_xml = xmltodict.parse(domain.XMLDesc(0))
-        if "nova:instance" in dom_xml["domain"]["metadata"]:
-            nova_meta = dom_xml["domain"]["metadata"]["nova:instance"]
-            nova_owner = nova_meta["nova:owner"]
-            prometheus_desc.libvirt_domain_nova_metadata.labels(
-                domain=domain.name(),
+        with exporter_desc.libvirt_exporter_sweep_duration.labels(
+            worker="domain", host=self.host
+        ).time():
+            domains = None
+            if self.inventory is not None:
+                domains = list(self.inventory.domains.values())
+            if self.shard is not None:
+                if domains is None:
+                    domains = await self.executor.call(self.conn.listAllDomains, 0)
+                # Bulk stats then only cover this shard's domains too
+                domains = [
+                    domain
+                    for domain in domains
+                    if self.shard.owns(domain.UUIDString())
+                ]
+            bulk_groups = ()
+            if any(group in groups for group in self.stats_groups):
+                bulk_groups, records = await self.executor.call(
+                    self.fetch_bulk_stats, groups, domains, method="getAllDomainStats"
+                )
+            else:
+                if domains is None:
+                    domains = await self.executor.call(self.conn.listAllDomains, 0)
+                records = [(domain, {}) for domain in domains]
+            workers = [
+                self.worker(domain, groups, record, bulk_groups)
+                for domain, record in records
+            ]
+            results = await asyncio.gather(*workers, return_exceptions=True)
+        failed = False
+        for (domain, _), result in zip(records, results):
+            # One stuck or vanished domain must not fail the whole sweep
+            if isinstance(result, libvirt.libvirtError):
+                logging.warning(
+                    "Collection of domain %s failed: %s", domain.name(), result
+                )
+                self.count_error(domain.UUIDString(), domain.name())
+                failed = True
+            elif isinstance(result, BaseException):
+                raise result
+        if self.inventory is None:
+            uuids = [domain.UUIDString() for domain, _ in records]
+            self.descriptions.retain(uuids)
+            self.snapshots.retain(uuids)
+            self.memory_stats.retain(uuids)
+            if self.rates is not None:
+                self.rates.retain(uuids)
+            if self.allocations is not None:
+                self.allocations.retain(uuids)
+            if self.local_stats is not None:
+                self.local_stats.retain(uuids)
+            for uuid in self.errored.keys() - set(uuids):
+                self.forget_errors(uuid)
+            if isinstance(self.conn, ConnectionPool):
+                self.conn.retain(uuids)
+        exporter_desc.libvirt_exporter_sweep_objects.labels(
+            worker="domain", host=self.host
+        ).set(len(records))
+        if not failed:
+            exporter_desc.libvirt_exporter_sweep_last_success.labels(
+                worker="domain", host=self.host
+            ).set_to_current_time()
+        return len(records)
+
+    def enabled(self, *names) -> bool:
+        # Whether any of the families is written
+        return any(prometheus_desc.enabled(self.metrics, name) for name in names)
+
+    def count_error(self, uuid: str, domain_name: str):
+        self.errored[uuid] = domain_name
+        exporter_desc.libvirt_exporter_domain_errors.labels(
+            domain=domain_name, host=self.host
+        ).inc()
+
+    def forget_errors(self, uuid: str, domain: libvirt.virDomain = None):
+        # Only once the domain is gone, not on every change of it
+        if domain is not None or uuid not in self.errored:
+            return
+        try:
+            exporter_desc.libvirt_exporter_domain_errors.remove(
+                self.errored.pop(uuid), self.host
+            )
+        except KeyError:
+            pass
+
+    @staticmethod
+    async def timed(helper: str, coroutine):
+        with exporter_desc.libvirt_exporter_helper_duration.labels(
+            helper=helper
+        ).time():
+            await coroutine
+
+    def call(self, domain: libvirt.virDomain, func, *args):
+        return self.executor.call(func, *args, key=domain.UUIDString())
+
+    async def bind(self, domain: libvirt.virDomain) -> libvirt.virDomain:
+        # Spreads the per-domain calls over the connections of a pool
+        if not isinstance(self.conn, ConnectionPool):
+            return domain
+        handle = self.conn.bound(domain)
+        if handle is None:
+            handle = await self.call(domain, self.conn.bind, domain)
+        return handle
+
+    async def describe(self, domain: libvirt.virDomain) -> DomainDescription:
+        description = self.descriptions.lookup(domain)
+        if description is None:
+            domain_xml = await self.call(domain, domain.XMLDesc, 0)
+            description = self.descriptions.store(domain, domain_xml)
+        return description
+
+    def get_all_domain_stats(self, groups: tuple, domains: list = None) -> list:
+        stats = 0
+        for group in groups:
+            stats |= STATS_GROUPS[group]
+        flags = libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ENFORCE_STATS
+        if domains is None:
+            return self.conn.getAllDomainStats(stats, flags)
+        if not domains:
+            return []
+        return self.conn.domainListGetStats(domains, stats, flags)
+
+    def probe_stats_groups(self, requested: tuple, domains: list = None) -> tuple:
+        # (supported groups, records of domains if all requested groups are)
+        try:
+            return requested, self.get_all_domain_stats(requested, domains)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() not in UNSUPPORTED_ERRORS:
+                raise
+        # One domain tells which groups the driver can deliver in bulk. Without
+        # any, getAllDomainStats is cheap and still rejects unsupported groups
+        if domains is None:
+            domains = self.conn.listAllDomains(0)
+        sample = domains[:1] or None
+        supported = []
+        for group in requested:
+            try:
+                self.get_all_domain_stats((group,), sample)
+            except libvirt.libvirtError as e:
+                if e.get_error_code() not in UNSUPPORTED_ERRORS:
+                    raise
+                logging.warning(
+                    "Stats group %s is not supported in bulk, using per-domain calls",
+                    group,
+                )
+                continue
+            supported.append(group)
+        return tuple(supported), None
+
+    def fetch_bulk_stats(self, groups: tuple, domains: list = None) -> tuple:
+        records = None
+        if self.bulk_groups is None:
+            if domains is not None and not domains:
+                # Nothing to probe with, and nothing to collect
+                return (), []
+            # The probe's records serve this sweep
+            self.bulk_groups, records = self.probe_stats_groups(
+                self.stats_groups, domains
+            )
+        bulk_groups = tuple(group for group in self.bulk_groups if group in groups)
+        if not bulk_groups:
+            if domains is None:
+                domains = self.conn.listAllDomains(0)
+            return bulk_groups, [(domain, {}) for domain in domains]
+        if records is not None:
+            return bulk_groups, records
+        return bulk_groups, self.get_all_domain_stats(bulk_groups, domains)
+
+    async def worker(
+        self,
+        domain: libvirt.virDomain,
+        groups: tuple = COLLECTION_GROUPS,
+        record: dict = None,
+        bulk_groups: tuple = (),
+    ):
+        snapshot = self.snapshot(domain)
+        snapshot.touch(
+            ("metadata",),
+            lambda: self.metrics.libvirt_domain_metadata.labels(
+                domain=snapshot.name,
                 uuid=domain.UUIDString(),
-                instance_name=nova_meta["nova:name"],
-                flavor=nova_meta["nova:flavor"]["@name"],
-                user_name=nova_owner["nova:user"]["#text"],
-                user_uuid=nova_owner["nova:user"]["@uuid"],
-                project_name=nova_owner["nova:project"]["#text"],
-                project_uuid=nova_owner["nova:project"]["@uuid"],
+            ),
+        )
+        if "state" in bulk_groups:
+            self.write(
+                snapshot,
+                ("state",),
+                ("libvirt_domain_state",),
+                (float(record.get("state.state", 0)),),
+            )
+        if "vcpu" in bulk_groups:
+            self.write(
+                snapshot,
+                ("vcpu",),
+                ("libvirt_domain_vcpus",),
+                (float(record.get("vcpu.current", 0)),),
             )
+            self.bulk_vcpus(snapshot, record)
+        if "cpu" in bulk_groups:
+            self.bulk_cpu(snapshot, record)
+        if "balloon" in bulk_groups:
+            if self.memory_stats.period:
+                await self.memory_support(domain)
+            self.bulk_balloon(snapshot, record)
+        if "interface" in bulk_groups or "block" in bulk_groups:
+            description = await self.describe(domain)
+            if "interface" in bulk_groups:
+                self.bulk_interface(snapshot, description.interfaces, record)
+            if "block" in bulk_groups:
+                self.bulk_block(snapshot, description.disks, record)
+
+        # Everything not delivered in bulk goes through the per-domain calls
+        helpers = {
+            "state": self.state_helper,
+            "vcpu": self.state_helper,
+            "cpu": self.cpu_helper,
+            "balloon": self.mem_helper,
+            "interface": self.io_helper,
+            "block": self.block_dev_helper,
+            "nova": self.nova_helper,
+        }
+        domain_helpers = dict.fromkeys(
+            helpers[group] for group in groups if group not in bulk_groups
+        )
+        if domain_helpers:
+            domain = await self.bind(domain)
+        calls = DomainCalls(domain, self.executor)
+        # state and vcpu share info(), a group that came in bulk isn't written
+        # again from it
+        info_groups = tuple(
+            group
+            for group in ("state", "vcpu")
+            if group in groups and group not in bulk_groups
+        )
         domain_coroutines = [
-            self.cpu_helper(domain),
-            self.mem_helper(domain),
-            self.io_helper(domain),
-            self.block_dev_helper(domain),
+            self.timed(
+                helper.__name__[: -len("_helper")],
+                (
+                    helper(domain, calls, info_groups)
+                    if helper == self.state_helper
+                    else helper(domain, calls)
+                ),
+            )
+            for helper in domain_helpers
         ]
         await asyncio.gather(*domain_coroutines, return_exceptions=False)
 
-    async def cpu_helper(self, domain: libvirt.virDomain):
+    def snapshot(self, domain: libvirt.virDomain) -> DomainSnapshot:
+        return self.snapshots.lookup(self.metrics, domain.UUIDString(), domain.name())
+
+    def children(self, names: tuple, **labelkwargs) -> tuple:
+        return tuple(
+            getattr(self.metrics, name).labels(**labelkwargs)._value for name in names
+        )
+
+    def write(
+        self,
+        snapshot: DomainSnapshot,
+        key: tuple,
+        names: tuple,
+        values: tuple,
+        **labels,
+    ):
+        # Children of names are looked up once per snapshot, values are only
+        # written when they changed since the last sweep
+        snapshot.write(
+            key,
+            values,
+            lambda: self.children(names, domain=snapshot.name, **labels),
+        )
+        if self.rates is not None and names in RATE_PLANS:
+            self.write_rates(snapshot, key, RATE_PLANS[names], values, labels)
+        if self.allocations is not None and key[:1] in ALLOCATION_KEYS:
+            if key[0] == "balloon" or len(key) == 1:
+                # Per-vCPU writes are keyed ("vcpu", i)
+                self.allocations.record(snapshot.uuid, key[0], values)
+
+    def write_rates(
+        self,
+        snapshot: DomainSnapshot,
+        key: tuple,
+        plan: tuple,
+        values: tuple,
+        labels: dict,
+    ):
+        now = time.monotonic()
+        rates = tuple(
+            self.rates.rate(snapshot.uuid, key + (i,), now, values[i])
+            for i, _ in plan
+        )
+        if None in rates:
+            # First sample
+            return
+        if key == ("cpu",):
+            # CPU seconds per second, in percent of the vCPUs
+            vcpus = snapshot.series.get(("vcpu",))
+            if not vcpus or not vcpus[0][0]:
+                return
+            rates = tuple(rate * 100 / vcpus[0][0] for rate in rates)
+        snapshot.write(
+            ("rate",) + key,
+            rates,
+            lambda: self.children(
+                tuple(name for _, name in plan), domain=snapshot.name, **labels
+            ),
+        )
+
+    def bulk_cpu(self, snapshot: DomainSnapshot, record: dict):
+        self.write(
+            snapshot,
+            ("cpu",),
+            CPU_METRICS,
+            (
+                float(record.get("cpu.time", 0) / 1000 / 1000 / 1000),
+                float(record.get("cpu.user", 0) / 1000 / 1000 / 1000),
+                float(record.get("cpu.system", 0) / 1000 / 1000 / 1000),
+            ),
+        )
+
+    def bulk_vcpus(self, snapshot: DomainSnapshot, record: dict):
+        for i in range(record.get("vcpu.maximum", 0)):
+            if "vcpu.%d.state" % i not in record:
+                # Not plugged in
+                continue
+            self.write(
+                snapshot,
+                ("vcpu", i),
+                VCPU_METRICS,
+                tuple(
+                    record.get("vcpu.%d.%s" % (i, key), 0) / divisor
+                    for key, _, divisor in VCPU_STATS
+                ),
+                vcpu=str(i),
+            )
+
+    def bulk_balloon(self, snapshot: DomainSnapshot, record: dict):
+        info = {"actual": record.get("balloon.current", 0)}
+        for key, _, _ in MEMORY_STATS:
+            if "balloon." + key in record:
+                info[key] = record["balloon." + key]
+        self.set_memory_stats(
+            snapshot,
+            record.get("balloon.maximum", 0),
+            record.get("balloon.current", 0),
+            info,
+        )
+
+    def bulk_interface(self, snapshot: DomainSnapshot, interfaces: tuple, record: dict):
+        macs = {
+            interface.target_dev: interface.mac
+            for interface in interfaces
+            if interface.target_dev is not None and interface.mac is not None
+        }
+        for i in range(record.get("net.count", 0)):
+            dev_mac = macs.get(record.get("net.%d.name" % i))
+            if dev_mac is None:
+                continue
+            self.write(
+                snapshot,
+                ("interface", dev_mac),
+                INTERFACE_METRICS,
+                tuple(
+                    int(record.get("net.%d.%s" % (i, key), 0))
+                    for key, _ in INTERFACE_STATS
+                ),
+                dev_mac=dev_mac,
+            )
+
+    def bulk_block(self, snapshot: DomainSnapshot, disks: tuple, record: dict):
+        indexes = {}
+        for i in range(record.get("block.count", 0)):
+            indexes[record.get("block.%d.name" % i)] = i
+        for disk in disks:
+            self.set_block_dev_metadata(snapshot, disk)
+            i = indexes.get(disk.target_dev)
+            values = (0,) * len(BLOCK_STATS)
+            if i is not None:
+                values = tuple(
+                    record.get("block.%d.%s" % (i, key), 0)
+                    for _, key, _, _ in BLOCK_STATS
+                )
+            self.set_block_stats(snapshot, disk.target_dev, values)
+
+    async def state_helper(
+        self,
+        domain: libvirt.virDomain,
+        calls: DomainCalls,
+        groups: tuple = ("state", "vcpu"),
+    ):
+        snapshot = self.snapshot(domain)
+        domain_info = await calls.info()
+        if "state" in groups:
+            self.write(
+                snapshot,
+                ("state",),
+                ("libvirt_domain_state",),
+                (float(domain_info[0]),),
+            )
+        if "vcpu" in groups:
+            self.write(
+                snapshot,
+                ("vcpu",),
+                ("libvirt_domain_vcpus",),
+                (float(domain_info[3]),),
+            )
+
+    async def nova_helper(self, domain: libvirt.virDomain, calls: DomainCalls):
+        await self.metadata_helper(domain, domain_metadata.NOVA)
+
+    async def metadata_helper(
+        self,
+        domain: libvirt.virDomain,
+        extractor: domain_metadata.MetadataExtractor,
+    ):
+        snapshot = self.snapshot(domain)
+        if self.enabled(*DEVICE_METRICS):
+            # The domain XML is fetched for the devices anyway, and cached
+            labels = (await self.describe(domain)).metadata.get(extractor.name)
+        else:
+            labels = await self.executor.call(
+                domain_metadata.fetch,
+                domain,
+                extractor,
+                key=domain.UUIDString(),
+                method="metadata",
+            )
+        if labels is not None:
+            snapshot.touch(
+                (extractor.name,) + tuple(labels.values()),
+                lambda: getattr(self.metrics, extractor.metric).labels(
+                    domain=snapshot.name,
+                    uuid=domain.UUIDString(),
+                    **labels,
+                ),
+            )
+
+    async def cpu_helper(self, domain: libvirt.virDomain, calls: DomainCalls):
+        snapshot = self.snapshot(domain)
+        if self.local_stats is not None:
+            times = self.local_stats.cpu_times(domain)
+            if times is not None:
+                self.write(snapshot, ("cpu",), CPU_METRICS, times)
+                return
         cpu_time_abs = 0
         cpu_system_time_abs = 0
         cpu_user_time_abs = 0
-        if domain.isActive():
-            cpu_info = domain.getCPUStats(True)
+        if await calls.is_active():
+            cpu_info = await self.call(domain, domain.getCPUStats, True)
             cpu_time_abs = cpu_info[0]["cpu_time"]
             cpu_system_time_abs = cpu_info[0]["system_time"]
             cpu_user_time_abs = cpu_info[0]["user_time"]
-        prometheus_desc.libvirt_domain_cpu_time.labels(domain=domain.name())._value.set(
-            float(cpu_time_abs / 1000 / 1000 / 1000)
+        self.write(
+            snapshot,
+            ("cpu",),
+            CPU_METRICS,
+            (
+                float(cpu_time_abs / 1000 / 1000 / 1000),
+                float(cpu_user_time_abs / 1000 / 1000 / 1000),
+                float(cpu_system_time_abs / 1000 / 1000 / 1000),
+            ),
         )
-        prometheus_desc.libvirt_domain_cpu_user_time.labels(
-            domain=domain.name()
-        )._value.set(float(cpu_user_time_abs / 1000 / 1000 / 1000))
-        prometheus_desc.libvirt_domain_cpu_system_time.labels(
-            domain=domain.name()
-        )._value.set(float(cpu_system_time_abs / 1000 / 1000 / 1000))
-
-    # noinspection PyProtectedMember
-    async def mem_helper(self, domain: libvirt.virDomain):
-        domain_name = domain.name()
-        domain_info = domain.info()
+
+    async def mem_helper(self, domain: libvirt.virDomain, calls: DomainCalls):
+        snapshot = self.snapshot(domain)
+        domain_info = await calls.info()
         info = {}
-        if domain.isActive():
+        rss = None
+        if self.local_stats is not None and self.enabled(*MEMORY_METRICS):
+            rss = self.local_stats.memory_rss(domain)
+        # A readable cgroup means the domain is running
+        if self.enabled(*MEMORY_METRICS) and (
+            rss is not None or await calls.is_active()
+        ):
+            support = await self.memory_support(domain)
+            if (
+                rss is not None
+                and support.keys is not None
+                and support.keys <= LOCAL_MEMORY_KEYS
+            ):
+                # Typical of guests without balloon stats, memoryStats()
+                # would tell nothing new
+                local = {"actual": domain_info[2], "rss": rss}
+                info = {key: local[key] for key in support.keys}
+            # A domain that reported none of the stats, e.g. one without a
+            # balloon device, is only asked again once the probe expires
+            elif support.keys is None or support.keys:
+                try:
+                    info = await self.call(domain, domain.memoryStats)
+                except libvirt.libvirtError:
+                    self.count_error(snapshot.uuid, snapshot.name)
+                else:
+                    if support.keys is None:
+                        self.memory_stats.store(support, MEMORY_KEYS.intersection(info))
+            if rss is not None and "rss" in info:
+                # The same source every sweep, whichever call ran
+                info["rss"] = rss
+        self.set_memory_stats(snapshot, domain_info[1], domain_info[2], info)
+
+    async def memory_support(self, domain: libvirt.virDomain) -> MemoryStatsSupport:
+        support = self.memory_stats.lookup(domain)
+        if self.memory_stats.period and not support.period_set:
+            # Live only, so once per start of the domain
+            support.period_set = True
             try:
-                info = domain.memoryStats()
-            except libvirt.libvirtError:
-                pass
-        prometheus_desc.libvirt_domain_max_memory_bytes.labels(domain=domain_name).set(
-            domain_info[1] * 1024
-        )
-        prometheus_desc.libvirt_domain_mem_stat_usage_bytes.labels(
-            domain=domain_name
-        ).set(domain_info[2] * 1024)
-        prometheus_desc.libvirt_domain_mem_stat_actual_balloon_bytes.labels(
-            domain=domain_name
-        ).set(int(info.get("actual", 0) * 1024))
-        prometheus_desc.libvirt_domain_mem_stat_swap_in_bytes.labels(
-            domain=domain_name
-        )._value.set(int(info.get("swap_in", 0) * 1024))
-        prometheus_desc.libvirt_domain_mem_stat_swap_out_bytes.labels(
-            domain=domain_name
-        )._value.set(int(info.get("swap_out", 0) * 1024))
-        prometheus_desc.libvirt_domain_mem_stat_major_fault.labels(
-            domain=domain_name
-        )._value.set(info.get("major_fault", 0))
-        prometheus_desc.libvirt_domain_mem_stat_minor_fault.labels(
-            domain=domain_name
-        )._value.set(info.get("minor_fault", 0))
-        prometheus_desc.libvirt_domain_mem_stat_unused_bytes.labels(
-            domain=domain_name
-        ).set(int(info.get("unused", 0)))
-        prometheus_desc.libvirt_domain_mem_stat_available_bytes.labels(
-            domain=domain_name
-        ).set(int(info.get("available", 0) * 1024))
-        prometheus_desc.libvirt_domain_mem_stat_usable_bytes.labels(
-            domain=domain_name
-        ).set(int(info.get("usable", 0) * 1024))
-        prometheus_desc.libvirt_domain_mem_stat_disk_caches_bytes.labels(
-            domain=domain_name
-        ).set(int(info.get("disk_caches", 0) * 1024))
-        prometheus_desc.libvirt_domain_mem_stat_hugetlb_pgalloc.labels(
-            domain=domain_name
-        )._value.set(info.get("hugetlb_pgalloc", 0))
-        prometheus_desc.libvirt_domain_mem_stat_hugetlb_pgfail.labels(
-            domain=domain_name
-        )._value.set(info.get("hugetlb_pgfail", 0))
-        prometheus_desc.libvirt_domain_mem_stat_rss.labels(domain=domain_name).set(
-            int(info.get("rss", 0) * 1024)
-        )
+                await self.call(
+                    domain,
+                    domain.setMemoryStatsPeriod,
+                    self.memory_stats.period,
+                    libvirt.VIR_DOMAIN_AFFECT_LIVE,
+                )
+            except libvirt.libvirtError as e:
+                logging.debug(
+                    "No balloon stats period for domain %s: %s", domain.name(), e
+                )
+        return support
 
-    async def io_helper(self, domain: libvirt.virDomain):
-        domain_name = domain.name()
-        domain_xml = ET.fromstring(domain.XMLDesc(0))
-        for interface in domain_xml.iter("interface"):
-            if domain.isActive():
+    async def io_helper(self, domain: libvirt.virDomain, calls: DomainCalls):
+        snapshot = self.snapshot(domain)
+        interfaces = (await self.describe(domain)).interfaces
+        if not interfaces:
+            return
+        local = (None,) * len(interfaces)
+        if self.local_stats is not None:
+            local = tuple(
+                self.local_stats.interface_stats(domain, interface.target_dev)
+                for interface in interfaces
+            )
+        # Counters read locally already tell that the domain runs
+        if None in local and not await calls.is_active():
+            return
+        for interface, stats in zip(interfaces, local):
+            if stats is None:
                 try:
-                    stats = domain.interfaceStats(interface.find("target").attrib.get("dev"))
-                    dev_mac = interface.find("mac").attrib.get("address")
-                    prometheus_desc.libvirt_domain_io_rx_bytes.labels(
-                        domain=domain_name, dev_mac=dev_mac
-                    )._value.set(int(stats[0]))
-                    prometheus_desc.libvirt_domain_io_rx_packets.labels(
-                        domain=domain_name, dev_mac=dev_mac
-                    )._value.set(int(stats[1]))
-                    prometheus_desc.libvirt_domain_io_rx_errors.labels(
-                        domain=domain_name, dev_mac=dev_mac
-                    )._value.set(int(stats[2]))
-                    prometheus_desc.libvirt_domain_io_rx_drops.labels(
-                        domain=domain_name, dev_mac=dev_mac
-                    )._value.set(int(stats[3]))
-                    prometheus_desc.libvirt_domain_io_tx_bytes.labels(
-                        domain=domain_name, dev_mac=dev_mac
-                    )._value.set(int(stats[4]))
-                    prometheus_desc.libvirt_domain_io_tx_packets.labels(
-                        domain=domain_name, dev_mac=dev_mac
-                    )._value.set(int(stats[5]))
-                    prometheus_desc.libvirt_domain_io_tx_errors.labels(
-                        domain=domain_name, dev_mac=dev_mac
-                    )._value.set(int(stats[6]))
-                    prometheus_desc.libvirt_domain_io_tx_drops.labels(
-                        domain=domain_name, dev_mac=dev_mac
-                    )._value.set(int(stats[7]))
+                    stats = await self.call(
+                        domain, domain.interfaceStats, interface.target_dev
+                    )
                 except libvirt.libvirtError:
-                    pass
+                    self.count_error(snapshot.uuid, snapshot.name)
+                    continue
+            self.write(
+                snapshot,
+                ("interface", interface.mac),
+                INTERFACE_METRICS,
+                tuple(int(stats[i]) for i in range(len(INTERFACE_STATS))),
+                dev_mac=interface.mac,
+            )
 
-    async def block_dev_helper(self, domain: libvirt.virDomain):
-        domain_name = domain.name()
-        domain_xml = ET.fromstring(domain.XMLDesc(0))
-        for disk in domain_xml.iter("disk"):
+    async def block_dev_helper(self, domain: libvirt.virDomain, calls: DomainCalls):
+        snapshot = self.snapshot(domain)
+        disks = (await self.describe(domain)).disks
+        active = (
+            bool(disks)
+            and self.enabled(*BLOCK_METRICS)
+            and await calls.is_active()
+        )
+        for disk in disks:
             stats_flagged = {}
-            target_dev = disk.find("target").attrib.get("dev")
-            if domain.isActive():
+            if active:
                 try:
-                    stats_flagged = domain.blockStatsFlags(target_dev)
+                    stats_flagged = await self.call(
+                        domain, domain.blockStatsFlags, disk.target_dev
+                    )
                 except libvirt.libvirtError:
-                    pass
-            prometheus_desc.libvirt_domain_block_dev_metadata.labels(
-                domain=domain_name,
-                disk_type=disk.attrib.get("type"),
-                target_dev=disk.find("target").attrib.get("dev"),
-                target_bus=disk.find("target").attrib.get("bus"),
-                source_file=disk.find("source").attrib.get("file"),
-                driver_name=disk.find("driver").attrib.get("name"),
-                driver_type=disk.find("driver").attrib.get("type"),
-                driver_discard=disk.find("driver").attrib.get("discard"),
-            )
-            prometheus_desc.libvirt_domain_block_dev_read_bytes.labels(
-                domain=domain_name,
-                target_dev=target_dev,
-            )._value.set(stats_flagged.get("rd_bytes", 0))
-            prometheus_desc.libvirt_domain_block_dev_read_operations.labels(
-                domain=domain_name,
-                target_dev=target_dev,
-            )._value.set(stats_flagged.get("rd_operations", 0))
-            prometheus_desc.libvirt_domain_block_dev_read_total_seconds.labels(
-                domain=domain_name,
-                target_dev=target_dev,
-            )._value.set(
-                float(stats_flagged.get("rd_total_times", 0) / 1000 / 1000 / 1000)
-            )
-            prometheus_desc.libvirt_domain_block_dev_write_bytes.labels(
-                domain=domain_name,
-                target_dev=target_dev,
-            )._value.set(stats_flagged.get("wr_bytes", 0))
-            prometheus_desc.libvirt_domain_block_dev_write_operations.labels(
-                domain=domain_name,
-                target_dev=target_dev,
-            )._value.set(stats_flagged.get("wr_operations", 0))
-            prometheus_desc.libvirt_domain_block_dev_write_total_seconds.labels(
-                domain=domain_name,
-                target_dev=target_dev,
-            )._value.set(
-                float(stats_flagged.get("wr_total_times", 0) / 1000 / 1000 / 1000)
-            )
-            prometheus_desc.libvirt_domain_block_dev_flush_operations.labels(
-                domain=domain_name,
-                target_dev=target_dev,
-            )._value.set(stats_flagged.get("flush_operations", 0))
-            prometheus_desc.libvirt_domain_block_dev_flush_total_seconds.labels(
-                domain=domain_name,
-                target_dev=target_dev,
-            )._value.set(
-                float(stats_flagged.get("flush_total_times", 0) / 1000 / 1000 / 1000)
+                    self.count_error(snapshot.uuid, snapshot.name)
+            self.set_block_dev_metadata(snapshot, disk)
+            self.set_block_stats(
+                snapshot,
+                disk.target_dev,
+                tuple(stats_flagged.get(key, 0) for key, _, _, _ in BLOCK_STATS),
             )
+
+    def set_memory_stats(
+        self, snapshot: DomainSnapshot, max_memory: int, usage: int, info: dict
+    ):
+        # max_memory and usage in KiB, info as returned by memoryStats()
+        values = (float(max_memory * 1024), float(usage * 1024))
+        if self.memory_stats.export_absent:
+            self.write(
+                snapshot,
+                ("balloon",),
+                BALLOON_METRICS,
+                values
+                + tuple(
+                    int(info.get(key, 0) * scale) for key, _, scale in MEMORY_STATS
+                ),
+            )
+            return
+        # No series for stats the domain doesn't report
+        stats = tuple(stat for stat in MEMORY_STATS if stat[0] in info)
+        self.write(
+            snapshot,
+            ("balloon",) + tuple(key for key, _, _ in stats),
+            BALLOON_METRICS[:2] + tuple(name for _, name, _ in stats),
+            values + tuple(int(info[key] * scale) for key, _, scale in stats),
+        )
+
+    def set_block_stats(self, snapshot: DomainSnapshot, target_dev: str, stats: tuple):
+        # stats in BLOCK_STATS order, times in nanoseconds
+        self.write(
+            snapshot,
+            ("block", target_dev),
+            BLOCK_METRICS,
+            tuple(
+                value / divisor
+                for value, (_, _, _, divisor) in zip(stats, BLOCK_STATS)
+            ),
+            target_dev=target_dev,
+        )
+
+    def set_block_dev_metadata(self, snapshot: DomainSnapshot, disk: Disk):
+        snapshot.touch(
+            ("block_dev_metadata", disk),
+            lambda: self.metrics.libvirt_domain_block_dev_metadata.labels(
+                domain=snapshot.name,
+                **disk._asdict(),
+            ),
+        )
@@ -0,0 +1,317 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+####
+# Domain description cache
+####
+
+libvirt_exporter_xml_cache_hits = Counter(
+    namespace="libvirt_exporter",
+    subsystem="xml_cache",
+    name="hits",
+    documentation="Domain descriptions served from the cache",
+)
+
+libvirt_exporter_xml_cache_misses = Counter(
+    namespace="libvirt_exporter",
+    subsystem="xml_cache",
+    name="misses",
+    documentation="Domain descriptions fetched and parsed from the domain XML",
+)
+
+libvirt_exporter_xml_cache_entries = Gauge(
+    namespace="libvirt_exporter",
+    subsystem="xml_cache",
+    name="entries",
+    documentation="Domain descriptions currently cached",
+    labelnames=["host"],
+)
+
+####
+# Scheduler
+####
+
+libvirt_exporter_scheduler_lag = Gauge(
+    namespace="libvirt_exporter",
+    subsystem="scheduler",
+    name="lag",
+    documentation="How late the last run of a collection group started, in seconds",
+    unit="seconds",
+    labelnames=["group", "host"],
+)
+
+libvirt_exporter_scheduler_duration = Gauge(
+    namespace="libvirt_exporter",
+    subsystem="scheduler",
+    name="duration",
+    documentation="Duration of the last run of a collection group, in seconds",
+    unit="seconds",
+    labelnames=["group", "host"],
+)
+
+libvirt_exporter_scheduler_overruns = Counter(
+    namespace="libvirt_exporter",
+    subsystem="scheduler",
+    name="overruns",
+    documentation="Ticks skipped because the previous run of a collection group "
+    "was still in flight",
+    labelnames=["group", "host"],
+)
+
+libvirt_exporter_scheduler_errors = Counter(
+    namespace="libvirt_exporter",
+    subsystem="scheduler",
+    name="errors",
+    documentation="Runs of a collection group that failed with an exception",
+    labelnames=["group", "host"],
+)
+
+####
+# Stale series
+####
+
+libvirt_exporter_stale_series_evicted = Counter(
+    namespace="libvirt_exporter",
+    subsystem="stale_series",
+    name="evicted",
+    documentation="Series removed because their domain, device or pool was not "
+    "seen within the grace period",
+    labelnames=["metric"],
+)
+
+libvirt_exporter_stale_series_tracked = Gauge(
+    namespace="libvirt_exporter",
+    subsystem="stale_series",
+    name="tracked",
+    documentation="Series currently tracked for staleness",
+    labelnames=["host"],
+)
+
+####
+# libvirt calls
+####
+
+libvirt_exporter_rpc_queue_depth = Gauge(
+    namespace="libvirt_exporter",
+    subsystem="rpc",
+    name="queue_depth",
+    documentation="libvirt calls waiting for a free executor thread",
+)
+
+libvirt_exporter_rpc_in_flight = Gauge(
+    namespace="libvirt_exporter",
+    subsystem="rpc",
+    name="in_flight",
+    documentation="libvirt calls currently running, including timed out ones "
+    "that did not return yet",
+)
+
+libvirt_exporter_rpc_duration = Histogram(
+    namespace="libvirt_exporter",
+    subsystem="rpc",
+    name="duration",
+    documentation="Duration of libvirt calls by method, in seconds",
+    unit="seconds",
+    labelnames=["method"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+libvirt_exporter_rpc_timeouts = Counter(
+    namespace="libvirt_exporter",
+    subsystem="rpc",
+    name="timeouts",
+    documentation="libvirt calls abandoned after the per-call timeout",
+    labelnames=["method"],
+)
+
+libvirt_exporter_rpc_errors = Counter(
+    namespace="libvirt_exporter",
+    subsystem="rpc",
+    name="errors",
+    documentation="libvirt calls by method that failed with a libvirt error",
+    labelnames=["method"],
+)
+
+libvirt_exporter_rpc_open_circuits = Gauge(
+    namespace="libvirt_exporter",
+    subsystem="rpc",
+    name="open_circuits",
+    documentation="Domains whose calls are skipped after repeated timeouts",
+)
+
+####
+# libvirt connections
+####
+
+libvirt_exporter_connections = Gauge(
+    namespace="libvirt_exporter",
+    subsystem="connection",
+    name="open",
+    documentation="libvirt connections currently open",
+    labelnames=["host"],
+)
+
+libvirt_exporter_connection_reconnects = Counter(
+    namespace="libvirt_exporter",
+    subsystem="connection",
+    name="reconnects",
+    documentation="libvirt connections re-established after they were closed",
+)
+
+####
+# Sweeps
+####
+
+libvirt_exporter_sweep_duration = Histogram(
+    namespace="libvirt_exporter",
+    subsystem="sweep",
+    name="duration",
+    documentation="Duration of domain, storage pool and storage volume sweeps, "
+    "in seconds",
+    unit="seconds",
+    labelnames=["worker", "host"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+libvirt_exporter_sweep_objects = Gauge(
+    namespace="libvirt_exporter",
+    subsystem="sweep",
+    name="objects",
+    documentation="Domains, storage pools or storage volumes processed by the "
+    "last sweep",
+    labelnames=["worker", "host"],
+)
+
+libvirt_exporter_sweep_last_success = Gauge(
+    namespace="libvirt_exporter",
+    subsystem="sweep",
+    name="last_success_timestamp",
+    documentation="Unix time the last sweep without a failure finished at",
+    unit="seconds",
+    labelnames=["worker", "host"],
+)
+
+libvirt_exporter_helper_duration = Histogram(
+    namespace="libvirt_exporter",
+    subsystem="helper",
+    name="duration",
+    documentation="Duration of collecting one domain with a per-domain helper, "
+    "or of parsing one domain XML description, in seconds",
+    unit="seconds",
+    labelnames=["helper"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5),
+)
+
+libvirt_exporter_domain_errors = Counter(
+    namespace="libvirt_exporter",
+    subsystem="domain",
+    name="errors",
+    documentation="libvirt errors while collecting a domain, including single "
+    "devices or stats that had to be left out",
+    labelnames=["domain", "host"],
+)
+
+####
+# Cardinality limits
+####
+
+libvirt_exporter_series_overflow = Counter(
+    namespace="libvirt_exporter",
+    subsystem="series",
+    name="overflow",
+    documentation="Writes dropped because they would have created a series "
+    "beyond the configured limit of the family",
+    labelnames=["metric"],
+)
+
+####
+# Storage volume listings
+####
+
+libvirt_exporter_volume_refresh_duration = Gauge(
+    namespace="libvirt_exporter",
+    subsystem="volume_refresh",
+    name="duration",
+    documentation="Duration of the last volume listing of a storage pool, in seconds",
+    unit="seconds",
+    labelnames=["pool", "host"],
+)
+
+libvirt_exporter_volume_refreshes = Counter(
+    namespace="libvirt_exporter",
+    subsystem="volume_refresh",
+    name="refreshes",
+    documentation="Volume listings of a storage pool, by what triggered them",
+    labelnames=["pool", "reason", "host"],
+)
+
+####
+# Shards
+####
+
+libvirt_exporter_shard_restarts = Counter(
+    namespace="libvirt_exporter",
+    subsystem="shard",
+    name="restarts",
+    documentation="Shard processes restarted after they exited",
+    labelnames=["shard"],
+)
+
+libvirt_exporter_shard_series = Gauge(
+    namespace="libvirt_exporter",
+    subsystem="shard",
+    name="series",
+    documentation="Series a shard process currently exports",
+    labelnames=["shard"],
+)
+
+libvirt_exporter_shard_batch_bytes = Gauge(
+    namespace="libvirt_exporter",
+    subsystem="shard",
+    name="batch",
+    documentation="Size of the last sample batch a shard process sent, in bytes",
+    unit="bytes",
+    labelnames=["shard"],
+)
+
+####
+# Push mode
+####
+
+libvirt_exporter_push_batches = Counter(
+    namespace="libvirt_exporter",
+    subsystem="push",
+    name="batches",
+    documentation="Pushed batches by result: sent, failed (retried), rejected "
+    "by the receiver, or dropped from a full spool",
+    labelnames=["result"],
+)
+
+libvirt_exporter_push_spool_bytes = Gauge(
+    namespace="libvirt_exporter",
+    subsystem="push",
+    name="spool",
+    documentation="Size of the remote write batches waiting in the spool, in bytes",
+    unit="bytes",
+)
+
+libvirt_exporter_push_last_success = Gauge(
+    namespace="libvirt_exporter",
+    subsystem="push",
+    name="last_success_timestamp",
+    documentation="When a batch was last accepted by the receiver, in seconds "
+    "since the epoch",
+    unit="seconds",
+)
+
+####
+# Local stats
+####
+
+libvirt_exporter_local_stats_fallbacks = Counter(
+    namespace="libvirt_exporter",
+    subsystem="local_stats",
+    name="fallbacks",
+    documentation="Reads of domain counters from cgroup or sysfs files that "
+    "fell back to libvirt, by kind: cpu, memory or interface",
+    labelnames=["kind"],
+)
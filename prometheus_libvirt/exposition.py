@@ -0,0 +1,169 @@
+import asyncio
+import email.utils
+import gzip
+import hashlib
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.openmetrics import exposition as openmetrics
+
+from prometheus_libvirt.debounced_writer import DebouncedWriter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def accepts(header: str, value: str) -> bool:
+    # Whether a comma separated Accept style header lists value, q=0 excluded
+    for accepted in header.split(","):
+        media_type, *params = (part.strip() for part in accepted.split(";"))
+        if media_type != value:
+            continue
+        for param in params:
+            if param.startswith("q=") and param[2:].strip("0.") == "":
+                return False
+        return True
+    return False
+
+
+class Rendering:
+    __slots__ = (
+        "content_type",
+        "body",
+        "gzip",
+        "zstd",
+        "etag",
+        "rendered_at",
+        "last_modified",
+    )
+
+    def __init__(self, content_type: str, body: bytes, previous=None):
+        self.content_type = content_type
+        self.body = body
+        self.etag = '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+        if previous is not None and previous.etag == self.etag:
+            # Nothing changed since the last sweep, keep validators stable
+            self.rendered_at = previous.rendered_at
+            self.gzip = previous.gzip
+            self.zstd = previous.zstd
+        else:
+            self.rendered_at = int(time.time())
+            self.gzip = None
+            self.zstd = None
+        self.last_modified = email.utils.formatdate(self.rendered_at, usegmt=True)
+
+    def compress(self):
+        if self.gzip is None:
+            self.gzip = gzip.compress(self.body, compresslevel=6)
+        if self.zstd is None and zstandard is not None:
+            self.zstd = zstandard.ZstdCompressor().compress(self.body)
+
+    def not_modified(self, if_none_match: str, if_modified_since: str) -> bool:
+        if if_none_match:
+            return self.etag in (tag.strip() for tag in if_none_match.split(","))
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            return since.timestamp() >= self.rendered_at
+        return False
+
+    def encoded(self, accept_encoding: str) -> tuple:
+        if self.zstd is not None and accepts(accept_encoding, "zstd"):
+            return "zstd", self.zstd
+        if self.gzip is not None and accepts(accept_encoding, "gzip"):
+            return "gzip", self.gzip
+        return None, self.body
+
+
+class Snapshot:
+    __slots__ = ("families",)
+
+    def __init__(self, registry):
+        # The collectors' samples as of now, a registry to the formatters
+        self.families = list(registry.collect())
+
+    def collect(self):
+        return iter(self.families)
+
+
+class ExpositionCache(DebouncedWriter):
+    def __init__(self, registry, min_interval: float = 1):
+        super().__init__(min_interval)
+        self.registry = registry
+        self.text = None
+        self.openmetrics = None
+
+    def render(self, snapshot: Snapshot = None):
+        # Formats a snapshot taken on the loop, so may run in a thread while
+        # the next sweep changes the metrics
+        if snapshot is None:
+            snapshot = Snapshot(self.registry)
+        self.text = Rendering(CONTENT_TYPE_LATEST, generate_latest(snapshot), self.text)
+        self.openmetrics = Rendering(
+            openmetrics.CONTENT_TYPE_LATEST,
+            openmetrics.generate_latest(snapshot),
+            self.openmetrics,
+        )
+        return self.text, self.openmetrics
+
+    async def write(self) -> bool:
+        # Scrapes before the first sweep finished render on demand
+        renderings = await asyncio.to_thread(self.render, Snapshot(self.registry))
+        for rendering in renderings:
+            await asyncio.to_thread(rendering.compress)
+        return True
+
+    def response(
+        self,
+        accept: str = "",
+        accept_encoding: str = "",
+        if_none_match: str = "",
+        if_modified_since: str = "",
+    ) -> tuple:
+        # (status, headers, body) of the latest rendering, nothing is
+        # formatted or compressed per request
+        text, openmetrics_rendering = self.text, self.openmetrics
+        if text is None:
+            # Scraped before the first sweep finished
+            text, openmetrics_rendering = self.render()
+        rendering = text
+        if accepts(accept or "", "application/openmetrics-text"):
+            rendering = openmetrics_rendering
+        headers = [
+            ("ETag", rendering.etag),
+            ("Last-Modified", rendering.last_modified),
+            ("Vary", "Accept, Accept-Encoding"),
+        ]
+        if rendering.not_modified(if_none_match or "", if_modified_since or ""):
+            return "304 Not Modified", headers, b""
+        encoding, body = rendering.encoded(accept_encoding or "")
+        headers.append(("Content-Type", rendering.content_type))
+        if encoding is not None:
+            headers.append(("Content-Encoding", encoding))
+        headers.append(("Content-Length", str(len(body))))
+        return "200 OK", headers, body
+
+
+async def render_live(
+    registry, accept: str = "", accept_encoding: str = "", names: list = ()
+) -> tuple:
+    # For --on-scrape and name[] filtered scrapes, formats in a thread since
+    # collectors may wait on the loop
+    if names:
+        registry = registry.restricted_registry(names)
+    if accepts(accept, "application/openmetrics-text"):
+        content_type = openmetrics.CONTENT_TYPE_LATEST
+        body = await asyncio.to_thread(openmetrics.generate_latest, registry)
+    else:
+        content_type = CONTENT_TYPE_LATEST
+        body = await asyncio.to_thread(generate_latest, registry)
+    headers = [("Content-Type", content_type)]
+    if accepts(accept_encoding, "gzip"):
+        body = await asyncio.to_thread(gzip.compress, body, 6)
+        headers.append(("Content-Encoding", "gzip"))
+    headers.append(("Content-Length", str(len(body))))
+    return "200 OK", headers, body
@@ -0,0 +1,189 @@
+import logging
+
+import libvirt
+
+from prometheus_libvirt import domain_metadata, exporter_desc, prometheus_desc
+from prometheus_libvirt.domain_allocations import DomainAllocations
+from prometheus_libvirt.libvirt_executor import LibvirtExecutor
+
+# virNodeGetCPUStats keys, in nanoseconds
+NODE_CPU_MODES = ("kernel", "user", "idle", "iowait")
+
+# virNodeGetMemoryStats keys, in KiB
+NODE_MEMORY_KINDS = ("total", "free", "buffers", "cached")
+
+# Families that need virNodeGetInfo, the NUMA ones for the number of cells
+INFO_METRICS = (
+    "libvirt_node_metadata",
+    "libvirt_node_cpus",
+    "libvirt_node_cpu_frequency",
+    "libvirt_node_numa_free_memory",
+    "libvirt_node_free_pages",
+)
+
+ALLOCATION_METRICS = (
+    "libvirt_node_domains",
+    "libvirt_node_domain_vcpus",
+    "libvirt_node_domain_max_memory",
+    "libvirt_node_domain_memory",
+)
+
+
+class HostWorker:
+    __slots__ = (
+        "conn",
+        "allocations",
+        "metrics",
+        "executor",
+        "node_stats",
+        "hostname",
+        "page_sizes",
+        "host",
+    )
+
+    def __init__(
+        self,
+        conn: libvirt.virConnect,
+        allocations: DomainAllocations = None,
+        metrics=prometheus_desc,
+        executor: LibvirtExecutor = None,
+        node_stats: bool = True,
+        host: str = "",
+    ):
+        self.conn = conn
+        # Target the worker collects from, empty with a single target
+        self.host = host
+        # Filled by the DomainWorker, None to not export the allocation sums
+        self.allocations = allocations
+        # prometheus_desc itself or a prometheus_desc.metric_set() copy
+        self.metrics = metrics
+        if executor is None:
+            executor = LibvirtExecutor()
+        self.executor = executor
+        # Whether the host's own CPU, memory and NUMA stats are read. Shards
+        # other than the first only export their share of the allocations
+        self.node_stats = node_stats
+        # Read once per connection, the node label of every series
+        self.hostname = None
+        # Page sizes in KiB from the capabilities, read once per connection
+        self.page_sizes = None
+
+    def reconnected(self, index: int):
+        # libvirtd may run on another host now, or with other hugepages
+        self.hostname = None
+        self.page_sizes = None
+
+    def enabled(self, *names) -> bool:
+        return any(prometheus_desc.enabled(self.metrics, name) for name in names)
+
+    async def sweep(self) -> int:
+        if not any(
+            prometheus_desc.enabled(self.metrics, name)
+            for name in prometheus_desc.collected_metrics(self.metrics)
+            if name.startswith("libvirt_node_")
+        ):
+            return 0
+        with exporter_desc.libvirt_exporter_sweep_duration.labels(
+            worker="host", host=self.host
+        ).time():
+            if self.hostname is None:
+                self.hostname = await self.executor.call(self.conn.getHostname)
+            if self.node_stats:
+                await self.node_helper()
+            if self.allocations is not None:
+                self.set_allocations()
+        exporter_desc.libvirt_exporter_sweep_objects.labels(
+            worker="host", host=self.host
+        ).set(1)
+        exporter_desc.libvirt_exporter_sweep_last_success.labels(
+            worker="host", host=self.host
+        ).set_to_current_time()
+        return 1
+
+    async def node_helper(self):
+        node = self.hostname
+        if self.enabled(*INFO_METRICS):
+            model, _, cpus, mhz, cells, sockets, cores, threads = (
+                await self.executor.call(self.conn.getInfo)
+            )
+            self.metrics.libvirt_node_metadata.labels(
+                node=node,
+                model=model,
+                numa_cells=str(cells),
+                sockets_per_cell=str(sockets),
+                cores_per_socket=str(cores),
+                threads_per_core=str(threads),
+            )
+            self.metrics.libvirt_node_cpus.labels(node=node).set(cpus)
+            self.metrics.libvirt_node_cpu_frequency.labels(node=node).set(
+                mhz * 1000 * 1000
+            )
+            if self.enabled("libvirt_node_numa_free_memory"):
+                await self.numa_helper(cells)
+            if self.enabled("libvirt_node_free_pages"):
+                await self.free_pages_helper(cells)
+        if self.enabled("libvirt_node_cpu_time"):
+            stats = await self.executor.call(
+                self.conn.getCPUStats, libvirt.VIR_NODE_CPU_STATS_ALL_CPUS, 0
+            )
+            for mode in NODE_CPU_MODES:
+                if mode in stats:
+                    self.metrics.libvirt_node_cpu_time.labels(
+                        node=node, mode=mode
+                    )._value.set(stats[mode] / 1000 / 1000 / 1000)
+        if self.enabled("libvirt_node_memory"):
+            stats = await self.executor.call(
+                self.conn.getMemoryStats, libvirt.VIR_NODE_MEMORY_STATS_ALL_CELLS, 0
+            )
+            for kind in NODE_MEMORY_KINDS:
+                if kind in stats:
+                    self.metrics.libvirt_node_memory.labels(node=node, kind=kind).set(
+                        stats[kind] * 1024
+                    )
+
+    async def numa_helper(self, cells: int):
+        free = await self.executor.call(self.conn.getCellsFreeMemory, 0, cells)
+        for cell, free_bytes in enumerate(free):
+            self.metrics.libvirt_node_numa_free_memory.labels(
+                node=self.hostname, cell=str(cell)
+            ).set(free_bytes)
+
+    async def free_pages_helper(self, cells: int):
+        if self.page_sizes is None:
+            capabilities = await self.executor.call(self.conn.getCapabilities)
+            self.page_sizes = parse_page_sizes(capabilities)
+        if not self.page_sizes:
+            return
+        try:
+            pages = await self.executor.call(
+                self.conn.getFreePages, list(self.page_sizes), 0, cells, 0
+            )
+        except libvirt.libvirtError as e:
+            # Not every driver reports them
+            logging.debug("No free pages of %s: %s", self.hostname, e)
+            return
+        for cell, sizes in pages.items():
+            for size, count in sizes.items():
+                self.metrics.libvirt_node_free_pages.labels(
+                    node=self.hostname, cell=str(cell), page_size=str(size * 1024)
+                ).set(count)
+
+    def set_allocations(self):
+        domains, vcpus, max_memory, memory = self.allocations.totals()
+        node = self.hostname
+        self.metrics.libvirt_node_domains.labels(node=node).set(domains)
+        self.metrics.libvirt_node_domain_vcpus.labels(node=node).set(vcpus)
+        self.metrics.libvirt_node_domain_max_memory.labels(node=node).set(max_memory)
+        self.metrics.libvirt_node_domain_memory.labels(node=node).set(memory)
+
+
+def parse_page_sizes(capabilities: str) -> tuple:
+    # Page sizes in KiB the host CPU supports, hugepages included
+    sizes = []
+    for pages in domain_metadata.fromstring(capabilities).iterfind("host/cpu/pages"):
+        size = int(pages.get("size", 0))
+        if pages.get("unit", "KiB") == "MiB":
+            size *= 1024
+        if size:
+            sizes.append(size)
+    return tuple(sizes)
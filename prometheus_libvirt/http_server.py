@@ -0,0 +1,161 @@
+import asyncio
+import email.utils
+import logging
+import urllib.parse
+
+MAX_HEADERS = 100
+MAX_BODY = 64 * 1024
+
+REASONS = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class BadRequest(Exception):
+    pass
+
+
+class Request:
+    __slots__ = ("method", "path", "query", "version", "headers")
+
+    def __init__(self, method: str, target: str, version: str, headers: dict):
+        self.method = method
+        url = urllib.parse.urlsplit(target)
+        self.path = url.path
+        self.query = urllib.parse.parse_qs(url.query)
+        self.version = version
+        # Lower case names, repeated headers joined with ", "
+        self.headers = headers
+
+    def header(self, name: str) -> str:
+        return self.headers.get(name, "")
+
+    def keep_alive(self) -> bool:
+        connection = self.header("connection").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+
+class HttpServer:
+    def __init__(
+        self,
+        handler,
+        host: str = "0.0.0.0",
+        port: int = 8000,
+        keepalive_timeout: float = 75,
+    ):
+        # Coroutine function taking a Request, returning (status, headers, body)
+        # with status an int or a "304 Not Modified" style string
+        self.handler = handler
+        self.host = host
+        self.port = port
+        # Idle connections are closed after this long without a request
+        self.keepalive_timeout = keepalive_timeout
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle_connection, self.host or None, self.port
+        )
+        for sock in self.server.sockets:
+            logging.info("Serving metrics on %s", sock.getsockname())
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(
+                        self.read_request(reader), self.keepalive_timeout
+                    )
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    break
+                except (BadRequest, ValueError, asyncio.LimitOverrunError) as e:
+                    logging.debug("Bad request: %s", e)
+                    await self.write_response(
+                        writer, 400, [], b"Bad Request\n", False
+                    )
+                    break
+                if request is None:
+                    break
+                keep_alive = request.keep_alive()
+                try:
+                    status, headers, body = await self.handler(request)
+                except Exception:
+                    logging.exception(
+                        "Handling %s %s failed", request.method, request.path
+                    )
+                    status, headers, body = 500, [], b"Internal Server Error\n"
+                if request.method == "HEAD":
+                    body = None
+                await self.write_response(writer, status, headers, body, keep_alive)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def read_request(reader: asyncio.StreamReader):
+        line = await reader.readline()
+        if not line:
+            # Client closed the connection
+            return None
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError:
+            raise BadRequest("malformed request line %r" % line) from None
+        if not version.startswith("HTTP/1."):
+            raise BadRequest("unsupported version %s" % version)
+        headers = {}
+        for _ in range(MAX_HEADERS):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            name = name.strip().lower()
+            value = value.strip()
+            if name in headers:
+                value = headers[name] + ", " + value
+            headers[name] = value
+        else:
+            raise BadRequest("too many headers")
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY:
+            raise BadRequest("request body too large")
+        if length:
+            # Nothing here takes a body, drop it to keep the connection usable
+            await reader.readexactly(length)
+        return Request(method, target, version, headers)
+
+    @staticmethod
+    async def write_response(
+        writer: asyncio.StreamWriter, status, headers: list, body, keep_alive: bool
+    ):
+        if isinstance(status, int):
+            status = "%d %s" % (status, REASONS[status])
+        lines = ["HTTP/1.1 " + status]
+        lines.extend("%s: %s" % header for header in headers)
+        names = {name.lower() for name, _ in headers}
+        if "content-length" not in names:
+            lines.append("Content-Length: %d" % len(body or b""))
+        lines.append("Date: " + email.utils.formatdate(usegmt=True))
+        lines.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if body:
+            writer.write(body)
+        await writer.drain()
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import libvirt
+
+from prometheus_libvirt import exporter_desc
+
+
+class CallTimeout(libvirt.libvirtError):
+    pass
+
+
+class CircuitOpen(libvirt.libvirtError):
+    pass
+
+
+class LibvirtExecutor:
+    __slots__ = (
+        "pool",
+        "semaphore",
+        "timeout",
+        "failure_threshold",
+        "reset_after",
+        "failures",
+        "queued",
+    )
+
+    def __init__(
+        self,
+        max_workers: int = 8,
+        timeout: float = 10,
+        failure_threshold: int = 3,
+        reset_after: float = 60,
+    ):
+        self.pool = ThreadPoolExecutor(max_workers, thread_name_prefix="libvirt")
+        # Held until the thread actually returns, so calls stuck past their
+        # timeout keep occupying a slot instead of piling up in the pool
+        self.semaphore = asyncio.Semaphore(max_workers)
+        self.timeout = timeout
+        # Consecutive timeouts after which calls for a key are refused ...
+        self.failure_threshold = failure_threshold
+        # ... until this many seconds passed, then one call may try again
+        self.reset_after = reset_after
+        # key -> [consecutive timeouts, time.monotonic() of the last one]
+        self.failures = {}
+        self.queued = 0
+
+    def circuit_open(self, key) -> bool:
+        failures = self.failures.get(key)
+        if failures is None or failures[0] < self.failure_threshold:
+            return False
+        if time.monotonic() - failures[1] >= self.reset_after:
+            # Half open, let this call through and re-open on its failure
+            failures[0] = self.failure_threshold - 1
+            return False
+        return True
+
+    def record_timeout(self, key):
+        failures = self.failures.setdefault(key, [0, 0.0])
+        failures[0] += 1
+        failures[1] = time.monotonic()
+        if failures[0] == self.failure_threshold:
+            logging.warning(
+                "Calls for %s keep timing out, skipping them for %ss",
+                key,
+                self.reset_after,
+            )
+        self.update_open_circuits()
+
+    def record_success(self, key):
+        if self.failures.pop(key, None) is not None:
+            self.update_open_circuits()
+
+    def update_open_circuits(self):
+        exporter_desc.libvirt_exporter_rpc_open_circuits.set(
+            sum(
+                1
+                for count, _ in self.failures.values()
+                if count >= self.failure_threshold
+            )
+        )
+
+    async def call(self, func, *args, key=None, method: str = None):
+        # key groups calls for circuit breaking, usually the domain UUID
+        if method is None:
+            method = getattr(func, "__name__", "unknown")
+        if key is not None and self.circuit_open(key):
+            raise CircuitOpen(
+                "%s skipped, calls for %s keep timing out" % (method, key)
+            )
+        self.queued += 1
+        exporter_desc.libvirt_exporter_rpc_queue_depth.set(self.queued)
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.queued -= 1
+            exporter_desc.libvirt_exporter_rpc_queue_depth.set(self.queued)
+        exporter_desc.libvirt_exporter_rpc_in_flight.inc()
+        started = time.monotonic()
+        future = asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+        future.add_done_callback(self.call_done)
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            exporter_desc.libvirt_exporter_rpc_timeouts.labels(method=method).inc()
+            if key is not None:
+                self.record_timeout(key)
+            raise CallTimeout(
+                "%s timed out after %ss" % (method, self.timeout)
+            ) from None
+        except libvirt.libvirtError:
+            exporter_desc.libvirt_exporter_rpc_errors.labels(method=method).inc()
+            raise
+        finally:
+            exporter_desc.libvirt_exporter_rpc_duration.labels(method=method).observe(
+                time.monotonic() - started
+            )
+        if key is not None:
+            self.record_success(key)
+        return result
+
+    def call_done(self, future):
+        self.semaphore.release()
+        exporter_desc.libvirt_exporter_rpc_in_flight.dec()
+        if future.cancelled():
+            return
+        # Nobody awaits a timed out call anymore, keep asyncio from
+        # complaining about a never retrieved exception
+        future.exception()
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,221 @@
+import logging
+import os
+import resource
+import urllib.parse
+
+import libvirt
+
+from prometheus_libvirt import exporter_desc
+
+# Scopes of QEMU domains are named machine-qemu\x2d<ID>\x2d<name>.scope
+SCOPE_PREFIX = "machine-qemu\\x2d"
+
+# cpu.stat keys in microseconds, in DomainWorker.CPU_METRICS order
+CPU_KEYS = ("usage_usec", "user_usec", "system_usec")
+
+# Files under /sys/class/net/<tap>/statistics in INTERFACE_STATS order. A tap
+# device receives what the guest sends, so rx and tx are swapped, as
+# virDomainInterfaceStats does
+INTERFACE_FILES = (
+    "tx_bytes",
+    "tx_packets",
+    "tx_errors",
+    "tx_dropped",
+    "rx_bytes",
+    "rx_packets",
+    "rx_errors",
+    "rx_dropped",
+)
+
+
+def local_uri(uri: str) -> bool:
+    # Only domains of the system instance on this host live in machine.slice,
+    # domain IDs of other connections would match the wrong scopes
+    parsed = urllib.parse.urlsplit(uri)
+    return not parsed.hostname and parsed.path == "/system"
+
+
+def raise_open_files_limit():
+    # Every domain keeps a few files open, one per counter of its interfaces
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def parse_keyed(data: bytes) -> dict:
+    # "key value" lines as in cpu.stat and memory.stat
+    values = {}
+    for line in data.splitlines():
+        key, _, value = line.partition(b" ")
+        values[key.decode()] = int(value)
+    return values
+
+
+class StatFile:
+    __slots__ = ("path", "fd")
+
+    def __init__(self, path: str):
+        self.path = path
+        # Opened on the first read and kept, None if the file can't be read
+        self.fd = None
+
+    def read(self, size: int = 8192) -> bytes:
+        # pread from offset 0 makes kernfs and sysfs generate the contents
+        # anew, no seek or reopen needed. None if the file is missing or the
+        # scope or device went away
+        try:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_RDONLY | os.O_CLOEXEC)
+            return os.pread(self.fd, size, 0)
+        except OSError:
+            self.close()
+            return None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class DomainFiles:
+    __slots__ = ("generation", "cpu_stat", "memory_stat", "net_root", "interfaces")
+
+    def __init__(self, generation, scope: str, net_root: str):
+        self.generation = generation
+        # No scope, no files: every read falls back to libvirt
+        self.cpu_stat = None
+        self.memory_stat = None
+        if scope is not None:
+            self.cpu_stat = StatFile(os.path.join(scope, "cpu.stat"))
+            self.memory_stat = StatFile(os.path.join(scope, "memory.stat"))
+        self.net_root = net_root
+        # Target device -> StatFiles in INTERFACE_FILES order
+        self.interfaces = {}
+
+    def interface(self, target_dev: str) -> tuple:
+        files = self.interfaces.get(target_dev)
+        if files is None:
+            statistics = os.path.join(self.net_root, target_dev, "statistics")
+            files = self.interfaces[target_dev] = tuple(
+                StatFile(os.path.join(statistics, name)) for name in INTERFACE_FILES
+            )
+        return files
+
+    def close(self):
+        for stat_file in (self.cpu_stat, self.memory_stat):
+            if stat_file is not None:
+                stat_file.close()
+        for files in self.interfaces.values():
+            for stat_file in files:
+                stat_file.close()
+
+
+class LocalStats:
+    __slots__ = ("cgroup_root", "net_root", "machine_slice", "scopes", "entries")
+
+    def __init__(
+        self,
+        cgroup_root: str = "/sys/fs/cgroup",
+        net_root: str = "/sys/class/net",
+        machine_slice: str = "machine.slice",
+    ):
+        self.cgroup_root = cgroup_root
+        self.net_root = net_root
+        self.machine_slice = machine_slice
+        # Domain ID -> scope directory, of the last scan
+        self.scopes = {}
+        # UUID -> DomainFiles
+        self.entries = {}
+
+    def available(self) -> bool:
+        # Only the unified hierarchy of cgroup v2 is supported
+        return os.path.exists(os.path.join(self.cgroup_root, "cgroup.controllers"))
+
+    def scan(self):
+        directory = os.path.join(self.cgroup_root, self.machine_slice)
+        scopes = {}
+        try:
+            names = os.listdir(directory)
+        except OSError as e:
+            logging.debug("No domain scopes in %s: %s", directory, e)
+            names = ()
+        for name in names:
+            if not name.startswith(SCOPE_PREFIX) or not name.endswith(".scope"):
+                continue
+            domain_id = name[len(SCOPE_PREFIX) :].partition("\\x2d")[0]
+            if domain_id.isdigit():
+                scopes[int(domain_id)] = os.path.join(directory, name)
+        self.scopes = scopes
+
+    def lookup(self, domain: libvirt.virDomain) -> DomainFiles:
+        uuid = domain.UUIDString()
+        # The ID is cached in the virDomain object and changes on every start,
+        # which is when the domain gets a new scope and tap devices
+        generation = domain.ID()
+        files = self.entries.get(uuid)
+        if files is not None and files.generation == generation:
+            return files
+        if files is not None:
+            files.close()
+        scope = None
+        if generation >= 0:
+            if generation not in self.scopes:
+                # Started since the last scan, one scan finds all new scopes
+                self.scan()
+            scope = self.scopes.get(generation)
+        files = self.entries[uuid] = DomainFiles(generation, scope, self.net_root)
+        return files
+
+    def cpu_times(self, domain: libvirt.virDomain) -> tuple:
+        # CPU, user and system time in seconds, None to ask libvirt
+        stat_file = self.lookup(domain).cpu_stat
+        data = stat_file.read() if stat_file is not None else None
+        if not data:
+            exporter_desc.libvirt_exporter_local_stats_fallbacks.labels(
+                kind="cpu"
+            ).inc()
+            return None
+        stat = parse_keyed(data)
+        return tuple(stat.get(key, 0) / 1000 / 1000 for key in CPU_KEYS)
+
+    def memory_rss(self, domain: libvirt.virDomain) -> int:
+        # Resident memory of the domain's processes in KiB, like the rss of
+        # virDomainMemoryStats, None to ask libvirt. memory.current would
+        # include the page cache, so it's anonymous plus mapped file memory
+        stat_file = self.lookup(domain).memory_stat
+        data = stat_file.read() if stat_file is not None else None
+        if not data:
+            exporter_desc.libvirt_exporter_local_stats_fallbacks.labels(
+                kind="memory"
+            ).inc()
+            return None
+        stat = parse_keyed(data)
+        return (stat.get("anon", 0) + stat.get("file_mapped", 0)) // 1024
+
+    def interface_stats(self, domain: libvirt.virDomain, target_dev: str) -> tuple:
+        # Counters in INTERFACE_STATS order, None to ask libvirt
+        values = []
+        files = self.lookup(domain)
+        # Without a scope the domain isn't running here, its device name may
+        # belong to another domain by now
+        if files.cpu_stat is not None and target_dev:
+            for stat_file in files.interface(target_dev):
+                data = stat_file.read(64)
+                if not data:
+                    break
+                values.append(int(data))
+        if len(values) != len(INTERFACE_FILES):
+            exporter_desc.libvirt_exporter_local_stats_fallbacks.labels(
+                kind="interface"
+            ).inc()
+            return None
+        return tuple(values)
+
+    def invalidate(self, uuid: str, domain: libvirt.virDomain = None):
+        files = self.entries.pop(uuid, None)
+        if files is not None:
+            files.close()
+
+    def retain(self, uuids):
+        for uuid in self.entries.keys() - set(uuids):
+            self.invalidate(uuid)
@@ -0,0 +1,60 @@
+import time
+
+import libvirt
+
+
+class MemoryStatsSupport:
+    __slots__ = ("generation", "probed_at", "keys", "period_set")
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.probed_at = 0.0
+        # memoryStats() keys the domain reported when last probed, None if it
+        # has to be probed again
+        self.keys = None
+        self.period_set = False
+
+
+class MemoryStatsCache:
+    __slots__ = ("entries", "max_age", "period", "export_absent")
+
+    def __init__(
+        self, max_age: float = 600, period: int = 0, export_absent: bool = True
+    ):
+        # UUID -> MemoryStatsSupport
+        self.entries = {}
+        # Domains are probed again after this long, a guest may load its
+        # balloon driver late
+        self.max_age = max_age
+        # Balloon stats period set on every domain once per start, 0 leaves
+        # it alone
+        self.period = period
+        # Whether stats a domain doesn't report are exported as 0
+        self.export_absent = export_absent
+
+    def lookup(self, domain: libvirt.virDomain) -> MemoryStatsSupport:
+        uuid = domain.UUIDString()
+        # Changes on every start, like DomainDescriptionCache.generation
+        generation = domain.ID()
+        support = self.entries.get(uuid)
+        if support is None or support.generation != generation:
+            support = self.entries[uuid] = MemoryStatsSupport(generation)
+        elif (
+            support.keys is not None
+            and self.max_age
+            and time.monotonic() - support.probed_at >= self.max_age
+        ):
+            support.keys = None
+        return support
+
+    @staticmethod
+    def store(support: MemoryStatsSupport, keys):
+        support.keys = frozenset(keys)
+        support.probed_at = time.monotonic()
+
+    def invalidate(self, uuid: str, domain: libvirt.virDomain = None):
+        self.entries.pop(uuid, None)
+
+    def retain(self, uuids):
+        for uuid in self.entries.keys() - set(uuids):
+            del self.entries[uuid]
@@ -0,0 +1,184 @@
+import fnmatch
+import json
+import types
+
+from prometheus_libvirt import exporter_desc, prometheus_desc
+
+
+class NullChild:
+    # Stands in for the child of a disabled family or of a series over the
+    # cap, every write is dropped
+    __slots__ = ()
+
+    @property
+    def _value(self):
+        return self
+
+    def set(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def info(self, val):
+        pass
+
+    def observe(self, amount):
+        pass
+
+
+NULL_CHILD = NullChild()
+
+
+# noinspection PyProtectedMember
+class ConfiguredMetric:
+    __slots__ = (
+        "name",
+        "metric",
+        "_labelnames",
+        "labelmap",
+        "max_series",
+        "enabled",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        metric,
+        labelnames: tuple,
+        labelmap: dict,
+        max_series: int = 0,
+    ):
+        self.name = name
+        # The metric actually exposed, None if the family is disabled
+        self.metric = metric
+        self.enabled = metric is not None
+        # Label names the workers pass, as in prometheus_desc
+        self._labelnames = labelnames
+        # Worker label name -> exposed label name, dropped labels are missing
+        self.labelmap = labelmap
+        self.max_series = max_series
+
+    def labels(self, **labelkwargs):
+        if self.metric is None:
+            return NULL_CHILD
+        labelkwargs = {
+            self.labelmap[name]: value
+            for name, value in labelkwargs.items()
+            if name in self.labelmap
+        }
+        if self.max_series and len(self.metric._metrics) >= self.max_series:
+            labelvalues = tuple(
+                str(labelkwargs[name]) for name in self.metric._labelnames
+            )
+            if labelvalues not in self.metric._metrics:
+                exporter_desc.libvirt_exporter_series_overflow.labels(
+                    metric=self.metric._name
+                ).inc()
+                return NULL_CHILD
+        return self.metric.labels(**labelkwargs)
+
+    def remove(self, *labelvalues):
+        # Label values as exposed, see series_tracker.exposed_labelvalues
+        if self.metric is None:
+            return
+        self.metric.remove(*labelvalues)
+
+
+class MetricConfig:
+    def __init__(
+        self,
+        disable: list = (),
+        labels: dict = None,
+        max_series: int = 0,
+        max_series_per_metric: dict = None,
+    ):
+        # fnmatch patterns of family names (as exposed or as attribute of
+        # prometheus_desc) to leave out, along with the libvirt calls only
+        # they need
+        self.disable = list(disable)
+        # Pattern -> {"drop": [label, ...], "rename": {label: new label}}
+        self.labels = labels or {}
+        # Series a family may have, 0 for no limit
+        self.max_series = max_series
+        self.max_series_per_metric = max_series_per_metric or {}
+
+    @classmethod
+    def load(cls, path: str, **overrides):
+        # {
+        #   "disable": ["libvirt_domain_mem_stat_hugetlb_*"],
+        #   "labels": {
+        #     "libvirt_domain_block_dev_metadata": {"drop": ["source_file"]},
+        #     "libvirt_domain_nova_metadata": {
+        #       "drop": ["user_name", "project_name"],
+        #       "rename": {"instance_name": "instance"}
+        #     }
+        #   },
+        #   "max_series": 10000,
+        #   "max_series_per_metric": {"libvirt_domain_block_dev_*": 2000}
+        # }
+        with open(path) as config_file:
+            config = json.load(config_file)
+        unknown = config.keys() - {
+            "disable",
+            "labels",
+            "max_series",
+            "max_series_per_metric",
+        }
+        if unknown:
+            raise ValueError("unknown metric config keys %s" % ", ".join(unknown))
+        config.update(overrides)
+        return cls(**config)
+
+    @staticmethod
+    def matches(pattern: str, name: str, metric) -> bool:
+        # noinspection PyProtectedMember
+        return fnmatch.fnmatchcase(name, pattern) or fnmatch.fnmatchcase(
+            metric._name, pattern
+        )
+
+    def enabled(self, name: str, metric) -> bool:
+        return not any(
+            self.matches(pattern, name, metric) for pattern in self.disable
+        )
+
+    # noinspection PyProtectedMember
+    def labelmap(self, name: str, metric) -> dict:
+        labelmap = {label: label for label in metric._labelnames}
+        for pattern, rules in self.labels.items():
+            if not self.matches(pattern, name, metric):
+                continue
+            for label in rules.get("drop", ()):
+                labelmap.pop(label, None)
+            for label, renamed in rules.get("rename", {}).items():
+                if label in labelmap:
+                    labelmap[label] = renamed
+        return labelmap
+
+    def limit(self, name: str, metric) -> int:
+        for pattern, max_series in self.max_series_per_metric.items():
+            if self.matches(pattern, name, metric):
+                return max_series
+        return self.max_series
+
+    # noinspection PyProtectedMember
+    def metric_set(self, registry=None) -> types.SimpleNamespace:
+        # Like prometheus_desc.metric_set(), but disabled families are not
+        # registered and the others carry the configured labels
+        metrics = {}
+        collected = prometheus_desc.collected_metrics(prometheus_desc)
+        for name, metric in collected.items():
+            labelmap = self.labelmap(name, metric)
+            exposed = None
+            if self.enabled(name, metric):
+                exposed = prometheus_desc.clone(
+                    metric, registry, labelnames=tuple(labelmap.values())
+                )
+            metrics[name] = ConfiguredMetric(
+                name,
+                exposed,
+                metric._labelnames,
+                labelmap,
+                self.limit(name, metric),
+            )
+        return types.SimpleNamespace(**metrics)
@@ -1,3 +1,6 @@
+import sys
+import types
+
 from prometheus_client import Gauge, Info, Counter
 
 ####
@@ -58,6 +61,28 @@ libvirt_storage_pool_available = Gauge(
     labelnames=["pool_name"],
 )
 
+####
+# Storage volumes
+####
+
+libvirt_storage_volume_capacity = Gauge(
+    namespace="libvirt",
+    subsystem="storage_volume",
+    name="capacity",
+    documentation="Logical size of the volume, in bytes",
+    unit="bytes",
+    labelnames=["pool_name", "volume_name"],
+)
+
+libvirt_storage_volume_allocation = Gauge(
+    namespace="libvirt",
+    subsystem="storage_volume",
+    name="allocation",
+    documentation="Space allocated to the volume in its pool, in bytes",
+    unit="bytes",
+    labelnames=["pool_name", "volume_name"],
+)
+
 ####
 # Domain Info
 ####
@@ -116,6 +141,42 @@ libvirt_domain_vcpus = Gauge(
     labelnames=["domain"],
 )
 
+libvirt_domain_vcpu_state = Gauge(
+    namespace="libvirt",
+    subsystem="domain_vcpu",
+    name="state",
+    documentation="State of the virtual CPU. 0: offline, 1: running, 2: blocked",
+    labelnames=["domain", "vcpu"],
+)
+
+libvirt_domain_vcpu_time = Counter(
+    namespace="libvirt",
+    subsystem="domain_vcpu",
+    name="time_seconds_total",
+    documentation="Amount of CPU time used by the virtual CPU, in seconds.",
+    labelnames=["domain", "vcpu"],
+    unit="seconds",
+)
+
+libvirt_domain_vcpu_wait = Counter(
+    namespace="libvirt",
+    subsystem="domain_vcpu",
+    name="wait_seconds_total",
+    documentation="Time the virtual CPU spent waiting for I/O, in seconds.",
+    labelnames=["domain", "vcpu"],
+    unit="seconds",
+)
+
+libvirt_domain_vcpu_delay = Counter(
+    namespace="libvirt",
+    subsystem="domain_vcpu",
+    name="delay_seconds_total",
+    documentation="Time the virtual CPU was runnable but waiting for a host CPU, "
+    "in seconds.",
+    labelnames=["domain", "vcpu"],
+    unit="seconds",
+)
+
 libvirt_domain_cpu_time = Counter(
     namespace="libvirt",
     subsystem="domain_info",
@@ -420,3 +481,208 @@ libvirt_domain_io_tx_drops = Counter(
     documentation="Number of packet transmit drops on a network interface.",
     labelnames=["domain", "dev_mac"],
 )
+
+####
+# Derived rates, only written with --derived-metrics
+####
+
+libvirt_domain_cpu_usage_percent = Gauge(
+    namespace="libvirt",
+    subsystem="domain_info",
+    name="cpu_usage_percent",
+    documentation="CPU time used by the domain between the last two samples, in "
+    "percent of its virtual CPUs.",
+    labelnames=["domain"],
+)
+
+libvirt_domain_io_rx_bytes_rate = Gauge(
+    namespace="libvirt",
+    subsystem="domain_interface",
+    name="receive_bytes_per_second",
+    documentation="Bytes received per second on a network interface between the "
+    "last two samples.",
+    labelnames=["domain", "dev_mac"],
+)
+
+libvirt_domain_io_tx_bytes_rate = Gauge(
+    namespace="libvirt",
+    subsystem="domain_interface",
+    name="transmit_bytes_per_second",
+    documentation="Bytes transmitted per second on a network interface between "
+    "the last two samples.",
+    labelnames=["domain", "dev_mac"],
+)
+
+libvirt_domain_block_dev_read_iops = Gauge(
+    namespace="libvirt",
+    subsystem="domain_block_dev",
+    name="read_operations_per_second",
+    documentation="Read operations per second from a block device between the "
+    "last two samples.",
+    labelnames=["domain", "target_dev"],
+)
+
+libvirt_domain_block_dev_write_iops = Gauge(
+    namespace="libvirt",
+    subsystem="domain_block_dev",
+    name="write_operations_per_second",
+    documentation="Write operations per second to a block device between the "
+    "last two samples.",
+    labelnames=["domain", "target_dev"],
+)
+
+####
+# Host
+####
+
+libvirt_node_metadata = Info(
+    namespace="libvirt",
+    subsystem="node",
+    name="metadata",
+    documentation="Hypervisor host hardware as reported by virNodeGetInfo.",
+    labelnames=[
+        "node",
+        "model",
+        "numa_cells",
+        "sockets_per_cell",
+        "cores_per_socket",
+        "threads_per_core",
+    ],
+)
+
+libvirt_node_cpus = Gauge(
+    namespace="libvirt",
+    subsystem="node",
+    name="cpus",
+    documentation="Active logical CPUs of the host.",
+    labelnames=["node"],
+)
+
+libvirt_node_cpu_frequency = Gauge(
+    namespace="libvirt",
+    subsystem="node",
+    name="cpu_frequency_hertz",
+    documentation="Expected CPU frequency of the host, in hertz.",
+    labelnames=["node"],
+    unit="hertz",
+)
+
+libvirt_node_cpu_time = Counter(
+    namespace="libvirt",
+    subsystem="node",
+    name="cpu_time_seconds_total",
+    documentation="CPU time of all host CPUs by mode (kernel, user, idle, "
+    "iowait), in seconds.",
+    labelnames=["node", "mode"],
+    unit="seconds",
+)
+
+libvirt_node_memory = Gauge(
+    namespace="libvirt",
+    subsystem="node",
+    name="memory_bytes",
+    documentation="Host memory by kind (total, free, buffers, cached), in bytes.",
+    labelnames=["node", "kind"],
+    unit="bytes",
+)
+
+libvirt_node_numa_free_memory = Gauge(
+    namespace="libvirt",
+    subsystem="node",
+    name="numa_free_memory_bytes",
+    documentation="Free memory of a NUMA cell, in bytes.",
+    labelnames=["node", "cell"],
+    unit="bytes",
+)
+
+libvirt_node_free_pages = Gauge(
+    namespace="libvirt",
+    subsystem="node",
+    name="free_pages",
+    documentation="Free pages of a size, hugepages included, in a NUMA cell.",
+    labelnames=["node", "cell", "page_size"],
+)
+
+libvirt_node_domains = Gauge(
+    namespace="libvirt",
+    subsystem="node",
+    name="active_domains",
+    documentation="Domains that are running, paused or suspended on the host.",
+    labelnames=["node"],
+)
+
+libvirt_node_domain_vcpus = Gauge(
+    namespace="libvirt",
+    subsystem="node",
+    name="allocated_vcpus",
+    documentation="Virtual CPUs of all active domains.",
+    labelnames=["node"],
+)
+
+libvirt_node_domain_max_memory = Gauge(
+    namespace="libvirt",
+    subsystem="node",
+    name="allocated_max_memory_bytes",
+    documentation="Maximum allowed memory of all active domains, in bytes.",
+    labelnames=["node"],
+    unit="bytes",
+)
+
+libvirt_node_domain_memory = Gauge(
+    namespace="libvirt",
+    subsystem="node",
+    name="allocated_memory_bytes",
+    documentation="Current memory of all active domains, in bytes.",
+    labelnames=["node"],
+    unit="bytes",
+)
+
+####
+# Copies for collection sweeps
+####
+
+# Metrics written by the domain, storage pool and host workers
+COLLECTED_PREFIXES = (
+    "libvirt_domain_",
+    "libvirt_storage_pool_",
+    "libvirt_storage_volume_",
+    "libvirt_node_",
+)
+
+
+def collected_metrics(metrics) -> dict:
+    # metrics is this module, a metric_set() or a MetricConfig.metric_set()
+    return {
+        name: value
+        for name, value in vars(metrics).items()
+        if name.startswith(COLLECTED_PREFIXES) and hasattr(value, "labels")
+    }
+
+
+def enabled(metrics, name: str) -> bool:
+    # Families disabled by a MetricConfig need no libvirt calls
+    return getattr(getattr(metrics, name), "enabled", True)
+
+
+# noinspection PyProtectedMember
+def clone(metric, registry=None, labelnames: tuple = None):
+    # Unpopulated copy of metric, registered in registry if one is given
+    if labelnames is None:
+        labelnames = metric._labelnames
+    return type(metric)(
+        name=metric._name,
+        documentation=metric._documentation,
+        labelnames=labelnames,
+        unit=metric._unit,
+        registry=registry,
+    )
+
+
+def metric_set(registry=None) -> types.SimpleNamespace:
+    # Copies of the collected metrics above, with the same attribute names
+    return types.SimpleNamespace(
+        **{
+            name: clone(metric, registry)
+            for name, metric in collected_metrics(sys.modules[__name__]).items()
+        }
+    )
@@ -0,0 +1,327 @@
+import asyncio
+import logging
+import math
+import os
+import socket
+import struct
+import time
+import urllib.error
+import urllib.request
+
+from prometheus_client.exposition import push_to_gateway
+
+from prometheus_libvirt import exporter_desc
+from prometheus_libvirt.debounced_writer import DebouncedWriter
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+
+def varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def length_delimited(field: int, payload: bytes) -> bytes:
+    return varint(field << 3 | 2) + varint(len(payload)) + payload
+
+
+def encode_labels(labels: tuple) -> bytes:
+    # Label messages of a TimeSeries, labels sorted by name as the remote
+    # write spec requires
+    return b"".join(
+        length_delimited(
+            1,
+            length_delimited(1, name.encode()) + length_delimited(2, value.encode()),
+        )
+        for name, value in labels
+    )
+
+
+def encode_sample(value: float, timestamp_ms: int) -> bytes:
+    # Sample {double value = 1; int64 timestamp = 2;}
+    return length_delimited(
+        2, b"\x09" + struct.pack("<d", value) + b"\x10" + varint(timestamp_ms)
+    )
+
+
+def snappy_compress(data: bytes) -> bytes:
+    # Remote write bodies are snappy block format. Without python-snappy the
+    # data goes as literals, valid for any decoder, just not smaller
+    if snappy is not None:
+        return snappy.compress(data)
+    out = bytearray(varint(len(data)))
+    for start in range(0, len(data), 65536):
+        chunk = data[start : start + 65536]
+        # Tag 61: literal whose length - 1 follows in two bytes
+        out.append(61 << 2)
+        out += struct.pack("<H", len(chunk) - 1)
+        out += chunk
+    return bytes(out)
+
+
+class Spool:
+    __slots__ = ("directory", "max_bytes", "next_seq")
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024):
+        # One file per remote write request, named by sequence number, so
+        # they are sent in order and survive restarts
+        self.directory = directory
+        # Oldest batches are dropped beyond this
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        seqs = self.pending()
+        self.next_seq = seqs[-1] + 1 if seqs else 0
+
+    def path(self, seq: int) -> str:
+        return os.path.join(self.directory, "%020d.snappy" % seq)
+
+    def pending(self) -> list:
+        return sorted(
+            int(name.partition(".")[0])
+            for name in os.listdir(self.directory)
+            if name.endswith(".snappy")
+        )
+
+    def append(self, body: bytes):
+        path = self.path(self.next_seq)
+        self.next_seq += 1
+        # Renamed into place, a crash never leaves half a batch to send
+        with open(path + ".tmp", "wb") as spool_file:
+            spool_file.write(body)
+        os.replace(path + ".tmp", path)
+        self.trim()
+
+    def trim(self):
+        sizes = []
+        for seq in self.pending():
+            try:
+                sizes.append((seq, os.path.getsize(self.path(seq))))
+            except FileNotFoundError:
+                # Sent meanwhile
+                pass
+        total = sum(size for _, size in sizes)
+        for seq, size in sizes[:-1]:
+            if total <= self.max_bytes:
+                break
+            self.remove(seq)
+            total -= size
+            exporter_desc.libvirt_exporter_push_batches.labels(result="dropped").inc()
+            logging.warning(
+                "Push spool over %d bytes, dropped batch %d", self.max_bytes, seq
+            )
+        exporter_desc.libvirt_exporter_push_spool_bytes.set(total)
+
+    def read(self, seq: int) -> bytes:
+        with open(self.path(seq), "rb") as spool_file:
+            return spool_file.read()
+
+    def remove(self, seq: int):
+        try:
+            os.remove(self.path(seq))
+        except FileNotFoundError:
+            pass
+
+
+def default_labels() -> dict:
+    # What a scrape would have attached as target labels
+    return {"job": "libvirt", "instance": socket.gethostname()}
+
+
+class RemoteWriter(DebouncedWriter):
+    def __init__(
+        self,
+        registry,
+        url: str,
+        spool: Spool,
+        labels: dict = None,
+        max_samples: int = 2000,
+        min_interval: float = 5,
+        timeout: float = 30,
+        max_backoff: float = 300,
+    ):
+        # Sweeps finishing closer together than min_interval share one capture
+        super().__init__(min_interval)
+        self.registry = registry
+        self.url = url
+        self.spool = spool
+        # Added to every series, a metric's own label of the same name wins
+        if labels is None:
+            labels = default_labels()
+        self.labels = labels
+        # Series per remote write request
+        self.max_samples = max_samples
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        # (sample name, label items) -> encoded labels, of the last capture
+        self.encoded = {}
+        self.spooled = None
+
+    def capture(self, timestamp_ms: int) -> list:
+        # Encoded TimeSeries of every sample, taken on the loop so no sweep
+        # changes the metrics halfway through
+        encoded = {}
+        series = []
+        for family in self.registry.collect():
+            for sample in family.samples:
+                if sample.name.endswith("_created") or math.isnan(sample.value):
+                    continue
+                key = (sample.name, tuple(sample.labels.items()))
+                labels = self.encoded.get(key)
+                if labels is None:
+                    labels = encode_labels(
+                        sorted(
+                            {
+                                **self.labels,
+                                **sample.labels,
+                                "__name__": sample.name,
+                            }.items()
+                        )
+                    )
+                encoded[key] = labels
+                series.append(
+                    length_delimited(
+                        1, labels + encode_sample(sample.value, timestamp_ms)
+                    )
+                )
+        # Only series still present are kept
+        self.encoded = encoded
+        return series
+
+    def spool_batches(self, series: list):
+        for start in range(0, len(series), self.max_samples):
+            self.spool.append(
+                snappy_compress(b"".join(series[start : start + self.max_samples]))
+            )
+
+    def send(self, body: bytes) -> int:
+        request = urllib.request.Request(
+            self.url,
+            data=body,
+            method="POST",
+            headers={
+                "Content-Encoding": "snappy",
+                "Content-Type": "application/x-protobuf",
+                "User-Agent": "prometheus_libvirt",
+                "X-Prometheus-Remote-Write-Version": "0.1.0",
+            },
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    async def run(self):
+        self.spooled = asyncio.Event()
+        # Batches left over from before a restart go first
+        self.spooled.set()
+        sender = asyncio.get_running_loop().create_task(self.sender())
+        try:
+            await super().run()
+        finally:
+            sender.cancel()
+
+    async def write(self) -> bool:
+        series = self.capture(int(time.time() * 1000))
+        await asyncio.to_thread(self.spool_batches, series)
+        self.spooled.set()
+        return True
+
+    async def sender(self):
+        backoff = 1.0
+        while True:
+            await self.spooled.wait()
+            self.spooled.clear()
+            for seq in await asyncio.to_thread(self.spool.pending):
+                while not await self.send_batch(seq):
+                    exporter_desc.libvirt_exporter_push_batches.labels(
+                        result="failed"
+                    ).inc()
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+                backoff = 1.0
+            await asyncio.to_thread(self.spool.trim)
+
+    async def send_batch(self, seq: int) -> bool:
+        # False if the batch has to be sent again
+        try:
+            body = await asyncio.to_thread(self.spool.read, seq)
+        except FileNotFoundError:
+            # Dropped by Spool.trim meanwhile
+            return True
+        try:
+            status = await asyncio.to_thread(self.send, body)
+        except OSError as e:
+            logging.warning("Remote write to %s failed: %s", self.url, e)
+            return False
+        if 200 <= status < 300:
+            result = "sent"
+            exporter_desc.libvirt_exporter_push_last_success.set_to_current_time()
+        elif status == 429 or status >= 500:
+            return False
+        else:
+            # Sending it again won't help, as the spec says
+            result = "rejected"
+            logging.warning(
+                "Remote write to %s rejected batch %d with %s", self.url, seq, status
+            )
+        exporter_desc.libvirt_exporter_push_batches.labels(result=result).inc()
+        await asyncio.to_thread(self.spool.remove, seq)
+        return True
+
+
+class PushgatewayWriter(DebouncedWriter):
+    def __init__(
+        self,
+        registry,
+        gateway: str,
+        labels: dict = None,
+        min_interval: float = 5,
+        timeout: float = 30,
+        max_backoff: float = 300,
+    ):
+        super().__init__(min_interval)
+        self.registry = registry
+        self.gateway = gateway
+        if labels is None:
+            labels = default_labels()
+        # job goes into the URL, the rest into the grouping key
+        labels = dict(labels)
+        self.job = labels.pop("job", "libvirt")
+        self.grouping_key = labels
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+
+    async def write(self) -> bool:
+        # The Pushgateway only keeps the latest state, so there is nothing
+        # to spool: a failed push is retried with whatever is current then
+        backoff = 1.0
+        while True:
+            try:
+                # Formats the registry in the thread, like render_live
+                await asyncio.to_thread(
+                    push_to_gateway,
+                    self.gateway,
+                    self.job,
+                    self.registry,
+                    self.grouping_key,
+                    self.timeout,
+                )
+            except OSError as e:
+                logging.warning("Push to %s failed: %s", self.gateway, e)
+                exporter_desc.libvirt_exporter_push_batches.labels(
+                    result="failed"
+                ).inc()
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            exporter_desc.libvirt_exporter_push_batches.labels(result="sent").inc()
+            exporter_desc.libvirt_exporter_push_last_success.set_to_current_time()
+            return True
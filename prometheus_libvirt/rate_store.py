@@ -0,0 +1,48 @@
+import array
+
+
+class RateStore:
+    __slots__ = ("slots", "free", "timestamps", "values")
+
+    def __init__(self):
+        # UUID -> {series key: index into timestamps and values}
+        self.slots = {}
+        # Indexes of forgotten series, reused before the arrays grow
+        self.free = []
+        # Previous sample of every series, 16 bytes each
+        self.timestamps = array.array("d")
+        self.values = array.array("d")
+
+    def rate(self, uuid: str, key: tuple, timestamp: float, value: float):
+        # Increase per second since the previous sample of key, None for the
+        # first sample
+        slots = self.slots.setdefault(uuid, {})
+        index = slots.get(key)
+        if index is None:
+            if self.free:
+                index = self.free.pop()
+                self.timestamps[index] = timestamp
+                self.values[index] = value
+            else:
+                index = len(self.values)
+                self.timestamps.append(timestamp)
+                self.values.append(value)
+            slots[key] = index
+            return None
+        elapsed = timestamp - self.timestamps[index]
+        previous = self.values[index]
+        self.timestamps[index] = timestamp
+        self.values[index] = value
+        if elapsed <= 0:
+            return None
+        if value < previous:
+            # Counter reset, e.g. the domain restarted, it counted up from 0
+            previous = 0
+        return (value - previous) / elapsed
+
+    def forget(self, uuid: str, domain=None):
+        self.free.extend(self.slots.pop(uuid, {}).values())
+
+    def retain(self, uuids):
+        for uuid in self.slots.keys() - set(uuids):
+            self.forget(uuid)
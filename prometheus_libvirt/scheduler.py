@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import random
+
+from prometheus_libvirt import exporter_desc
+
+
+class Job:
+    __slots__ = ("groups", "interval", "func", "task", "succeeded_at")
+
+    def __init__(self, groups: tuple, interval: float, func):
+        self.groups = groups
+        self.interval = interval
+        # Coroutine function, called without arguments on every tick
+        self.func = func
+        self.task = None
+        # loop.time() of the last successful run, of the start before that
+        self.succeeded_at = None
+
+
+class Scheduler:
+    __slots__ = ("jobs", "jitter", "host", "listeners")
+
+    def __init__(self, jitter: float = 0.1, host: str = ""):
+        self.jobs = []
+        # Fraction of the interval each tick is randomly moved by, spreads
+        # the load of groups sharing an interval
+        self.jitter = jitter
+        # Target the jobs collect from, empty with a single target
+        self.host = host
+        # Called without arguments whenever a run finished, failed or not
+        self.listeners = []
+
+    def add(self, groups: tuple, interval: float, func):
+        self.jobs.append(Job(groups, interval, func))
+
+    async def run(self):
+        await asyncio.gather(*(self.run_job(job) for job in self.jobs))
+
+    def stale_jobs(self, factor: float = 3) -> list:
+        # Jobs without a successful run for factor intervals
+        now = asyncio.get_running_loop().time()
+        return [
+            job
+            for job in self.jobs
+            if job.succeeded_at is not None
+            and now - job.succeeded_at > factor * job.interval
+        ]
+
+    async def run_job(self, job: Job):
+        loop = asyncio.get_running_loop()
+        job.succeeded_at = loop.time()
+        # Start at a random offset so jobs don't all fire together
+        deadline = loop.time() + random.uniform(0, job.interval * self.jitter)
+        while True:
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
+            now = loop.time()
+            if job.task is not None and not job.task.done():
+                for group in job.groups:
+                    exporter_desc.libvirt_exporter_scheduler_overruns.labels(
+                        group=group, host=self.host
+                    ).inc()
+            else:
+                for group in job.groups:
+                    exporter_desc.libvirt_exporter_scheduler_lag.labels(
+                        group=group, host=self.host
+                    ).set(now - deadline)
+                job.task = loop.create_task(self.execute(job))
+            deadline += job.interval * (
+                1 + random.uniform(-self.jitter, self.jitter)
+            )
+            if deadline < now:
+                # Way behind, e.g. after the host was suspended, don't burst
+                deadline = now + job.interval
+
+    async def execute(self, job: Job):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            await job.func()
+        except Exception:
+            logging.exception("Collection of %s failed", ", ".join(job.groups))
+            for group in job.groups:
+                exporter_desc.libvirt_exporter_scheduler_errors.labels(
+                    group=group, host=self.host
+                ).inc()
+        else:
+            job.succeeded_at = loop.time()
+            for group in job.groups:
+                exporter_desc.libvirt_exporter_scheduler_duration.labels(
+                    group=group, host=self.host
+                ).set(loop.time() - started)
+        for listener in self.listeners:
+            listener()
@@ -0,0 +1,75 @@
+import time
+
+
+class DomainSnapshot:
+    __slots__ = ("uuid", "name", "resolved_at", "series")
+
+    def __init__(self, uuid: str, name: str):
+        self.uuid = uuid
+        self.name = name
+        self.resolved_at = time.monotonic()
+        # Key (group, device) -> (last values written, values of the metric
+        # children they went to), or None for series without a value
+        self.series = {}
+
+    def write(self, key: tuple, values: tuple, resolve):
+        # resolve() returns the child._value of each series of key, it is only
+        # called the first time key is written
+        entry = self.series.get(key)
+        if entry is None:
+            children = resolve()
+            for child, value in zip(children, values):
+                child.set(value)
+        else:
+            previous, children = entry
+            if previous == values:
+                return
+            for child, value, last in zip(children, values, previous):
+                if value != last:
+                    child.set(value)
+        self.series[key] = (values, children)
+
+    def touch(self, key: tuple, resolve):
+        # For series that only carry labels, e.g. Info without info()
+        if key not in self.series:
+            resolve()
+            self.series[key] = None
+
+
+class SnapshotCache:
+    __slots__ = ("snapshots", "max_age", "metrics")
+
+    def __init__(self, max_age: float = 60):
+        # UUID -> DomainSnapshot
+        self.snapshots = {}
+        # Children are resolved again, and every value rewritten, once a
+        # snapshot gets this old. It keeps SeriesTracker stamps fresh and
+        # brings back series removed behind our back, so it has to stay
+        # below the stale series grace. 0 keeps snapshots until invalidated
+        self.max_age = max_age
+        # The metrics the children were resolved from
+        self.metrics = None
+
+    def lookup(self, metrics, uuid: str, name: str) -> DomainSnapshot:
+        if metrics is not self.metrics:
+            # e.g. a new metric_set() per on-scrape sweep
+            self.snapshots.clear()
+            self.metrics = metrics
+        snapshot = self.snapshots.get(uuid)
+        if (
+            snapshot is None
+            or snapshot.name != name
+            or (
+                self.max_age
+                and time.monotonic() - snapshot.resolved_at >= self.max_age
+            )
+        ):
+            snapshot = self.snapshots[uuid] = DomainSnapshot(uuid, name)
+        return snapshot
+
+    def invalidate(self, uuid: str, domain=None):
+        self.snapshots.pop(uuid, None)
+
+    def retain(self, uuids):
+        for uuid in self.snapshots.keys() - set(uuids):
+            del self.snapshots[uuid]
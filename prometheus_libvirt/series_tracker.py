@@ -0,0 +1,75 @@
+import logging
+import time
+
+from prometheus_libvirt import exporter_desc, prometheus_desc
+
+
+# noinspection PyProtectedMember
+def exposed_labelvalues(metric, labelkwargs: dict) -> tuple:
+    # Label values of the series labelkwargs write to. A ConfiguredMetric's
+    # labelmap leaves out dropped labels, so worker label sets differing only
+    # in those share one series
+    names = getattr(metric, "labelmap", None) or metric._labelnames
+    return tuple(str(labelkwargs[name]) for name in names)
+
+
+class TrackedMetric:
+    __slots__ = ("metric", "seen")
+
+    def __init__(self, metric):
+        self.metric = metric
+        # Exposed label values -> time.monotonic() of the last labels() call
+        self.seen = {}
+
+    def labels(self, **labelkwargs):
+        self.seen[exposed_labelvalues(self.metric, labelkwargs)] = time.monotonic()
+        return self.metric.labels(**labelkwargs)
+
+
+class SeriesTracker:
+    def __init__(self, metrics=prometheus_desc, grace: float = 900, host: str = ""):
+        # Series nobody wrote for this long are removed from the metric
+        self.grace = grace
+        # Target the series are collected from, empty with a single target
+        self.host = host
+        # Same attribute names as metrics, so workers can use the tracker
+        # in place of prometheus_desc
+        for name, metric in prometheus_desc.collected_metrics(metrics).items():
+            if prometheus_desc.enabled(metrics, name):
+                metric = TrackedMetric(metric)
+            setattr(self, name, metric)
+
+    def tracked_metrics(self) -> dict:
+        return {
+            name: value
+            for name, value in vars(self).items()
+            if isinstance(value, TrackedMetric)
+        }
+
+    async def collect_garbage(self) -> int:
+        deadline = time.monotonic() - self.grace
+        evicted = 0
+        for name, tracked in self.tracked_metrics().items():
+            stale = [
+                labelvalues
+                for labelvalues, seen in tracked.seen.items()
+                if seen < deadline
+            ]
+            for labelvalues in stale:
+                del tracked.seen[labelvalues]
+                try:
+                    tracked.metric.remove(*labelvalues)
+                except KeyError:
+                    pass
+            if stale:
+                exporter_desc.libvirt_exporter_stale_series_evicted.labels(
+                    metric=name
+                ).inc(len(stale))
+                evicted += len(stale)
+        if evicted:
+            logging.info("Removed %d stale series", evicted)
+        tracked = sum(len(metric.seen) for metric in self.tracked_metrics().values())
+        exporter_desc.libvirt_exporter_stale_series_tracked.labels(
+            host=self.host
+        ).set(tracked)
+        return evicted
@@ -0,0 +1,367 @@
+import array
+import asyncio
+import hashlib
+import importlib
+import logging
+import multiprocessing
+import pickle
+import time
+
+from prometheus_client.metrics_core import Metric
+from prometheus_client.registry import Collector
+
+from prometheus_libvirt import exporter_desc, prometheus_desc
+from prometheus_libvirt.debounced_writer import DebouncedWriter
+
+# Families whose series every shard sends for its own domains, added up
+SUMMED_FAMILIES = frozenset(
+    metric._name
+    for metric in (
+        prometheus_desc.libvirt_node_domains,
+        prometheus_desc.libvirt_node_domain_vcpus,
+        prometheus_desc.libvirt_node_domain_max_memory,
+        prometheus_desc.libvirt_node_domain_memory,
+    )
+)
+
+# exporter_desc metrics only the supervisor writes, the shard processes send
+# all others
+SUPERVISOR_METRICS = (
+    exporter_desc.libvirt_exporter_shard_restarts,
+    exporter_desc.libvirt_exporter_shard_series,
+    exporter_desc.libvirt_exporter_shard_batch_bytes,
+    exporter_desc.libvirt_exporter_push_batches,
+    exporter_desc.libvirt_exporter_push_spool_bytes,
+    exporter_desc.libvirt_exporter_push_last_success,
+)
+
+
+def shard_metrics() -> list:
+    # The exporter_desc metrics a shard process sends
+    return [
+        metric
+        for name, metric in vars(exporter_desc).items()
+        if name.startswith("libvirt_exporter_") and metric not in SUPERVISOR_METRICS
+    ]
+
+
+class Shard:
+    __slots__ = ("index", "count")
+
+    def __init__(self, index: int, count: int):
+        self.index = index
+        self.count = count
+
+    @property
+    def primary(self) -> bool:
+        # Host wide series, e.g. storage pools, come from the first shard only
+        return self.index == 0
+
+    def owns(self, uuid: str) -> bool:
+        # Not crc32 like ConnectionPool.slot, the domains of a shard would all
+        # land on the same connection whenever the two counts share a factor
+        digest = hashlib.blake2b(uuid.encode(), digest_size=4).digest()
+        return int.from_bytes(digest, "little") % self.count == self.index
+
+
+class ShardMetrics(Collector):
+    def __init__(self, shard: Shard, label: str = "shard"):
+        self.shard = shard
+        self.label = label
+        self.metrics = shard_metrics()
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        # The exporter's own series of this process, told apart from the
+        # other shards' by the shard label
+        index = str(self.shard.index)
+        for metric in self.metrics:
+            for family in metric.collect():
+                family.samples = [
+                    sample._replace(labels={**sample.labels, self.label: index})
+                    for sample in family.samples
+                ]
+                yield family
+
+
+class SeriesEncoder:
+    __slots__ = ("families", "ids", "values", "next_id")
+
+    def __init__(self):
+        # Families whose metadata was sent
+        self.families = set()
+        # (sample name, label items) -> series id
+        self.ids = {}
+        # Series id -> value last sent
+        self.values = {}
+        self.next_id = 0
+
+    def batch(self, registry) -> bytes:
+        # Everything that changed since the previous batch: new families and
+        # series are described once, values go as two packed arrays
+        families = []
+        definitions = []
+        ids = array.array("I")
+        values = array.array("d")
+        seen = set()
+        for family in registry.collect():
+            if family.name not in self.families:
+                self.families.add(family.name)
+                families.append(
+                    (family.name, family.documentation, family.type, family.unit)
+                )
+            for sample in family.samples:
+                key = (sample.name, tuple(sample.labels.items()))
+                series_id = self.ids.get(key)
+                if series_id is None:
+                    series_id = self.ids[key] = self.next_id
+                    self.next_id += 1
+                    definitions.append((series_id, family.name) + key)
+                seen.add(series_id)
+                if self.values.get(series_id) != sample.value:
+                    self.values[series_id] = sample.value
+                    ids.append(series_id)
+                    values.append(sample.value)
+        removed = []
+        if len(seen) != len(self.ids):
+            for key, series_id in list(self.ids.items()):
+                if series_id not in seen:
+                    del self.ids[key]
+                    del self.values[series_id]
+                    removed.append(series_id)
+        return pickle.dumps(
+            (families, definitions, removed, ids.tobytes(), values.tobytes()),
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+
+
+class ShardSeries:
+    __slots__ = ("families", "series")
+
+    def __init__(self):
+        # Family name -> (documentation, type, unit)
+        self.families = {}
+        # Series id -> [family name, sample name, labels, value]
+        self.series = {}
+
+    def apply(self, data: bytes):
+        families, definitions, removed, id_bytes, value_bytes = pickle.loads(data)
+        for name, documentation, family_type, unit in families:
+            self.families[name] = (documentation, family_type, unit)
+        for series_id, family_name, sample_name, labels in definitions:
+            self.series[series_id] = [family_name, sample_name, dict(labels), 0.0]
+        for series_id in removed:
+            del self.series[series_id]
+        ids = array.array("I")
+        ids.frombytes(id_bytes)
+        values = array.array("d")
+        values.frombytes(value_bytes)
+        for series_id, value in zip(ids, values):
+            self.series[series_id][3] = value
+
+    def clear(self):
+        self.families.clear()
+        self.series.clear()
+
+
+class ShardWriter(DebouncedWriter):
+    __slots__ = ("registry", "connection", "encoder")
+
+    def __init__(self, registry, connection, min_interval: float = 1):
+        super().__init__(min_interval)
+        self.registry = registry
+        # Write end of the pipe to the supervisor
+        self.connection = connection
+        self.encoder = SeriesEncoder()
+
+    async def write(self) -> bool:
+        # Encoded on the loop, so no sweep changes the metrics halfway
+        # through. Sent even when empty, the supervisor takes it as a sign
+        # of life
+        data = self.encoder.batch(self.registry)
+        try:
+            await asyncio.to_thread(self.connection.send_bytes, data)
+        except OSError:
+            # The supervisor is gone
+            return False
+        return True
+
+
+def process_main(entry: str, index: int, count: int, connection, *args):
+    # Runs in the spawned process, entry is "module:function"
+    module_name, _, function_name = entry.partition(":")
+    function = getattr(importlib.import_module(module_name), function_name)
+    function(Shard(index, count), connection, *args)
+
+
+class ShardProcess:
+    __slots__ = (
+        "index",
+        "process",
+        "connection",
+        "series",
+        "fresh",
+        "started_at",
+        "received_at",
+        "backoff",
+    )
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        # Read end of the pipe from the process
+        self.connection = None
+        # Kept while the process restarts, until its replacement sends the
+        # first batch
+        self.series = ShardSeries()
+        self.fresh = False
+        self.started_at = None
+        self.received_at = None
+        self.backoff = 1.0
+
+
+class ShardSupervisor(Collector):
+    def __init__(
+        self,
+        count: int,
+        entry: str,
+        args: tuple = (),
+        stale_after: float = 60,
+        max_backoff: float = 60,
+    ):
+        self.shards = [ShardProcess(index) for index in range(count)]
+        # "module:function" called in every process with the Shard, the write
+        # end of its pipe and args
+        self.entry = entry
+        self.args = args
+        # A shard without a batch for this long is reported by problems()
+        self.stale_after = stale_after
+        self.max_backoff = max_backoff
+        # spawn, not fork: the supervisor runs an event loop and libvirt's
+        # event implementation, neither survives a fork
+        self.context = multiprocessing.get_context("spawn")
+        # Called without arguments whenever a batch was merged
+        self.listeners = []
+
+    def describe(self):
+        # Families come and go with the shards' batches
+        return []
+
+    def collect(self):
+        # Families of all shards merged into one. A series several shards
+        # send, e.g. a domain both collected while one of them restarted, is
+        # taken from the first shard, except the host's allocation totals:
+        # every shard sums up its own domains
+        families = {}
+        # (sample name, label items) -> index in its family's samples
+        positions = {}
+        for shard in self.shards:
+            for family_name, sample_name, labels, value in list(
+                shard.series.series.values()
+            ):
+                merged = families.get(family_name)
+                if merged is None:
+                    documentation, family_type, unit = shard.series.families[
+                        family_name
+                    ]
+                    merged = families[family_name] = Metric(
+                        family_name, documentation, family_type, unit
+                    )
+                key = (sample_name, tuple(labels.items()))
+                position = positions.get(key)
+                if position is None:
+                    positions[key] = len(merged.samples)
+                    merged.add_sample(sample_name, labels, value)
+                elif family_name in SUMMED_FAMILIES:
+                    sample = merged.samples[position]
+                    merged.samples[position] = sample._replace(
+                        value=sample.value + value
+                    )
+        return families.values()
+
+    def start(self, shard: ShardProcess):
+        reader, writer = self.context.Pipe(duplex=False)
+        shard.process = self.context.Process(
+            target=process_main,
+            args=(self.entry, shard.index, len(self.shards), writer) + self.args,
+            name="prometheus_libvirt shard %d" % shard.index,
+            daemon=True,
+        )
+        shard.process.start()
+        # The child holds its own copy now
+        writer.close()
+        shard.connection = reader
+        shard.fresh = True
+        shard.started_at = time.monotonic()
+        asyncio.get_running_loop().add_reader(reader.fileno(), self.receive, shard)
+        logging.info("Started shard %d as pid %s", shard.index, shard.process.pid)
+
+    def receive(self, shard: ShardProcess):
+        try:
+            data = shard.connection.recv_bytes()
+        except (EOFError, OSError):
+            # The process exited, supervise() restarts it
+            self.close(shard)
+            return
+        if shard.fresh:
+            # First batch of a restarted process, it describes all its series
+            shard.series.clear()
+            shard.fresh = False
+            shard.backoff = 1.0
+        shard.series.apply(data)
+        shard.received_at = time.monotonic()
+        exporter_desc.libvirt_exporter_shard_batch_bytes.labels(
+            shard=shard.index
+        ).set(len(data))
+        exporter_desc.libvirt_exporter_shard_series.labels(shard=shard.index).set(
+            len(shard.series.series)
+        )
+        for listener in self.listeners:
+            listener()
+
+    def close(self, shard: ShardProcess):
+        if shard.connection is not None:
+            asyncio.get_running_loop().remove_reader(shard.connection.fileno())
+            shard.connection.close()
+            shard.connection = None
+
+    async def supervise(self, interval: float = 1):
+        for shard in self.shards:
+            self.start(shard)
+        while True:
+            await asyncio.sleep(interval)
+            for shard in self.shards:
+                if shard.process.is_alive():
+                    continue
+                if time.monotonic() - shard.started_at < shard.backoff:
+                    continue
+                logging.warning(
+                    "Shard %d exited with %s, restarting",
+                    shard.index,
+                    shard.process.exitcode,
+                )
+                self.close(shard)
+                shard.process.close()
+                shard.backoff = min(shard.backoff * 2, self.max_backoff)
+                exporter_desc.libvirt_exporter_shard_restarts.labels(
+                    shard=shard.index
+                ).inc()
+                # Only this shard's series are replaced, once its new
+                # process sends them
+                self.start(shard)
+
+    def problems(self) -> list:
+        problems = []
+        now = time.monotonic()
+        for shard in self.shards:
+            if shard.process is None:
+                continue
+            if not shard.process.is_alive():
+                problems.append("shard %d is not running" % shard.index)
+            elif now - (shard.received_at or shard.started_at) > self.stale_after:
+                problems.append(
+                    "shard %d sent nothing for %gs" % (shard.index, self.stale_after)
+                )
+        return problems
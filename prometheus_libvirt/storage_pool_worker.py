@@ -1,47 +1,67 @@
 import asyncio
-import logging
 
 import libvirt
 
-from prometheus_libvirt import prometheus_desc
+from prometheus_libvirt import exporter_desc, prometheus_desc
+from prometheus_libvirt.libvirt_executor import LibvirtExecutor
 
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="[%(asctime)s] p%(process)s {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s",
-)
-
 class StoragePoolWorker:
     def __init__(
             self,
             conn: libvirt.virConnect,
+            metrics=prometheus_desc,
+            executor: LibvirtExecutor = None,
+            host: str = "",
     ):
         self.conn = conn
+        # Target the worker collects from, empty with a single target
+        self.host = host
+        if executor is None:
+            executor = LibvirtExecutor()
+        self.executor = executor
+        # prometheus_desc itself or a prometheus_desc.metric_set() copy
+        self.metrics = metrics
 
-    async def run(self):
-        while True:
-            pool_list = self.conn.listAllStoragePools(0)
+    async def sweep(self) -> int:
+        if not any(
+                prometheus_desc.enabled(self.metrics, name)
+                for name in prometheus_desc.collected_metrics(self.metrics)
+                if name.startswith("libvirt_storage_pool_")
+        ):
+            # Every storage pool family is disabled
+            return 0
+        with exporter_desc.libvirt_exporter_sweep_duration.labels(
+                worker="storage_pool", host=self.host
+        ).time():
+            pool_list = await self.executor.call(self.conn.listAllStoragePools, 0)
             workers = [self.storage_pool_worker(pool) for pool in pool_list]
             await asyncio.gather(*workers, return_exceptions=False)
-            await asyncio.sleep(5)
+        exporter_desc.libvirt_exporter_sweep_objects.labels(
+            worker="storage_pool", host=self.host
+        ).set(len(pool_list))
+        exporter_desc.libvirt_exporter_sweep_last_success.labels(
+            worker="storage_pool", host=self.host
+        ).set_to_current_time()
+        return len(pool_list)
 
     async def storage_pool_worker(self, pool: libvirt.virStoragePool):
         pool_name = pool.name()
-        pool_info = pool.info()
+        pool_info = await self.executor.call(pool.info, key=pool.UUIDString())
         pool_uuid = pool.UUIDString()
-        prometheus_desc.libvirt_storage_pool_metadata.labels(
+        self.metrics.libvirt_storage_pool_metadata.labels(
             pool_name=pool_name,
             pool_uuid=pool_uuid
         )
-        prometheus_desc.libvirt_storage_pool_state.labels(
+        self.metrics.libvirt_storage_pool_state.labels(
             pool_name=pool_name
         ).set(int(pool_info[0]))
-        prometheus_desc.libvirt_storage_pool_capacity.labels(
+        self.metrics.libvirt_storage_pool_capacity.labels(
             pool_name=pool_name
         ).set(int(pool_info[1]))
-        prometheus_desc.libvirt_storage_pool_allocation.labels(
+        self.metrics.libvirt_storage_pool_allocation.labels(
             pool_name=pool_name
         ).set(int(pool_info[2]))
-        prometheus_desc.libvirt_storage_pool_available.labels(
+        self.metrics.libvirt_storage_pool_available.labels(
             pool_name=pool_name
         ).set(int(pool_info[3]))
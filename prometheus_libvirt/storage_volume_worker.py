@@ -0,0 +1,107 @@
+import asyncio
+import logging
+
+import libvirt
+
+from prometheus_libvirt import exporter_desc, prometheus_desc
+from prometheus_libvirt.libvirt_executor import LibvirtExecutor
+from prometheus_libvirt.volume_inventory import VolumeInventory
+
+
+class StorageVolumeWorker:
+    __slots__ = ("conn", "inventory", "metrics", "executor", "batch_size", "host")
+
+    def __init__(
+        self,
+        conn: libvirt.virConnect,
+        inventory: VolumeInventory = None,
+        metrics=prometheus_desc,
+        executor: LibvirtExecutor = None,
+        batch_size: int = 256,
+        host: str = "",
+    ):
+        self.conn = conn
+        # Target the worker collects from, empty with a single target
+        self.host = host
+        if executor is None:
+            executor = LibvirtExecutor()
+        self.executor = executor
+        if inventory is None:
+            inventory = VolumeInventory(conn, executor=executor, host=host)
+        self.inventory = inventory
+        # prometheus_desc itself or a prometheus_desc.metric_set() copy
+        self.metrics = metrics
+        # Volumes whose info() is read in one executor call
+        self.batch_size = batch_size
+
+    async def sweep(self) -> int:
+        if not any(
+            prometheus_desc.enabled(self.metrics, name)
+            for name in prometheus_desc.collected_metrics(self.metrics)
+            if name.startswith("libvirt_storage_volume_")
+        ):
+            return 0
+        with exporter_desc.libvirt_exporter_sweep_duration.labels(
+            worker="storage_volume", host=self.host
+        ).time():
+            # Inactive pools can't list their volumes
+            pool_list = await self.executor.call(
+                self.conn.listAllStoragePools,
+                libvirt.VIR_CONNECT_LIST_STORAGE_POOLS_ACTIVE,
+            )
+            self.inventory.retain(pool.UUIDString() for pool in pool_list)
+            counts = await asyncio.gather(
+                *(self.pool_worker(pool) for pool in pool_list)
+            )
+        exporter_desc.libvirt_exporter_sweep_objects.labels(
+            worker="storage_volume", host=self.host
+        ).set(sum(counts))
+        exporter_desc.libvirt_exporter_sweep_last_success.labels(
+            worker="storage_volume", host=self.host
+        ).set_to_current_time()
+        return sum(counts)
+
+    async def pool_worker(self, pool: libvirt.virStoragePool) -> int:
+        pool_name = pool.name()
+        pool_uuid = pool.UUIDString()
+        volumes = await self.inventory.lookup(pool)
+        batches = [
+            volumes[start : start + self.batch_size]
+            for start in range(0, len(volumes), self.batch_size)
+        ]
+        # Batches run in parallel on the executor threads
+        results = await asyncio.gather(
+            *(
+                self.executor.call(
+                    self.volume_infos, batch, key=pool_uuid, method="volumeInfo"
+                )
+                for batch in batches
+            )
+        )
+        for batch, infos in zip(batches, results):
+            for volume, info in zip(batch, infos):
+                if isinstance(info, libvirt.libvirtError):
+                    # Most likely deleted since the pool was listed
+                    logging.debug(
+                        "Volume %s of pool %s: %s", volume.name(), pool_name, info
+                    )
+                    self.inventory.invalidate(pool_uuid)
+                    continue
+                self.metrics.libvirt_storage_volume_capacity.labels(
+                    pool_name=pool_name, volume_name=volume.name()
+                ).set(info[1])
+                self.metrics.libvirt_storage_volume_allocation.labels(
+                    pool_name=pool_name, volume_name=volume.name()
+                ).set(info[2])
+        return len(volumes)
+
+    @staticmethod
+    def volume_infos(volumes: list) -> list:
+        # Runs on an executor thread, one call per batch rather than per volume
+        infos = []
+        for volume in volumes:
+            try:
+                infos.append(volume.info())
+            except libvirt.libvirtError as e:
+                infos.append(e)
+        return infos
@@ -0,0 +1,54 @@
+import socket
+import urllib.parse
+
+from prometheus_client import CollectorRegistry
+from prometheus_client.metrics_core import Metric
+from prometheus_client.registry import Collector
+
+from prometheus_libvirt import prometheus_desc
+
+
+def target_host(uri: str) -> str:
+    # qemu:///system and friends are the local host
+    return urllib.parse.urlsplit(uri).hostname or socket.gethostname()
+
+
+class Target:
+    __slots__ = ("uri", "host", "registry", "versions_info")
+
+    def __init__(self, uri: str):
+        self.uri = uri
+        self.host = target_host(uri)
+        # Holds the target's series without the host label, also what
+        # /metrics?target= serves
+        self.registry = CollectorRegistry(auto_describe=True)
+        self.versions_info = prometheus_desc.clone(
+            prometheus_desc.libvirt_versions_info, self.registry
+        )
+
+
+class MultiTargetCollector(Collector):
+    def __init__(self, targets: list, label: str = "host"):
+        self.targets = targets
+        self.label = label
+
+    def describe(self):
+        # Families come and go with the targets' collectors
+        return []
+
+    def collect(self):
+        # Same named families of all targets merged into one, told apart by
+        # the host label
+        families = {}
+        for target in self.targets:
+            for family in target.registry.collect():
+                merged = families.get(family.name)
+                if merged is None:
+                    merged = families[family.name] = Metric(
+                        family.name, family.documentation, family.type, family.unit
+                    )
+                merged.samples.extend(
+                    sample._replace(labels={**sample.labels, self.label: target.host})
+                    for sample in family.samples
+                )
+        return families.values()
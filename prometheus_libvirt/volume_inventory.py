@@ -0,0 +1,122 @@
+import logging
+import time
+
+import libvirt
+
+from prometheus_libvirt import exporter_desc
+from prometheus_libvirt.libvirt_executor import LibvirtExecutor
+
+
+class VolumeInventory:
+    __slots__ = (
+        "conn",
+        "executor",
+        "volumes",
+        "listed_at",
+        "stale",
+        "callback_ids",
+        "refresh_interval",
+        "host",
+    )
+
+    def __init__(
+        self,
+        conn: libvirt.virConnect,
+        executor: LibvirtExecutor = None,
+        refresh_interval: float = 600,
+        host: str = "",
+    ):
+        self.conn = conn
+        # Target the pools are on, empty with a single target
+        self.host = host
+        if executor is None:
+            executor = LibvirtExecutor()
+        self.executor = executor
+        # Pool UUID -> virStorageVol handles of its last listing
+        self.volumes = {}
+        self.listed_at = {}
+        # Pools to list again on their next lookup, set by pool events
+        self.stale = set()
+        self.callback_ids = []
+        # Pools are listed again after this long even without an event, as
+        # volumes created or deleted through libvirt don't send any. 0 only
+        # lists on events
+        self.refresh_interval = refresh_interval
+
+    def start(self):
+        try:
+            self.register_callbacks()
+        except libvirt.libvirtError as e:
+            logging.warning(
+                "No storage pool events, volumes are listed every %ss: %s",
+                self.refresh_interval,
+                e,
+            )
+
+    def register_callbacks(self):
+        self.deregister_callbacks()
+        for event_id, callback in (
+            (libvirt.VIR_STORAGE_POOL_EVENT_ID_LIFECYCLE, self.lifecycle_callback),
+            (libvirt.VIR_STORAGE_POOL_EVENT_ID_REFRESH, self.refresh_callback),
+        ):
+            self.callback_ids.append(
+                self.conn.storagePoolEventRegisterAny(None, event_id, callback, None)
+            )
+
+    def deregister_callbacks(self):
+        for callback_id in self.callback_ids:
+            try:
+                self.conn.storagePoolEventDeregisterAny(callback_id)
+            except libvirt.libvirtError:
+                pass
+        self.callback_ids.clear()
+
+    def reconnected(self, index: int):
+        # Callbacks and volume handles died with the old connection
+        self.start()
+        self.volumes.clear()
+        self.listed_at.clear()
+
+    def lifecycle_callback(self, conn, pool, event, detail, opaque):
+        self.invalidate(pool.UUIDString())
+
+    def refresh_callback(self, conn, pool, opaque):
+        self.invalidate(pool.UUIDString())
+
+    def invalidate(self, uuid: str):
+        self.stale.add(uuid)
+
+    async def lookup(self, pool: libvirt.virStoragePool) -> list:
+        uuid = pool.UUIDString()
+        listed_at = self.listed_at.get(uuid)
+        if listed_at is None:
+            reason = "new"
+        elif uuid in self.stale:
+            reason = "event"
+        elif (
+            self.refresh_interval
+            and time.monotonic() - listed_at >= self.refresh_interval
+        ):
+            reason = "interval"
+        else:
+            return self.volumes[uuid]
+        self.stale.discard(uuid)
+        pool_name = pool.name()
+        started = time.monotonic()
+        volumes = await self.executor.call(pool.listAllVolumes, 0, key=uuid)
+        self.volumes[uuid] = volumes
+        self.listed_at[uuid] = time.monotonic()
+        exporter_desc.libvirt_exporter_volume_refresh_duration.labels(
+            pool=pool_name, host=self.host
+        ).set(self.listed_at[uuid] - started)
+        exporter_desc.libvirt_exporter_volume_refreshes.labels(
+            pool=pool_name, reason=reason, host=self.host
+        ).inc()
+        return volumes
+
+    def retain(self, uuids):
+        # Drops pools that were deleted or stopped
+        for uuid in self.volumes.keys() - set(uuids):
+            del self.volumes[uuid]
+            del self.listed_at[uuid]
+            self.stale.discard(uuid)
@@ -1,9 +1,48 @@
 import asyncio
+import gzip
+import http.server
+import threading
+import time
 
 import libvirt
+import pytest
+from prometheus_client import CollectorRegistry, generate_latest
 
-from prometheus_libvirt import prometheus_desc
-from prometheus_libvirt.domain_worker import DomainWorker
+from benchmarks.fake_connection import FakeConnection
+from prometheus_libvirt.__main__ import Exporter, health_response, parse_args
+from prometheus_libvirt import exporter_desc, prometheus_desc
+from prometheus_libvirt.collector import LibvirtCollector
+from prometheus_libvirt.connection_pool import ConnectionPool
+from prometheus_libvirt import domain_metadata
+from prometheus_libvirt.domain_allocations import DomainAllocations
+from prometheus_libvirt.domain_description import (
+    DomainDescription,
+    DomainDescriptionCache,
+    Interface,
+)
+from prometheus_libvirt.domain_inventory import DomainInventory
+from prometheus_libvirt.domain_worker import STATS_GROUPS, DomainWorker
+from prometheus_libvirt.exposition import ExpositionCache, Snapshot
+from prometheus_libvirt.http_server import HttpServer
+from prometheus_libvirt.host_worker import HostWorker
+from prometheus_libvirt.libvirt_executor import CallTimeout, CircuitOpen, LibvirtExecutor
+from prometheus_libvirt.local_stats import INTERFACE_FILES, LocalStats
+from prometheus_libvirt.memory_stats import MemoryStatsCache
+from prometheus_libvirt.metric_config import MetricConfig
+from prometheus_libvirt.push import RemoteWriter, Spool, snappy_compress
+from prometheus_libvirt.scheduler import Scheduler
+from prometheus_libvirt.rate_store import RateStore
+from prometheus_libvirt.series_snapshot import SnapshotCache
+from prometheus_libvirt.series_tracker import SeriesTracker
+from prometheus_libvirt.shard import (
+    SeriesEncoder,
+    Shard,
+    ShardMetrics,
+    ShardSupervisor,
+)
+from prometheus_libvirt.storage_pool_worker import StoragePoolWorker
+from prometheus_libvirt.storage_volume_worker import StorageVolumeWorker
+from prometheus_libvirt.target import MultiTargetCollector, Target
 
 # test_same_but_in_async.py - Generated by CodiumAI
 
@@ -70,7 +109,7 @@ class TestDomainWorker:
         mem_worker_mock.return_value = asyncio.sleep(0)
 
         domain_worker = DomainWorker(conn)
-        asyncio.run(domain_worker.run())
+        asyncio.run(domain_worker.sweep())
 
         conn.listAllDomains.assert_called_once_with(0)
         worker_mock.assert_has_calls([mocker.call(domain1), mocker.call(domain2)])
@@ -126,7 +165,7 @@ class TestDomainWorker:
         worker_mock.return_value = asyncio.sleep(0)
 
         domain_worker = DomainWorker(conn)
-        asyncio.run(domain_worker.run())
+        asyncio.run(domain_worker.sweep())
 
         conn.listAllDomains.assert_called_once_with(0)
         worker_mock.assert_not_called()
@@ -220,3 +259,1314 @@ class TestDomainWorker:
         assert prometheus_desc.libvirt_domain_mem_stat_hugetlb_pgfail.labels.called_once_with(domain="test_domain")
         assert prometheus_desc.libvirt_domain_mem_stat_rss.labels.called_once_with(domain="test_domain")
 
+
+
+class TestBulkDomainStats:
+    record = {
+        "state.state": 1,
+        "vcpu.current": 2,
+        "cpu.time": 10000000000,
+        "cpu.user": 4000000000,
+        "cpu.system": 6000000000,
+        "balloon.current": 512,
+        "balloon.maximum": 1024,
+        "balloon.swap_in": 8,
+        "net.count": 1,
+        "net.0.name": "tap0",
+        "net.0.rx.bytes": 100,
+        "net.0.tx.pkts": 7,
+        "block.count": 1,
+        "block.0.name": "vda",
+        "block.0.rd.bytes": 4096,
+        "block.0.wr.times": 2000000000,
+    }
+    xml = (
+        "<domain><metadata><meta/></metadata><devices>"
+        "<interface><mac address='52:54:00:00:00:01'/><target dev='tap0'/></interface>"
+        "<disk type='file'><driver name='qemu' type='qcow2'/><source file='/a.qcow2'/>"
+        "<target dev='vda' bus='virtio'/></disk>"
+        "</devices></domain>"
+    )
+
+    def make_domain(self, mocker, name):
+        domain = mocker.Mock()
+        domain.name.return_value = name
+        domain.UUIDString.return_value = name + "-uuid"
+        domain.XMLDesc.return_value = self.xml
+        return domain
+
+    def test_bulk_sweep(self, mocker):
+        conn = mocker.Mock()
+        domain = self.make_domain(mocker, "bulk_domain")
+        conn.getAllDomainStats.return_value = [(domain, self.record)]
+
+        domain_worker = DomainWorker(conn, stats_groups=tuple(STATS_GROUPS))
+        asyncio.run(domain_worker.sweep())
+
+        # The probe for unsupported groups delivers the records too
+        assert conn.getAllDomainStats.call_count == 1
+        domain.info.assert_not_called()
+        domain.getCPUStats.assert_not_called()
+        domain.memoryStats.assert_not_called()
+        domain.interfaceStats.assert_not_called()
+        domain.blockStatsFlags.assert_not_called()
+        labels = {"domain": "bulk_domain"}
+        assert prometheus_desc.libvirt_domain_state.labels(**labels)._value.get() == 1
+        assert prometheus_desc.libvirt_domain_vcpus.labels(**labels)._value.get() == 2
+        assert prometheus_desc.libvirt_domain_cpu_time.labels(**labels)._value.get() == 10.0
+        assert prometheus_desc.libvirt_domain_cpu_user_time.labels(**labels)._value.get() == 4.0
+        assert prometheus_desc.libvirt_domain_max_memory_bytes.labels(**labels)._value.get() == 1024 * 1024
+        assert prometheus_desc.libvirt_domain_mem_stat_swap_in_bytes.labels(**labels)._value.get() == 8 * 1024
+        assert prometheus_desc.libvirt_domain_io_rx_bytes.labels(dev_mac="52:54:00:00:00:01", **labels)._value.get() == 100
+        assert prometheus_desc.libvirt_domain_io_tx_packets.labels(dev_mac="52:54:00:00:00:01", **labels)._value.get() == 7
+        assert prometheus_desc.libvirt_domain_block_dev_read_bytes.labels(target_dev="vda", **labels)._value.get() == 4096
+        assert prometheus_desc.libvirt_domain_block_dev_write_total_seconds.labels(target_dev="vda", **labels)._value.get() == 2.0
+
+    def test_bulk_sweep_unsupported_group(self, mocker):
+        def get_all_domain_stats(stats, flags):
+            if stats & libvirt.VIR_DOMAIN_STATS_BLOCK:
+                raise libvirt.libvirtError("unsupported")
+            return [(domain, self.record)]
+
+        mocker.patch.object(
+            libvirt.libvirtError, "get_error_code", return_value=libvirt.VIR_ERR_NO_SUPPORT
+        )
+        conn = mocker.Mock()
+        domain = self.make_domain(mocker, "bulk_fallback_domain")
+        domain.isActive.return_value = True
+        domain.info.return_value = (1, 1024, 512, 2)
+        domain.memoryStats.return_value = {}
+        domain.interfaceStats.return_value = (0,) * 8
+        domain.blockStatsFlags.return_value = {"rd_bytes": 512}
+        conn.getAllDomainStats.side_effect = get_all_domain_stats
+        conn.domainListGetStats.side_effect = (
+            lambda domains, stats, flags: get_all_domain_stats(stats, flags)
+        )
+        conn.listAllDomains.return_value = [domain]
+
+        domain_worker = DomainWorker(conn, stats_groups=("cpu", "block"))
+        asyncio.run(domain_worker.sweep())
+
+        assert domain_worker.bulk_groups == ("cpu",)
+        domain.getCPUStats.assert_not_called()
+        domain.blockStatsFlags.assert_called_once_with("vda")
+        assert prometheus_desc.libvirt_domain_block_dev_read_bytes.labels(
+            domain="bulk_fallback_domain", target_dev="vda"
+        )._value.get() == 512
+
+
+class TestDomainInventory:
+    def make_domain(self, mocker, uuid):
+        domain = mocker.Mock()
+        domain.UUIDString.return_value = uuid
+        return domain
+
+    def test_resync(self, mocker):
+        conn = mocker.Mock()
+        domain1 = self.make_domain(mocker, "1234")
+        domain2 = self.make_domain(mocker, "5678")
+        conn.listAllDomains.return_value = [domain1, domain2]
+        listener = mocker.Mock()
+
+        inventory = DomainInventory(conn, resync_interval=0)
+        inventory.listeners.append(listener)
+        asyncio.run(inventory.run())
+
+        assert conn.domainEventRegisterAny.call_count == 4
+        assert inventory.domains == {"1234": domain1, "5678": domain2}
+        listener.assert_has_calls([mocker.call("1234", domain1), mocker.call("5678", domain2)])
+
+        conn.listAllDomains.return_value = [domain2]
+        asyncio.run(inventory.resync())
+
+        assert inventory.domains == {"5678": domain2}
+        listener.assert_called_with("1234", None)
+
+    def test_lifecycle_events(self, mocker):
+        inventory = DomainInventory(mocker.Mock())
+        domain = self.make_domain(mocker, "1234")
+
+        inventory.lifecycle_callback(None, domain, libvirt.VIR_DOMAIN_EVENT_DEFINED, 0, None)
+        assert inventory.domains == {"1234": domain}
+
+        domain.isPersistent.return_value = True
+        inventory.lifecycle_callback(None, domain, libvirt.VIR_DOMAIN_EVENT_STOPPED, 0, None)
+        assert inventory.domains == {"1234": domain}
+
+        inventory.lifecycle_callback(None, domain, libvirt.VIR_DOMAIN_EVENT_UNDEFINED, 0, None)
+        assert inventory.domains == {}
+
+        domain.isPersistent.return_value = False
+        inventory.lifecycle_callback(None, domain, libvirt.VIR_DOMAIN_EVENT_STARTED, 0, None)
+        inventory.lifecycle_callback(None, domain, libvirt.VIR_DOMAIN_EVENT_STOPPED, 0, None)
+        assert inventory.domains == {}
+
+    def test_worker_reads_inventory(self):
+        registry = CollectorRegistry()
+        conn = FakeConnection(domains=2, nics=0, disks=0)
+        inventory = DomainInventory(conn)
+        domain = conn.domains[0]
+        inventory.domains[domain.UUIDString()] = domain
+
+        domain_worker = DomainWorker(
+            conn, inventory=inventory, metrics=prometheus_desc.metric_set(registry)
+        )
+        assert asyncio.run(domain_worker.sweep(("state",))) == 1
+        assert conn.rpcs["listAllDomains"] == 0
+        assert registry.get_sample_value(
+            "libvirt_domain_state", {"domain": "domain-0"}
+        ) is not None
+        assert registry.get_sample_value(
+            "libvirt_domain_state", {"domain": "domain-1"}
+        ) is None
+
+
+class TestDomainDescriptionCache:
+    xml = (
+        "<domain><metadata><meta/></metadata><devices>"
+        "<interface><mac address='52:54:00:00:00:01'/><target dev='tap0'/></interface>"
+        "<disk type='file'><driver name='qemu' type='qcow2'/><source file='/a.qcow2'/>"
+        "<target dev='vda' bus='virtio'/></disk>"
+        "<disk type='file'><driver name='qemu' type='raw'/><target dev='sda' bus='sata'/></disk>"
+        "</devices></domain>"
+    )
+
+    def test_describe(self, mocker):
+        domain = mocker.Mock()
+        domain.UUIDString.return_value = "1234"
+        domain.ID.return_value = 1
+        domain.XMLDesc.return_value = self.xml
+        hits = exporter_desc.libvirt_exporter_xml_cache_hits._value.get()
+        misses = exporter_desc.libvirt_exporter_xml_cache_misses._value.get()
+
+        cache = DomainDescriptionCache()
+        describe = DomainWorker(mocker.Mock(), descriptions=cache).describe
+        description = asyncio.run(describe(domain))
+        assert asyncio.run(describe(domain)) is description
+        assert cache.lookup(domain) is description
+        domain.XMLDesc.assert_called_once_with(0)
+        assert description.interfaces == (Interface(target_dev="tap0", mac="52:54:00:00:00:01"),)
+        assert [disk.target_dev for disk in description.disks] == ["vda", "sda"]
+        assert description.disks[0].source_file == "/a.qcow2"
+        assert description.disks[1].source_file is None
+        assert description.metadata == {}
+        assert exporter_desc.libvirt_exporter_xml_cache_hits._value.get() == hits + 2
+        assert exporter_desc.libvirt_exporter_xml_cache_misses._value.get() == misses + 1
+
+        domain.ID.return_value = 2
+        assert cache.lookup(domain) is None
+        assert cache.store(domain, self.xml) is not description
+
+        cache.invalidate("1234")
+        assert cache.lookup(domain) is None
+
+        # Each target counts its own entries
+        DomainDescriptionCache(host="node2").store(domain, self.xml)
+        entries = exporter_desc.libvirt_exporter_xml_cache_entries
+        assert entries.labels(host="node2")._value.get() == 1
+        assert entries.labels(host="")._value.get() == 0
+
+
+class TestLibvirtCollector:
+    def test_collect(self, mocker):
+        conn = mocker.Mock()
+        pool = mocker.Mock()
+        pool.name.return_value = "scrape_pool"
+        pool.UUIDString.return_value = "1234"
+        pool.info.return_value = (2, 100, 40, 60)
+        conn.listAllStoragePools.return_value = [pool]
+        storage_pool_worker = StoragePoolWorker(conn)
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        collector = LibvirtCollector(loop, [storage_pool_worker], window=60)
+        registry = CollectorRegistry()
+        registry.register(collector)
+        first = generate_latest(registry)
+        second = generate_latest(registry)
+        loop.call_soon_threadsafe(loop.stop)
+
+        conn.listAllStoragePools.assert_called_once_with(0)
+        assert first == second
+        assert b'libvirt_storage_pool_capacity_bytes{pool_name="scrape_pool"} 100.0' in first
+        assert storage_pool_worker.metrics is not prometheus_desc
+
+    def test_sweep_longer_than_window(self):
+        sweeps = []
+
+        class SlowWorker:
+            metrics = None
+
+            async def sweep(self):
+                sweeps.append(1)
+                await asyncio.sleep(0.4)
+
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        collector = LibvirtCollector(loop, [SlowWorker()], window=0.1)
+        first = threading.Thread(target=lambda: list(collector.collect()))
+        first.start()
+        # Arrives while the first sweep runs, past the window
+        time.sleep(0.2)
+        list(collector.collect())
+        first.join()
+        assert len(sweeps) == 1
+        # A scrape after the sweep finished and the window passed sweeps again
+        time.sleep(0.2)
+        list(collector.collect())
+        loop.call_soon_threadsafe(loop.stop)
+        assert len(sweeps) == 2
+
+
+class TestScheduler:
+    def test_overrun(self):
+        runs = []
+
+        async def slow_job():
+            runs.append(1)
+            await asyncio.sleep(0.25)
+
+        async def main():
+            scheduler = Scheduler(jitter=0)
+            scheduler.add(("test_slow",), 0.1, slow_job)
+            try:
+                await asyncio.wait_for(scheduler.run(), 0.55)
+            except asyncio.TimeoutError:
+                pass
+
+        overruns = exporter_desc.libvirt_exporter_scheduler_overruns.labels(group="test_slow", host="")
+        before = overruns._value.get()
+        asyncio.run(main())
+
+        assert len(runs) == 2
+        assert overruns._value.get() - before >= 2
+        assert exporter_desc.libvirt_exporter_scheduler_duration.labels(group="test_slow", host="")._value.get() >= 0.25
+
+    def test_error(self):
+        async def failing_job():
+            raise libvirt.libvirtError("error")
+
+        async def main():
+            scheduler = Scheduler(jitter=0)
+            scheduler.add(("test_failing",), 0.1, failing_job)
+            try:
+                await asyncio.wait_for(scheduler.run(), 0.25)
+            except asyncio.TimeoutError:
+                pass
+
+        asyncio.run(main())
+
+        assert exporter_desc.libvirt_exporter_scheduler_errors.labels(group="test_failing", host="")._value.get() >= 2
+
+
+class TestSeriesTracker:
+    def test_collect_garbage(self, mocker):
+        metrics = prometheus_desc.metric_set()
+        tracker = SeriesTracker(metrics, grace=60)
+        monotonic = mocker.patch("prometheus_libvirt.series_tracker.time.monotonic")
+        monotonic.return_value = 1000
+        tracker.libvirt_domain_state.labels(domain="gone").set(5)
+        tracker.libvirt_storage_pool_state.labels(pool_name="gone").set(1)
+        monotonic.return_value = 1050
+        tracker.libvirt_domain_state.labels(domain="alive").set(1)
+
+        monotonic.return_value = 1070
+        evicted = asyncio.run(tracker.collect_garbage())
+
+        assert evicted == 2
+        assert list(metrics.libvirt_domain_state._metrics) == [("alive",)]
+        assert not metrics.libvirt_storage_pool_state._metrics
+        assert exporter_desc.libvirt_exporter_stale_series_evicted.labels(
+            metric="libvirt_domain_state"
+        )._value.get() >= 1
+        assert exporter_desc.libvirt_exporter_stale_series_tracked.labels(
+            host=""
+        )._value.get() == 1
+
+    def test_dropped_label_changes(self, mocker):
+        config = MetricConfig(
+            labels={"libvirt_domain_block_dev_metadata": {"drop": ["source_file"]}}
+        )
+        registry = CollectorRegistry()
+        tracker = SeriesTracker(config.metric_set(registry), grace=60)
+        monotonic = mocker.patch("prometheus_libvirt.series_tracker.time.monotonic")
+        labels = dict(
+            domain="snapshotted",
+            disk_type="file",
+            target_dev="vda",
+            target_bus="virtio",
+            driver_name="qemu",
+            driver_type="qcow2",
+            driver_discard="",
+        )
+        monotonic.return_value = 1000
+        tracker.libvirt_domain_block_dev_metadata.labels(
+            source_file="/base.qcow2", **labels
+        ).info({})
+        # An external snapshot moved the disk to an overlay
+        monotonic.return_value = 1050
+        tracker.libvirt_domain_block_dev_metadata.labels(
+            source_file="/overlay.qcow2", **labels
+        ).info({})
+
+        monotonic.return_value = 1070
+        assert asyncio.run(tracker.collect_garbage()) == 0
+        assert registry.get_sample_value(
+            "libvirt_domain_block_dev_metadata_info_info", labels
+        ) == 1
+
+
+class TestLibvirtExecutor:
+    def test_call(self):
+        executor = LibvirtExecutor(max_workers=2)
+        assert asyncio.run(executor.call(sum, (1, 2))) == 3
+
+    def test_timeout_opens_circuit(self):
+        release = threading.Event()
+        executor = LibvirtExecutor(max_workers=3, timeout=0.05, failure_threshold=2, reset_after=60)
+
+        async def main():
+            for _ in range(2):
+                with pytest.raises(CallTimeout):
+                    await executor.call(release.wait, key="stuck")
+            with pytest.raises(CircuitOpen):
+                await executor.call(release.wait, key="stuck")
+            # Other domains are not affected, but only one thread is left
+            assert await executor.call(sum, (1, 2), key="healthy") == 3
+
+        try:
+            asyncio.run(main())
+        finally:
+            release.set()
+        assert exporter_desc.libvirt_exporter_rpc_timeouts.labels(method="wait")._value.get() >= 2
+
+
+class TestConnectionPool:
+    def make_pool(self, mocker, size):
+        connections = [mocker.Mock(name="conn%d" % i) for i in range(size * 2)]
+        mocker.patch("libvirt.open", side_effect=connections)
+        pool = ConnectionPool("test:///default", size=size)
+        pool.open()
+        return pool, connections
+
+    def test_bind(self, mocker):
+        pool, connections = self.make_pool(mocker, 2)
+        assert exporter_desc.libvirt_exporter_connections.labels(host="")._value.get() == 2
+        connections[0].registerCloseCallback.assert_called_once_with(pool.close_callback, 0)
+        # Connection level calls go to the primary connection
+        pool.listAllDomains(0)
+        connections[0].listAllDomains.assert_called_once_with(0)
+
+        domain = mocker.Mock()
+        domain.UUIDString.return_value = "1234"
+        domain.connect.return_value = connections[0]
+        domain.ID.return_value = 1
+        connections[1].lookupByUUIDString.return_value.ID.return_value = 1
+        assert pool.slot("1234") == 1
+        assert pool.bound(domain) is None
+        handle = pool.bind(domain)
+        assert handle is connections[1].lookupByUUIDString.return_value
+        assert pool.bound(domain) is handle
+        pool.retain([])
+        assert pool.bound(domain) is None
+
+    def test_bound_after_restart(self, mocker):
+        pool, connections = self.make_pool(mocker, 2)
+        domain = mocker.Mock()
+        domain.UUIDString.return_value = "1234"
+        domain.connect.return_value = connections[0]
+        domain.ID.return_value = 1
+        stale, fresh = mocker.Mock(), mocker.Mock()
+        stale.ID.return_value = 1
+        fresh.ID.return_value = 2
+        connections[1].lookupByUUIDString.side_effect = [stale, fresh]
+        assert pool.bind(domain) is stale
+        assert pool.bound(domain) is stale
+
+        # Listed again after a restart, with its new ID
+        domain.ID.return_value = 2
+        assert pool.bound(domain) is None
+        assert pool.bind(domain) is fresh
+        assert pool.bound(domain) is fresh
+
+    def test_reconnect(self, mocker):
+        pool, connections = self.make_pool(mocker, 1)
+        listener = mocker.Mock()
+        pool.listeners.append(listener)
+        reconnects = exporter_desc.libvirt_exporter_connection_reconnects._value.get()
+
+        async def main():
+            pool.close_callback(connections[0], libvirt.VIR_CONNECT_CLOSE_REASON_ERROR, 0)
+            assert exporter_desc.libvirt_exporter_connections.labels(host="")._value.get() == 0
+            with pytest.raises(libvirt.libvirtError):
+                pool.primary()
+            while pool.reconnecting:
+                await asyncio.sleep(0.1)
+
+        asyncio.run(main())
+        assert pool.primary() is connections[1]
+        listener.assert_called_once_with(0)
+        assert exporter_desc.libvirt_exporter_connection_reconnects._value.get() == reconnects + 1
+
+
+class TestMultiTarget:
+    def test_host_label(self):
+        targets = [Target("qemu+tls://node1/system"), Target("qemu+tls://node2/system")]
+        assert [target.host for target in targets] == ["node1", "node2"]
+        for index, target in enumerate(targets):
+            metrics = prometheus_desc.metric_set(target.registry)
+            metrics.libvirt_domain_state.labels(domain="domain%d" % index).set(1)
+
+        registry = CollectorRegistry()
+        registry.register(MultiTargetCollector(targets))
+        output = generate_latest(registry).decode()
+        assert output.count("# TYPE libvirt_domain_state gauge") == 1
+        assert 'libvirt_domain_state{domain="domain0",host="node1"} 1.0' in output
+        assert 'libvirt_domain_state{domain="domain1",host="node2"} 1.0' in output
+        # A single target is served without the host label
+        assert 'libvirt_domain_state{domain="domain1"} 1.0' in generate_latest(targets[1].registry).decode()
+
+
+class TestExpositionCache:
+    def test_response(self):
+        registry = CollectorRegistry()
+        metrics = prometheus_desc.metric_set(registry)
+        metrics.libvirt_domain_state.labels(domain="cached_domain").set(1)
+        exposition = ExpositionCache(registry)
+        for rendering in exposition.render():
+            rendering.compress()
+
+        status, headers, body = exposition.response(accept_encoding="gzip, deflate")
+        headers = dict(headers)
+        assert status == "200 OK"
+        assert headers["Content-Encoding"] == "gzip"
+        assert b'libvirt_domain_state{domain="cached_domain"} 1.0' in gzip.decompress(body)
+
+        # Nothing changed, the rendering keeps its validators
+        etag = headers["ETag"]
+        exposition.render()
+        status, _, body = exposition.response(if_none_match=etag)
+        assert (status, body) == ("304 Not Modified", b"")
+
+        metrics.libvirt_domain_state.labels(domain="cached_domain").set(2)
+        exposition.render()
+        status, headers, body = exposition.response(
+            accept="application/openmetrics-text; version=1.0.0", if_none_match=etag
+        )
+        assert status == "200 OK"
+        assert dict(headers)["Content-Type"].startswith("application/openmetrics-text")
+        assert body.endswith(b"# EOF\n")
+
+    def test_snapshot(self):
+        registry = CollectorRegistry()
+        metrics = prometheus_desc.metric_set(registry)
+        metrics.libvirt_domain_state.labels(domain="cached_domain").set(1)
+        exposition = ExpositionCache(registry)
+        snapshot = Snapshot(registry)
+        # A sweep finishing while the snapshot is formatted in a thread
+        metrics.libvirt_domain_state.labels(domain="cached_domain").set(2)
+        metrics.libvirt_domain_state.labels(domain="new_domain").set(1)
+
+        text, _ = exposition.render(snapshot)
+        assert b'libvirt_domain_state{domain="cached_domain"} 1.0' in text.body
+        assert b"new_domain" not in text.body
+
+
+class TestHttpServer:
+    def test_keep_alive(self):
+        async def handler(request):
+            return 200, [("Content-Type", "text/plain")], request.path.encode()
+
+        async def main():
+            server = HttpServer(handler, host="127.0.0.1", port=0)
+            await server.start()
+            port = server.server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            responses = []
+            for path in ("/metrics", "/healthz"):
+                writer.write(b"GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n" % path.encode())
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+                responses.append((head, await reader.readexactly(length)))
+            writer.write(b"POST / HTTP/1.0\r\nContent-Length: 2\r\n\r\nhi")
+            # HTTP/1.0 without keep-alive, the server closes after responding
+            last = await reader.read()
+            writer.close()
+            await server.close()
+            return responses, last
+
+        responses, last = asyncio.run(main())
+        assert [body for _, body in responses] == [b"/metrics", b"/healthz"]
+        assert all(head.startswith(b"HTTP/1.1 200 OK") for head, _ in responses)
+        assert b"Connection: keep-alive" in responses[0][0]
+        assert last.startswith(b"HTTP/1.1 200 OK")
+        assert b"Connection: close" in last
+
+
+class TestSelfInstrumentation:
+    def test_domain_errors(self, mocker):
+        conn = mocker.Mock()
+        domain = TestBulkDomainStats().make_domain(mocker, "instrumented_domain")
+        domain.isActive.return_value = True
+        domain.info.return_value = (1, 1024, 512, 2)
+        domain.memoryStats.side_effect = libvirt.libvirtError("no balloon")
+        domain.memoryStats.__name__ = "memoryStats"
+        conn.listAllDomains.return_value = [domain]
+        errors = exporter_desc.libvirt_exporter_domain_errors.labels(domain="instrumented_domain", host="")
+        rpc_errors = exporter_desc.libvirt_exporter_rpc_errors.labels(method="memoryStats")
+        errors_before, rpc_errors_before = errors._value.get(), rpc_errors._value.get()
+
+        domain_worker = DomainWorker(conn)
+        assert asyncio.run(domain_worker.sweep(("balloon",))) == 1
+
+        assert errors._value.get() == errors_before + 1
+        assert rpc_errors._value.get() == rpc_errors_before + 1
+        assert exporter_desc.libvirt_exporter_sweep_objects.labels(worker="domain", host="")._value.get() == 1
+        assert exporter_desc.libvirt_exporter_sweep_last_success.labels(worker="domain", host="")._value.get() > 0
+        registry = CollectorRegistry()
+        registry.register(exporter_desc.libvirt_exporter_helper_duration)
+        assert registry.get_sample_value(
+            "libvirt_exporter_helper_duration_seconds_count", {"helper": "mem"}
+        ) >= 1
+
+    def test_domain_errors_removed(self, mocker):
+        conn = mocker.Mock()
+        domain = TestBulkDomainStats().make_domain(mocker, "removed_domain")
+        domain.isActive.return_value = True
+        domain.info.return_value = (1, 1024, 512, 2)
+        domain.memoryStats.side_effect = libvirt.libvirtError("no balloon")
+        conn.listAllDomains.return_value = [domain]
+        registry = CollectorRegistry()
+        registry.register(exporter_desc.libvirt_exporter_domain_errors)
+
+        domain_worker = DomainWorker(conn)
+        asyncio.run(domain_worker.sweep(("balloon",)))
+        labels = {"domain": "removed_domain", "host": ""}
+        assert registry.get_sample_value(
+            "libvirt_exporter_domain_errors_total", labels
+        ) >= 1
+        conn.listAllDomains.return_value = []
+        asyncio.run(domain_worker.sweep(("balloon",)))
+        assert registry.get_sample_value(
+            "libvirt_exporter_domain_errors_total", labels
+        ) is None
+
+
+    def test_domain_errors_per_host(self, mocker):
+        registry = CollectorRegistry()
+        registry.register(exporter_desc.libvirt_exporter_domain_errors)
+        workers = []
+        for host in ("node1", "node2"):
+            conn = mocker.Mock()
+            domain = TestBulkDomainStats().make_domain(mocker, "same_name")
+            domain.isActive.return_value = True
+            domain.info.return_value = (1, 1024, 512, 2)
+            domain.memoryStats.side_effect = libvirt.libvirtError("no balloon")
+            conn.listAllDomains.return_value = [domain]
+            workers.append(DomainWorker(conn, host=host))
+            asyncio.run(workers[-1].sweep(("balloon",)))
+
+        # The domain is gone from node1 only
+        workers[0].conn.listAllDomains.return_value = []
+        asyncio.run(workers[0].sweep(("balloon",)))
+        assert registry.get_sample_value(
+            "libvirt_exporter_domain_errors_total", {"domain": "same_name", "host": "node1"}
+        ) is None
+        assert registry.get_sample_value(
+            "libvirt_exporter_domain_errors_total", {"domain": "same_name", "host": "node2"}
+        ) >= 1
+        assert exporter_desc.libvirt_exporter_sweep_objects.labels(
+            worker="domain", host="node1"
+        )._value.get() == 0
+        assert exporter_desc.libvirt_exporter_sweep_objects.labels(
+            worker="domain", host="node2"
+        )._value.get() == 1
+
+class TestFakeConnection:
+    def test_bulk_and_per_domain_agree(self):
+        conn = FakeConnection(domains=3, nics=2, disks=1)
+        per_domain = prometheus_desc.metric_set()
+        bulk = prometheus_desc.metric_set()
+        asyncio.run(DomainWorker(conn, metrics=per_domain).sweep())
+        assert "getAllDomainStats" not in conn.rpcs
+        assert conn.rpcs["interfaceStats"] == 6
+        # Shared by the helpers, one of each per domain
+        assert conn.rpcs["info"] == 3
+        assert conn.rpcs["isActive"] == 3
+
+        conn.rpcs.clear()
+        asyncio.run(DomainWorker(conn, stats_groups=tuple(STATS_GROUPS), metrics=bulk).sweep())
+        assert "interfaceStats" not in conn.rpcs
+        for name in ("libvirt_domain_state", "libvirt_domain_cpu_time", "libvirt_domain_mem_stat_rss"):
+            assert getattr(bulk, name).labels(domain="domain-2")._value.get() == getattr(
+                per_domain, name
+            ).labels(domain="domain-2")._value.get()
+
+
+class TestMetricConfig:
+    def test_labels_and_limits(self):
+        config = MetricConfig(
+            disable=["libvirt_domain_block_dev_flush_*", "libvirt_domain_info_cpu_time_seconds*"],
+            labels={"libvirt_domain_block_dev_metadata": {"drop": ["source_file"], "rename": {"disk_type": "type"}}},
+            max_series_per_metric={"libvirt_domain_state": 1},
+        )
+        registry = CollectorRegistry()
+        metrics = config.metric_set(registry)
+        assert not metrics.libvirt_domain_block_dev_flush_operations.enabled
+        assert not metrics.libvirt_domain_cpu_time.enabled
+        assert metrics.libvirt_domain_cpu_user_time.enabled
+
+        conn = FakeConnection(domains=2, nics=1, disks=1)
+        tracker = SeriesTracker(metrics=metrics)
+        asyncio.run(DomainWorker(conn, metrics=tracker).sweep())
+
+        output = generate_latest(registry).decode()
+        assert "flush" not in output
+        assert "libvirt_domain_info_cpu_time_seconds_total" not in output
+        assert 'type="file"' in output and "source_file" not in output
+        assert output.count("libvirt_domain_state{") == 1
+        assert exporter_desc.libvirt_exporter_series_overflow.labels(
+            metric="libvirt_domain_state"
+        )._value.get() >= 1
+
+    def test_disabled_group_skips_calls(self):
+        config = MetricConfig(disable=["libvirt_domain_io_*", "libvirt_domain_mem_stat_*"])
+        conn = FakeConnection(domains=2, nics=2, disks=1)
+        asyncio.run(DomainWorker(conn, metrics=config.metric_set()).sweep())
+        assert "interfaceStats" not in conn.rpcs
+        assert "memoryStats" not in conn.rpcs
+        assert conn.rpcs["blockStatsFlags"] == 2
+
+
+class TestSeriesSnapshot:
+    def test_unchanged_values_are_not_written(self, mocker):
+        conn = FakeConnection(domains=2, nics=1, disks=1)
+        registry = CollectorRegistry()
+        metrics = prometheus_desc.metric_set(registry)
+        domain_worker = DomainWorker(conn, metrics=metrics)
+        labels = mocker.spy(metrics.libvirt_domain_io_rx_bytes, "labels")
+        child = metrics.libvirt_domain_block_dev_read_bytes.labels(
+            domain="domain-0", target_dev="vda"
+        )
+
+        async def sweeps():
+            await domain_worker.sweep()
+            await domain_worker.sweep()
+            # Children are resolved once per snapshot
+            assert labels.call_count == 2
+            child._value.set(0)
+            await domain_worker.sweep()
+            # Unchanged since the last sweep, so not written again
+            assert child._value.get() == 0
+            domain_worker.snapshots.max_age = 1e-9
+            await domain_worker.sweep()
+            assert child._value.get() == 4096
+            assert labels.call_count == 4
+
+        asyncio.run(sweeps())
+
+    def test_new_metrics_reset_snapshots(self):
+        cache = SnapshotCache()
+        snapshot = cache.lookup(prometheus_desc, "uuid", "domain")
+        assert cache.lookup(prometheus_desc, "uuid", "domain") is snapshot
+        assert cache.lookup(prometheus_desc, "uuid", "renamed") is not snapshot
+        assert cache.lookup(object(), "uuid", "renamed") is not snapshot
+        cache.retain([])
+        assert not cache.snapshots
+
+
+class TestDomainMetadata:
+    def test_extract(self):
+        xml = (
+            "<domain><metadata>"
+            "<nova:instance xmlns:nova='http://openstack.org/xmlns/libvirt/nova/1.1'>"
+            "<nova:name>instance</nova:name><nova:owner>"
+            "<nova:user uuid='5678'>user</nova:user></nova:owner>"
+            "</nova:instance></metadata></domain>"
+        )
+        assert DomainDescription(1, xml).metadata == {
+            "nova": dict(
+                instance_name="instance",
+                flavor="",
+                user_name="user",
+                user_uuid="5678",
+                project_name="",
+                project_uuid="",
+            )
+        }
+        assert DomainDescription(1, "<domain/>").metadata == {}
+        assert DomainDescription(1, "<domain><metadata/></domain>").metadata == {}
+
+    def test_fetch_without_domain_xml(self):
+        conn = FakeConnection(domains=2, nics=1, disks=1)
+        conn.domains[1].nova = None
+        registry = CollectorRegistry()
+        config = MetricConfig(disable=["libvirt_domain_io_*", "libvirt_domain_block_dev_*"])
+        asyncio.run(DomainWorker(conn, metrics=config.metric_set(registry)).sweep(("nova",)))
+        assert "XMLDesc" not in conn.rpcs
+        assert conn.rpcs["metadata"] == 2
+        assert registry.get_sample_value(
+            "libvirt_domain_nova_metadata_info",
+            dict(
+                domain="domain-0",
+                uuid=conn.domains[0].uuid,
+                instance_name="instance-0",
+                flavor="m1.small",
+                user_name="user-0",
+                user_uuid=conn.domains[0].uuid,
+                project_name="project-0",
+                project_uuid=conn.domains[0].uuid,
+            ),
+        ) == 1
+        assert domain_metadata.fetch(conn.domains[1], domain_metadata.NOVA) is None
+
+
+class TestVcpuStats:
+    def test_one_bulk_call_per_sweep(self):
+        registry = CollectorRegistry()
+        metrics = prometheus_desc.metric_set(registry)
+        conn = FakeConnection(domains=10, nics=0, disks=0)
+        domain_worker = DomainWorker(conn, stats_groups=("vcpu",), metrics=metrics)
+
+        async def sweeps():
+            await domain_worker.sweep(("vcpu",))
+            conn.rpcs.clear()
+            await domain_worker.sweep(("vcpu",))
+
+        asyncio.run(sweeps())
+        assert conn.rpcs == {"getAllDomainStats": 1}
+        labels = {"domain": "domain-9", "vcpu": "1"}
+        assert registry.get_sample_value("libvirt_domain_vcpu_state", labels) == 1
+        assert registry.get_sample_value(
+            "libvirt_domain_vcpu_time_seconds_total", labels
+        ) == 5
+        assert registry.get_sample_value(
+            "libvirt_domain_vcpu_delay_seconds_total", labels
+        ) == 0.1
+
+    def test_not_requested(self):
+        registry = CollectorRegistry()
+        conn = FakeConnection(domains=2, nics=0, disks=0)
+        metrics = prometheus_desc.metric_set(registry)
+        asyncio.run(DomainWorker(conn, metrics=metrics).sweep(("state", "vcpu")))
+        assert "getAllDomainStats" not in conn.rpcs
+        assert conn.rpcs["info"] == 2
+        assert registry.get_sample_value(
+            "libvirt_domain_vcpu_state", {"domain": "domain-1", "vcpu": "1"}
+        ) is None
+
+    def test_vcpus_written_once(self, mocker):
+        conn = FakeConnection(domains=1, nics=0, disks=0)
+        info = mocker.patch.object(
+            conn.domains[0],
+            "info",
+            return_value=[libvirt.VIR_DOMAIN_RUNNING, 4194304, 2097152, 7, 0],
+        )
+        metrics = prometheus_desc.metric_set()
+        labels = mocker.spy(metrics.libvirt_domain_vcpus, "labels")
+        domain_worker = DomainWorker(conn, stats_groups=("vcpu",), metrics=metrics)
+        asyncio.run(domain_worker.sweep(("state", "vcpu")))
+        # state still comes from info(), vcpus only from the bulk record
+        info.assert_called_once_with()
+        assert labels.call_count == 1
+        assert metrics.libvirt_domain_vcpus.labels(domain="domain-0")._value.get() == 2
+
+
+class TestRateStore:
+    def test_rate(self):
+        rates = RateStore()
+        assert rates.rate("uuid", ("cpu",), 10, 100) is None
+        assert rates.rate("uuid", ("cpu",), 20, 150) == 5
+        # Counter reset, counted up from 0 since
+        assert rates.rate("uuid", ("cpu",), 30, 40) == 4
+        rates.forget("uuid")
+        assert rates.rate("other", ("cpu",), 30, 40) is None
+        assert len(rates.values) == 1
+
+    def test_derived_metrics(self, mocker):
+        registry = CollectorRegistry()
+        conn = FakeConnection(domains=1, nics=1, disks=0)
+        domain_worker = DomainWorker(
+            conn, metrics=prometheus_desc.metric_set(registry), rates=RateStore()
+        )
+        clock = mocker.patch("prometheus_libvirt.domain_worker.time")
+
+        async def sweeps():
+            clock.monotonic.return_value = 100
+            await domain_worker.sweep()
+            clock.monotonic.return_value = 110
+            # 2 more seconds of CPU time over 10s on 2 vCPUs
+            conn.domains[0].getCPUStats = lambda total: [
+                {"cpu_time": 12 * 10**9, "user_time": 0, "system_time": 0}
+            ]
+            await domain_worker.sweep()
+
+        asyncio.run(sweeps())
+        assert registry.get_sample_value(
+            "libvirt_domain_info_cpu_usage_percent", {"domain": "domain-0"}
+        ) == 10
+        assert registry.get_sample_value(
+            "libvirt_domain_interface_receive_bytes_per_second",
+            {"domain": "domain-0", "dev_mac": "52:54:00:00:00:00"},
+        ) == 0
+
+
+class TestStorageVolumeWorker:
+    def test_cached_listing(self):
+        registry = CollectorRegistry()
+        conn = FakeConnection(domains=0, pools=2, volumes=5)
+        worker = StorageVolumeWorker(
+            conn, metrics=prometheus_desc.metric_set(registry), batch_size=2
+        )
+        worker.inventory.start()
+
+        async def sweeps():
+            assert await worker.sweep() == 10
+            assert await worker.sweep() == 10
+            assert conn.rpcs["listAllVolumes"] == 2
+            assert conn.rpcs["volumeInfo"] == 20
+            # A refresh event lists the pool again
+            worker.inventory.refresh_callback(conn, conn.pools[1], None)
+            del conn.pools[1].volumes[4]
+            await worker.sweep()
+            assert conn.rpcs["listAllVolumes"] == 3
+
+        asyncio.run(sweeps())
+        assert conn.rpcs["storagePoolEventRegisterAny"] == 2
+        assert registry.get_sample_value(
+            "libvirt_storage_volume_allocation_bytes",
+            {"pool_name": "pool-1", "volume_name": "volume-3.qcow2"},
+        ) == 4 * 2**30
+        assert exporter_desc.libvirt_exporter_volume_refreshes.labels(
+            pool="pool-1", reason="event", host=""
+        )._value.get() >= 1
+
+    def test_deleted_volume(self, mocker):
+        conn = FakeConnection(domains=0, pools=1, volumes=2)
+        conn.pools[0].volumes[1].info = mocker.Mock(
+            side_effect=libvirt.libvirtError("no volume")
+        )
+        worker = StorageVolumeWorker(conn, metrics=prometheus_desc.metric_set())
+        asyncio.run(worker.sweep())
+        assert worker.inventory.stale == {conn.pools[0].UUIDString()}
+
+
+class TestMemoryStats:
+    def test_available_only(self, mocker):
+        registry = CollectorRegistry()
+        conn = FakeConnection(domains=2, nics=0, disks=0)
+        mocker.patch.object(conn.domains[0], "memory_stats", return_value={"rss": 1000})
+        mocker.patch.object(conn.domains[1], "memory_stats", return_value={})
+        domain_worker = DomainWorker(
+            conn,
+            metrics=prometheus_desc.metric_set(registry),
+            memory_stats=MemoryStatsCache(period=10, export_absent=False),
+        )
+
+        async def sweeps():
+            await domain_worker.sweep(("balloon",))
+            await domain_worker.sweep(("balloon",))
+
+        asyncio.run(sweeps())
+        # Once per domain start
+        assert conn.rpcs["setMemoryStatsPeriod"] == 2
+        # domain-1 reports nothing, it is not asked again
+        assert conn.rpcs["memoryStats"] == 3
+        assert registry.get_sample_value(
+            "libvirt_domain_mem_stat_rss_bytes", {"domain": "domain-0"}
+        ) == 1000 * 1024
+        assert registry.get_sample_value(
+            "libvirt_domain_mem_stat_swap_in_bytes_total", {"domain": "domain-0"}
+        ) is None
+        assert registry.get_sample_value(
+            "libvirt_domain_info_memory_usage_bytes", {"domain": "domain-1"}
+        ) == 2097152 * 1024
+
+    def test_new_generation(self, mocker):
+        cache = MemoryStatsCache()
+        domain = mocker.Mock()
+        domain.UUIDString.return_value = "1234"
+        domain.ID.return_value = 1
+        support = cache.lookup(domain)
+        cache.store(support, ["rss"])
+        support.period_set = True
+        assert cache.lookup(domain).keys == {"rss"}
+        domain.ID.return_value = 2
+        assert cache.lookup(domain).keys is None
+        assert not cache.lookup(domain).period_set
+
+
+class TestHostWorker:
+    def test_node_and_allocations(self, mocker):
+        registry = CollectorRegistry()
+        metrics = prometheus_desc.metric_set(registry)
+        conn = FakeConnection(domains=3, nics=0, disks=0)
+        mocker.patch.object(
+            conn.domains[2],
+            "info",
+            return_value=[libvirt.VIR_DOMAIN_SHUTOFF, 4194304, 4194304, 2, 0],
+        )
+        allocations = DomainAllocations()
+        domain_worker = DomainWorker(conn, metrics=metrics, allocations=allocations)
+        host_worker = HostWorker(conn, allocations, metrics=metrics)
+
+        async def sweeps():
+            await domain_worker.sweep(("state", "vcpu", "balloon"))
+            await host_worker.sweep()
+            await host_worker.sweep()
+
+        asyncio.run(sweeps())
+        assert conn.rpcs["getHostname"] == 1
+        assert conn.rpcs["getCapabilities"] == 1
+        node = {"node": "fake-host"}
+        assert registry.get_sample_value("libvirt_node_cpus", node) == 64
+        assert registry.get_sample_value(
+            "libvirt_node_cpu_time_seconds_total", {**node, "mode": "idle"}
+        ) == 10**5
+        assert registry.get_sample_value(
+            "libvirt_node_free_pages",
+            {**node, "cell": "1", "page_size": str(2 * 1024**2)},
+        ) == 1024
+        # The shut off domain holds nothing
+        assert registry.get_sample_value("libvirt_node_active_domains", node) == 2
+        assert registry.get_sample_value("libvirt_node_allocated_vcpus", node) == 4
+        assert registry.get_sample_value(
+            "libvirt_node_allocated_memory_bytes", node
+        ) == 2 * 2097152 * 1024
+
+    def test_allocations_only(self):
+        registry = CollectorRegistry()
+        conn = FakeConnection(domains=0)
+        worker = HostWorker(
+            conn,
+            DomainAllocations(),
+            metrics=prometheus_desc.metric_set(registry),
+            node_stats=False,
+        )
+        asyncio.run(worker.sweep())
+        assert set(conn.rpcs) == {"getHostname"}
+        assert registry.get_sample_value(
+            "libvirt_node_active_domains", {"node": "fake-host"}
+        ) == 0
+
+
+class TestLocalStats:
+    def test_files_and_fallback(self, tmp_path, mocker):
+        cgroup = tmp_path / "cgroup"
+        scope = cgroup / "machine.slice"
+        scope /= "machine-qemu\\x2d1\\x2ddomain\\x2d0.scope"
+        scope.mkdir(parents=True)
+        (cgroup / "cgroup.controllers").write_text("cpu memory\n")
+        (scope / "cpu.stat").write_text(
+            "usage_usec 3000000\nuser_usec 1000000\nsystem_usec 2000000\n"
+        )
+        (scope / "memory.stat").write_text(
+            "anon 1048576\nfile 8192\nfile_mapped 1024\n"
+        )
+        statistics = tmp_path / "net" / "tap0-0" / "statistics"
+        statistics.mkdir(parents=True)
+        for name in INTERFACE_FILES:
+            (statistics / name).write_text("300\n" if name == "tx_bytes" else "0\n")
+        local_stats = LocalStats(str(cgroup), str(tmp_path / "net"))
+        assert local_stats.available()
+        registry = CollectorRegistry()
+        conn = FakeConnection(domains=2, nics=2, disks=0)
+        mocker.patch.object(
+            conn.domains[0],
+            "memory_stats",
+            return_value={"actual": 2097152, "rss": 5},
+        )
+        worker = DomainWorker(
+            conn, metrics=prometheus_desc.metric_set(registry), local_stats=local_stats
+        )
+
+        async def sweeps():
+            await worker.sweep(("cpu", "balloon", "interface"))
+            (scope / "cpu.stat").write_text(
+                "usage_usec 4000000\nuser_usec 1000000\nsystem_usec 3000000\n"
+            )
+            await worker.sweep(("cpu", "balloon", "interface"))
+
+        asyncio.run(sweeps())
+        domain = {"domain": "domain-0"}
+        # Read again through the open file
+        assert registry.get_sample_value(
+            "libvirt_domain_info_cpu_time_seconds_total", domain
+        ) == 4
+        # domain-1 has no scope, it goes through libvirt
+        assert conn.rpcs["getCPUStats"] == 2
+        assert registry.get_sample_value(
+            "libvirt_domain_mem_stat_rss_bytes", domain
+        ) == 1049600
+        # domain-0 reports nothing beyond actual and rss, it is asked once
+        assert conn.rpcs["memoryStats"] == 3
+        # The tap's tx is the guest's rx
+        assert registry.get_sample_value(
+            "libvirt_domain_interface_receive_bytes_total",
+            {**domain, "dev_mac": "52:54:00:00:00:00"},
+        ) == 300
+        # tap0-1 has no statistics
+        assert conn.rpcs["interfaceStats"] == 6
+
+    def test_restart_rescans(self, tmp_path, mocker):
+        machine_slice = tmp_path / "machine.slice"
+        (machine_slice / "machine-qemu\\x2d1\\x2da.scope").mkdir(parents=True)
+        local_stats = LocalStats(str(tmp_path))
+        domain = mocker.Mock()
+        domain.UUIDString.return_value = "1234"
+        domain.ID.return_value = 1
+        assert local_stats.lookup(domain).cpu_stat is not None
+        domain.ID.return_value = 2
+        assert local_stats.lookup(domain).cpu_stat is None
+        (machine_slice / "machine-qemu\\x2d3\\x2da.scope").mkdir()
+        domain.ID.return_value = 3
+        assert local_stats.lookup(domain).cpu_stat is not None
+        assert set(local_stats.scopes) == {1, 3}
+
+
+class TestShard:
+    def test_domains_split(self):
+        registries = [CollectorRegistry() for _ in range(3)]
+        conn = FakeConnection(domains=30, nics=0, disks=0)
+        workers = [
+            DomainWorker(
+                conn,
+                metrics=prometheus_desc.metric_set(registry),
+                shard=Shard(index, 3),
+            )
+            for index, registry in enumerate(registries)
+        ]
+
+        async def sweeps():
+            return [await worker.sweep(("state",)) for worker in workers]
+
+        counts = asyncio.run(sweeps())
+        assert sum(counts) == 30
+        assert all(counts)
+        names = [
+            {
+                sample.labels["domain"]
+                for family in registry.collect()
+                for sample in family.samples
+                if family.name == "libvirt_domain_state"
+            }
+            for registry in registries
+        ]
+        assert set().union(*names) == {"domain-%d" % i for i in range(30)}
+        assert not names[0] & names[1]
+
+    def test_batches_merged(self):
+        registry = CollectorRegistry()
+        gauge = prometheus_desc.clone(prometheus_desc.libvirt_domain_state, registry)
+        gauge.labels(domain="a").set(1)
+        gauge.labels(domain="b").set(2)
+        encoder = SeriesEncoder()
+        supervisor = ShardSupervisor(2, "unused:entry")
+        first, second = supervisor.shards
+        first.series.apply(encoder.batch(registry))
+
+        # Unchanged values aren't sent again
+        gauge.labels(domain="b").set(3)
+        gauge.remove("a")
+        batch = encoder.batch(registry)
+        assert len(batch) < 100
+        first.series.apply(batch)
+
+        other = CollectorRegistry()
+        prometheus_desc.clone(prometheus_desc.libvirt_domain_state, other).labels(
+            domain="c"
+        ).set(4)
+        second.series.apply(SeriesEncoder().batch(other))
+        merged = CollectorRegistry()
+        merged.register(supervisor)
+        assert merged.get_sample_value("libvirt_domain_state", {"domain": "a"}) is None
+        assert merged.get_sample_value("libvirt_domain_state", {"domain": "b"}) == 3
+        assert merged.get_sample_value("libvirt_domain_state", {"domain": "c"}) == 4
+        assert generate_latest(merged).count(b"# TYPE libvirt_domain_state") == 1
+
+    def test_exporter_metrics_labeled(self):
+        supervisor = ShardSupervisor(2, "unused:entry")
+        exporter_desc.libvirt_exporter_rpc_errors.labels(method="sharded").inc()
+        for shard in supervisor.shards:
+            registry = CollectorRegistry()
+            registry.register(ShardMetrics(Shard(shard.index, 2)))
+            shard.series.apply(SeriesEncoder().batch(registry))
+        merged = CollectorRegistry()
+        merged.register(supervisor)
+        for index in ("0", "1"):
+            assert merged.get_sample_value(
+                "libvirt_exporter_rpc_errors_total", {"method": "sharded", "shard": index}
+            ) >= 1
+        # The supervisor keeps its own shard series
+        assert merged.get_sample_value(
+            "libvirt_exporter_shard_restarts_total", {"shard": "0"}
+        ) is None
+        assert generate_latest(merged).count(b"# TYPE libvirt_exporter_rpc_errors_total counter") == 1
+
+    def test_allocations_summed(self):
+        supervisor = ShardSupervisor(2, "unused:entry")
+        for shard, domains in zip(supervisor.shards, (2, 3)):
+            registry = CollectorRegistry()
+            gauge = prometheus_desc.clone(prometheus_desc.libvirt_node_domains, registry)
+            gauge.labels(node="host").set(domains)
+            shard.series.apply(SeriesEncoder().batch(registry))
+        merged = CollectorRegistry()
+        merged.register(supervisor)
+        assert merged.get_sample_value(
+            "libvirt_node_active_domains", {"node": "host"}
+        ) == 5
+
+    def test_duplicates_not_summed(self):
+        supervisor = ShardSupervisor(2, "unused:entry")
+        for shard, state in zip(supervisor.shards, (1, 3)):
+            registry = CollectorRegistry()
+            gauge = prometheus_desc.clone(prometheus_desc.libvirt_domain_state, registry)
+            gauge.labels(domain="moved").set(state)
+            shard.series.apply(SeriesEncoder().batch(registry))
+        merged = CollectorRegistry()
+        merged.register(supervisor)
+        assert merged.get_sample_value("libvirt_domain_state", {"domain": "moved"}) == 1
+        assert generate_latest(merged).count(b'libvirt_domain_state{domain="moved"}') == 1
+
+    def test_restart_keeps_other_shards(self, mocker):
+        supervisor = ShardSupervisor(2, "unused:entry")
+        for shard, domain in zip(supervisor.shards, ("a", "b")):
+            registry = CollectorRegistry()
+            prometheus_desc.clone(
+                prometheus_desc.libvirt_domain_state, registry
+            ).labels(domain=domain).set(1)
+            shard.series.apply(SeriesEncoder().batch(registry))
+        # A replacement process of shard 1 sends its first batch
+        restarted = supervisor.shards[1]
+        restarted.fresh = True
+        restarted.connection = mocker.Mock()
+        registry = CollectorRegistry()
+        prometheus_desc.clone(prometheus_desc.libvirt_domain_state, registry).labels(
+            domain="d"
+        ).set(1)
+        restarted.connection.recv_bytes.return_value = SeriesEncoder().batch(registry)
+        supervisor.receive(restarted)
+        merged = CollectorRegistry()
+        merged.register(supervisor)
+        assert merged.get_sample_value("libvirt_domain_state", {"domain": "a"}) == 1
+        assert merged.get_sample_value("libvirt_domain_state", {"domain": "b"}) is None
+        assert merged.get_sample_value("libvirt_domain_state", {"domain": "d"}) == 1
+
+
+class TestExporter:
+    def test_start_without_libvirtd(self, mocker):
+        conn = FakeConnection(domains=2, nics=0, disks=0)
+        mocker.patch(
+            "libvirt.open", side_effect=[libvirt.libvirtError("no libvirtd"), conn]
+        )
+        exporter = Exporter(parse_args(["--listen-address", "127.0.0.1", "--port", "0"]))
+
+        async def main():
+            await exporter.start()
+            pool = exporter.pools[0]
+            status, _, body = health_response(exporter.schedulers, exporter.pools, 3)
+            assert status == 503
+            assert b"no connection" in body
+            while pool.reconnecting:
+                await asyncio.sleep(0.1)
+            assert pool.primary() is conn
+            await exporter.http_server.close()
+
+        asyncio.run(main())
+        assert conn.rpcs["getVersion"] == 1
+
+
+class RemoteWriteReceiver(http.server.BaseHTTPRequestHandler):
+    # Answers with the next of statuses, records the bodies it accepted
+    statuses = []
+    bodies = []
+    requests = 0
+
+    def do_POST(self):
+        RemoteWriteReceiver.requests += 1
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        status = self.statuses.pop(0) if self.statuses else 204
+        if status < 300:
+            assert self.headers["Content-Encoding"] == "snappy"
+            self.bodies.append(body)
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def snappy_literals(data: bytes) -> bytes:
+    # Reverses snappy_compress without python-snappy
+    length, shift, pos = 0, 0, 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        length |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            break
+    out = bytearray()
+    while pos < len(data):
+        assert data[pos] == 61 << 2
+        size = int.from_bytes(data[pos + 1 : pos + 3], "little") + 1
+        out += data[pos + 3 : pos + 3 + size]
+        pos += 3 + size
+    assert len(out) == length
+    return bytes(out)
+
+
+class TestPush:
+    @pytest.fixture
+    def receiver(self):
+        RemoteWriteReceiver.statuses = []
+        RemoteWriteReceiver.bodies = []
+        RemoteWriteReceiver.requests = 0
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RemoteWriteReceiver)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        yield "http://127.0.0.1:%d/api/v1/write" % server.server_address[1]
+        server.shutdown()
+
+    def test_snappy_literals(self):
+        data = bytes(range(256)) * 600
+        assert snappy_literals(snappy_compress(data)) == data
+
+    def test_spool_survives_outage(self, mocker, receiver, tmp_path):
+        mocker.patch("prometheus_libvirt.push.snappy", None)
+        registry = CollectorRegistry()
+        metrics = prometheus_desc.metric_set(registry)
+        metrics.libvirt_domain_state.labels(domain="pushed").set(1)
+        metrics.libvirt_domain_state.labels(domain="other").set(5)
+
+        async def push(writer, requests):
+            task = asyncio.get_running_loop().create_task(writer.run())
+            await asyncio.sleep(0)
+            writer.invalidate()
+            while RemoteWriteReceiver.requests < requests:
+                await asyncio.sleep(0.05)
+            task.cancel()
+
+        # The receiver is down, batches stay in the spool
+        RemoteWriteReceiver.statuses = [503] * 10
+        spool = Spool(str(tmp_path))
+        writer = RemoteWriter(
+            registry, receiver, spool, labels={"job": "libvirt"}, max_samples=1
+        )
+        asyncio.run(push(writer, 1))
+        assert not RemoteWriteReceiver.bodies
+        # A batch per sample
+        assert len(spool.pending()) == 2
+
+        # Left over batches are sent first after a restart
+        RemoteWriteReceiver.statuses = []
+        restarted = Spool(str(tmp_path))
+        assert restarted.next_seq == 2
+        leftover = restarted.read(0)
+        asyncio.run(push(RemoteWriter(registry, receiver, restarted), 4))
+        assert RemoteWriteReceiver.bodies[0] == leftover
+        payload = snappy_literals(leftover)
+        assert b"libvirt_domain_state" in payload
+        assert b"job" in payload